@@ -1,35 +1,124 @@
+import importlib
+import threading
 from flask import Flask
-from flask_bootstrap import Bootstrap
-from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
-from flask_mail import Mail
 from flask_login import LoginManager
+from sqlalchemy import exc
+from .database import Database
+from .last_seen import LastSeenTracker
+from .cache import UserCache, FragmentCache
+from .hashing import PasswordHasher
+from .tokens import TokenSigner
+from .availability import AvailabilityIndex
+from .throttle import Throttle
+from .metrics import Metrics
+from .query_budget import QueryBudget
+from .profiler import Profiler
+from .templating import Templates
+from .directory import UserDirectory
 from config import config # from sys.path/config.py import dictionary config
 
 
-bootstrap = Bootstrap()
-moment = Moment()
-db = SQLAlchemy()
-mail = Mail()
+db = Database() # SQLAlchemy with per-config engine profile
 login_manager = LoginManager()
+last_seen = LastSeenTracker()
+user_cache = UserCache()
+fragment_cache = FragmentCache()
+password_hasher = PasswordHasher()
+tokens = TokenSigner()
+availability = AvailabilityIndex()
+throttle = Throttle()
+metrics = Metrics()
+query_budget = QueryBudget()
+profiler = Profiler()
+templates = Templates()
+directory = UserDirectory()
 login_manager.session_protection = 'strong' # strong means to check clients IP address
 login_manager.login_view = 'auth.login' # blueprint name = auth, route = login
 
-def create_app(config_name):
+
+# ----- Extensions imported on first use -----
+# Flask-Bootstrap (WTForms, email_validator), Flask-Moment (distutils) and
+# Flask-Mail (smtplib, the email package) are a good part of the import time
+# of the app, and only pages and sending mail need them. 'from app import mail'
+# still works: the module and the instance are created on first access (PEP
+# 562). create_app() sets up bootstrap and moment for apps with blueprints,
+# mail is set up by the first message sent (app/email.py).
+LAZY_EXTENSIONS = {
+    'bootstrap': ('flask_bootstrap', 'Bootstrap'),
+    'moment': ('flask_moment', 'Moment'),
+    'mail': ('flask_mail', 'Mail'),
+}
+_lazy_lock = threading.Lock()
+
+
+def _lazy_extension(name):
+    with _lazy_lock:
+        if name not in globals():
+            module, cls = LAZY_EXTENSIONS[name]
+            globals()[name] = getattr(importlib.import_module(module), cls)()
+    return globals()[name]
+
+
+def __getattr__(name):
+    if name in LAZY_EXTENSIONS:
+        return _lazy_extension(name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+# blueprints=False: no pages, forms or Bootstrap/Moment, for CLI commands and
+# scripts that only need the models and the database (see manage.py)
+def create_app(config_name, replica_urls=None, blueprints=True):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
+    if replica_urls is not None: # read replicas, see app/database.py
+        app.config['SQLALCHEMY_REPLICA_URLS'] = list(replica_urls)
     config[config_name].init_app(app) # init_app is not a staticmethod from config.py
 
-    bootstrap.init_app(app)
-    mail.init_app(app)
-    moment.init_app(app)
     db.init_app(app)
     login_manager.init_app(app)
+    last_seen.init_app(app)
+    user_cache.init_app(app)
+    fragment_cache.init_app(app)
+    password_hasher.init_app(app)
+    tokens.init_app(app)
+    availability.init_app(app)
+    throttle.init_app(app)
+    metrics.init_app(app) # before the first engine is made
+    query_budget.init_app(app) # same
+    profiler.init_app(app)
+    templates.init_app(app) # bytecode cache
+    directory.init_app(app) # admin user directory, counts of users
+
+    from .email import outbox # from ./email.py, needs the models
+    outbox.init_app(app)
+
+    if blueprints:
+        _lazy_extension('bootstrap').init_app(app)
+        _lazy_extension('moment').init_app(app)
+
+        from .main import main as main_blueprint # from ./main
+        app.register_blueprint(main_blueprint)
+
+        from .auth import auth as auth_blueprint # from ./auth
+        app.register_blueprint(auth_blueprint, url_prefix='/auth')
+
+        from .admin import admin as admin_blueprint # from ./admin
+        app.register_blueprint(admin_blueprint, url_prefix='/admin')
 
-    from .main import main as main_blueprint # from ./main
-    app.register_blueprint(main_blueprint)
+    # Permission table for User.can(); on an empty database it is built on
+    # first use. The username/email filters read every user, they are built by
+    # the first check or by warm_up() (app/prefork.py), never for CLI commands
+    from .models import Role
+    with app.app_context():
+        try:
+            Role.load_permission_table()
+        except exc.OperationalError:
+            db.session.rollback()
+            app.extensions['permissions'] = None
 
-    from .auth import auth as auth_blueprint # from ./auth
-    app.register_blueprint(auth_blueprint, url_prefix='/auth')
+    # Every template compiled (or loaded from the bytecode cache) before the
+    # first request, see app/templating.py
+    if blueprints and app.config['PURPLE_TEMPLATE_PREWARM']:
+        templates.prewarm(app)
 
     return app
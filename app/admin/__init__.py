@@ -0,0 +1,6 @@
+from flask import Blueprint
+
+# Pages and downloads for administrators only (Permission.ADMINISTER)
+admin = Blueprint('admin', __name__)
+
+from . import views
@@ -0,0 +1,134 @@
+from datetime import datetime
+from flask import Response, abort, current_app, render_template, request, send_from_directory, stream_with_context
+from flask_login import login_required
+from . import admin
+from .. import directory, metrics, profiler
+from ..decorators import admin_required
+from ..directory import SORTS
+from ..exporter import FORMATS, encode, export_filename, iter_rows
+from ..metrics import BACKGROUND, Histogram, stats_sections
+from ..models import Role
+from ..query_budget import query_budget
+
+
+# ----- Counters of the in-process caches and buffers -----
+@admin.route('/stats')
+@login_required
+@admin_required
+@query_budget(3)
+def stats():
+    sections = [(title, values) for key, title, values in stats_sections()]
+    load_seconds = current_app.extensions['templates']['load_seconds']  # per template, not for /metrics
+    if load_seconds:
+        sections.append(('Template load time at start, seconds', load_seconds))
+    return render_template('admin/stats.html', sections=sections)
+
+
+# ----- Per-endpoint timing and SQL, per-template render time (app/metrics.py) -----
+@admin.route('/metrics')
+@login_required
+@admin_required
+@query_budget(2)
+def metrics_summary():
+    registry = metrics.registry()
+    if registry is None:
+        return render_template('admin/metrics.html', endpoints=None)
+    with registry.lock:
+        merged = {}
+        for (endpoint, method, status), histogram in registry.requests.items():
+            total = merged.setdefault(endpoint, {'histogram': Histogram(histogram.buckets), 'errors': 0})
+            total['errors'] += histogram.count if status >= 500 else 0
+            for i, count in enumerate(histogram.counts):
+                total['histogram'].counts[i] += count
+            total['histogram'].sum += histogram.sum
+            total['histogram'].count += histogram.count
+        endpoints = []
+        for endpoint, total in sorted(merged.items()):
+            histogram, queries = total['histogram'], registry.request_queries[endpoint]
+            statements, sql_seconds = registry.sql.get(endpoint, (0, 0.0))
+            endpoints.append(dict(
+                endpoint=endpoint, requests=histogram.count, errors=total['errors'],
+                avg_ms=histogram.sum / histogram.count * 1000, p95_ms=_ms(histogram.quantile(0.95)),
+                queries=queries.sum / queries.count, sql_ms=sql_seconds / histogram.count * 1000))
+        background = registry.sql.get(BACKGROUND, (0, 0.0))
+        templates = [dict(name=name, renders=count, avg_ms=seconds / count * 1000)
+                     for name, (count, seconds) in sorted(registry.templates.items())]
+        counters = [(name, dict(labels), value) for (name, labels), value in sorted(registry.counters.items())]
+    return render_template('admin/metrics.html', endpoints=endpoints, templates=templates,
+                           background=background, counters=counters)
+
+
+def _ms(seconds):
+    return seconds * 1000 if seconds is not None else None
+
+
+# ----- Saved request profiles (app/profiler.py) -----
+@admin.route('/profiles')
+@login_required
+@admin_required
+@query_budget(2)
+def profiles():
+    return render_template('admin/profiles.html', profiles=profiler.list(),
+                           sample_every=current_app.config['PURPLE_PROFILER_SAMPLE_EVERY'])
+
+
+@admin.route('/profiles/<name>')
+@login_required
+@admin_required
+@query_budget(2)
+def profile_download(name):
+    if name not in profiler.names():
+        abort(404)
+    return send_from_directory(current_app.config['PURPLE_PROFILER_DIR'], name, as_attachment=True)
+
+
+# ----- Streaming export of all users (same output as 'manage.py export-users') -----
+# /admin/users/export?format=csv&gzip=1&since=2022-07-01
+@admin.route('/users/export')
+@login_required
+@admin_required
+@query_budget(3)
+def export_users():
+    fmt = request.args.get('format', 'ndjson')
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+    if fmt not in FORMATS:
+        abort(400)
+    since = request.args.get('since')
+    try:
+        since = datetime.fromisoformat(since) if since else None
+    except ValueError:
+        abort(400)
+    chunks = stream_with_context(encode(iter_rows(since), fmt, compress))
+    filename = export_filename(fmt, compress)
+    return Response(chunks, mimetype='application/gzip' if compress else FORMATS[fmt],
+                    headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+
+
+# ----- Directory of users, keyset pages (app/directory.py) -----
+# /admin/users?sort=username&role=3&confirmed=1&after=<cursor of the last page>
+CONFIRMED_FILTERS = {'': None, '1': True, '0': False}
+
+
+@admin.route('/users')
+@login_required
+@admin_required
+@query_budget(6)
+def users():
+    sort = request.args.get('sort', 'joined')
+    confirmed = request.args.get('confirmed', '')
+    if sort not in SORTS or confirmed not in CONFIRMED_FILTERS:
+        abort(400)
+    confirmed = CONFIRMED_FILTERS[confirmed]
+    roles = {role.id: role for role in Role.query.order_by(Role.id)}
+    role_id = request.args.get('role', type=int)
+    if role_id is not None and role_id not in roles:
+        abort(400)
+    try:
+        page = directory.page(roles.get(role_id), confirmed, sort, request.args.get('after'))
+    except ValueError:
+        abort(400)
+    total, counted_at = directory.count(role_id, confirmed)
+    filters = dict(sort=sort, role=role_id, confirmed=request.args.get('confirmed') or None)
+    return render_template('admin/users.html', users=page['users'], next_cursor=page['next'],
+                           first_page=not request.args.get('after'), roles=roles, filters=filters,
+                           total=total, counted_at=counted_at)
@@ -2,7 +2,7 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import DataRequired, Length, Email, Regexp, EqualTo
 from wtforms import ValidationError
-from ..models import User
+from .. import availability
 
 
 class LoginForm(FlaskForm):
@@ -23,12 +23,13 @@ class RegistrationForm(FlaskForm):
     submit = SubmitField('Register')
 
     # Two custom validators (validate_<form-field-name>) are written as a methods
+    # Free names are answered by the filters of app/availability.py without a query
     def validate_email(self, field):
-        if User.query.filter_by(email=field.data).first():
+        if availability.email_taken(field.data):
             raise ValidationError('Email already registered.')
 
     def validate_username(self, field):
-        if User.query.filter_by(username=field.data).first():
+        if availability.username_taken(field.data):
             raise ValidationError('Username already in use.')
 
 #----- [08f] Form to change password for existing user -----
@@ -57,7 +58,7 @@ class ChangeEmailForm(FlaskForm):
 
     # Custom validators (validate_<form-field-name>) are written as a methods
     def validate_email(self, field):
-        if User.query.filter_by(email=field.data.lower()).first():
+        if availability.email_taken(field.data):
             raise ValidationError('Email already registered.')
 
 
@@ -1,9 +1,12 @@
-from flask import render_template, redirect, request, url_for, flash
+from flask import render_template, redirect, request, url_for, flash, jsonify
 from flask_login import login_user, logout_user, login_required, current_user
 from . import auth # import blueprint from ./__init__.py
-from ..models import User
+from ..models import User, canonical
 from .forms import LoginForm, RegistrationForm, ChangePasswordForm, PasswordResetRequestForm, PasswordResetForm, ChangeEmailForm
-from .. import db
+from sqlalchemy.exc import IntegrityError
+from .. import db, user_cache, availability, throttle
+from ..query_budget import query_budget
+from ..decorators import read_write
 from ..email import send_email
 
 
@@ -25,6 +28,7 @@ def before_request():
 
 
 @auth.route('/unconfirmed')
+@query_budget(2)
 def unconfirmed():
     if current_user.is_anonymous or current_user.confirmed:
         return redirect(url_for('main.index'))
@@ -32,11 +36,16 @@ def unconfirmed():
 #----- [08e] Actions for unconfirmed users END-----
 
 @auth.route('/login', methods=['GET', 'POST'])
+@throttle.limit('login', account_field='email') # 429 per IP and per account, see app/throttle.py
+@query_budget(2)
 def login():
     form = LoginForm()
     if form.validate_on_submit(): # validate_on_submit() from Flask-WTF
-        user = User.query.filter_by(email=form.email.data).first()
-        if user is not None and user.verify_password(form.password.data):
+        # Not from user_cache: credentials are always checked against the database
+        user = User.query.filter_by(email_canonical=canonical(form.email.data)).first()
+        with throttle.verification(): # 503 when this worker is busy hashing already
+            valid = user is not None and user.verify_password(form.password.data)
+        if valid:
             login_user(user, form.remember_me.data) # login_user() from Flask-Login
             return redirect(request.args.get('next') or url_for('main.index'))
         flash('Invalid username or password.')
@@ -44,12 +53,14 @@ def login():
 
 @auth.route('/logout')
 @login_required # login_required() from Flak-Login
+@query_budget(2)
 def logout():
     logout_user() # logout_user() from Flak-Login
     flash('You have been logged out.')
     return redirect(url_for('main.index'))
 
 @auth.route('/register', methods=['GET', 'POST'])
+@query_budget(6)
 def register():
     form = RegistrationForm()
     if form.validate_on_submit():
@@ -60,7 +71,12 @@ def register():
         )
         db.session.add(user)
         #-----[08e] Block for sending email confirmation-----
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError: # registered by someone else after the form was validated
+            db.session.rollback()
+            form.email.errors.append('Email or username already registered.')
+            return render_template('auth/register.html', form=form)
         token = user.generate_confirmation_token()
         send_email(user.email, 'Confirm Your Account',
                    'auth/email/confirm', user=user, token=token)
@@ -69,13 +85,34 @@ def register():
         #-----[08e] End block-----
     return render_template('auth/register.html', form=form)
 
+#----- Availability of a username/email while the register form is filled in -----
+# /auth/check-availability?username=john&email=john@example.com
+@auth.route('/check-availability')
+@throttle.limit('availability', methods=('GET',))
+@query_budget(3)
+def check_availability():
+    result = {}
+    for field, taken in (('email', availability.email_taken), ('username', availability.username_taken)):
+        value = request.args.get(field)
+        if value is not None:
+            value = value.strip()
+            result[field] = {'value': value, 'available': bool(value) and not taken(value)}
+    if not result:
+        return jsonify(error='Pass email and/or username.'), 400
+    response = jsonify(result)
+    response.cache_control.no_store = True
+    return response
+
 #----- [08e] Function to confirm account -----
 @auth.route('/confirm/<token>')
 @login_required # Decorator form Flask-Login. Need to login on a first step
+@query_budget(2)
+@read_write  # writes on GET
 def confirm(token):
     if current_user.confirmed:
         return redirect(url_for('main.index'))
     if current_user.confirm(token):
+        db.session.commit() # now, so the read-your-writes window starts with this response
         flash('You have confirmed your account. Thanks!')
     else:
         flash('The confirmation link is invalid or has expired.')
@@ -84,6 +121,8 @@ def confirm(token):
 #----- [08e] Function to resend confirmation email -----
 @auth.route('/confirm')
 @login_required
+@query_budget(3)
+@read_write  # writes on GET
 def resend_confirmation():
     token = current_user.generate_confirmation_token()
     send_email(current_user.email, 'Confirm Your Account',
@@ -94,14 +133,18 @@ def resend_confirmation():
 #----- [08f] Function to change password for existing user -----
 @auth.route('/change-password', methods=['GET', 'POST'])
 @login_required
+@query_budget(3) # the UPDATE is committed in the view
 def change_password():
     form = ChangePasswordForm()
     if form.validate_on_submit():
-        # Use def verify_password(self, password) form models.py as a condition
-        if current_user.verify_password(form.old_password.data):
+        # Use def verify_password(self, password) form models.py as a condition.
+        # current_user may come from user_cache, its password_hash is read from the database
+        with throttle.verification():
+            valid = current_user.verify_password(form.old_password.data)
+        if valid:
             current_user.password = form.password.data  # password - property from models.py
-            db.session.add(current_user)  # Only add it to the session without commit (because session is still open)
-            # db.session.commit() # but with commit it is still working
+            db.session.add(current_user)
+            db.session.commit() # now, so the read-your-writes window starts with this response
             flash('Your password has been updated.')
             return redirect(url_for('main.index'))
         else:
@@ -117,12 +160,14 @@ def change_password():
 #   get_id() returns None
 
 @auth.route('/reset', methods=['GET', 'POST'])
+@throttle.limit('reset', account_field='email')
+@query_budget(2)
 def password_reset_request():
     if not current_user.is_anonymous:  # if not (True)
         return redirect(url_for('main.index'))
     form = PasswordResetRequestForm()
     if form.validate_on_submit():  # The convenient validate_on_submit will check if it is a POST request and if it is valid
-        user = User.query.filter_by(email=form.email.data).first()
+        user = user_cache.get_by_email(form.email.data)
         if user:
             token = user.generate_reset_token()
             send_email(user.email, 'Reset Your Password',
@@ -136,15 +181,18 @@ def password_reset_request():
 
 #----- [08g] Function to reset password for existing user -----
 @auth.route('/reset/<token>', methods=['GET', 'POST'])
+@throttle.limit('login') # hashes the new password
+@query_budget(2)
 def password_reset(token):
     if not current_user.is_anonymous:
         return redirect(url_for('main.index'))
     form = PasswordResetForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
+        user = User.query.filter_by(email_canonical=canonical(form.email.data)).first()
         if user is None:
             return redirect(url_for('main.index'))
         if user.reset_password(token, form.password.data):
+            db.session.commit() # now, so the read-your-writes window starts with this response
             flash('Your password has been updated.')
             return redirect(url_for('auth.login'))
         else:
@@ -154,10 +202,13 @@ def password_reset(token):
 #----- [08e] Function  to create a request for changing email address -----
 @auth.route('/change_email', methods=['GET', 'POST'])
 @login_required
+@query_budget(3)
 def change_email_request():
     form = ChangeEmailForm()
     if form.validate_on_submit():
-        if current_user.verify_password(form.password.data):
+        with throttle.verification():
+            valid = current_user.verify_password(form.password.data)
+        if valid:
             new_email = form.email.data.lower()
             token = current_user.generate_email_change_token(new_email)
             send_email(new_email, 'Confirm your email address',
@@ -173,6 +224,8 @@ def change_email_request():
 #----- [08e] Function to change email address -----
 @auth.route('/change_email/<token>')
 @login_required
+@query_budget(4)
+@read_write  # writes on GET
 def change_email(token):
     if current_user.change_email(token):
         db.session.commit()
@@ -0,0 +1,171 @@
+import hashlib
+import math
+import threading
+import time
+from flask import current_app
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, exists, select, func
+
+
+# ----- Bloom filter -----
+# No false negatives: a value that was add()ed is always 'in' the filter.
+# A value that is 'in' may still be absent (about error_rate of the time).
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+
+# ----- Username/email availability -----
+# One filter per field with every canonical (stripped, lower case) email and
+# username in table 'users'. A value missing from the filter is definitely free
+# and costs no query; 'maybe taken' is answered by an EXISTS on the unique index
+# of the canonical column.
+#
+# The filters are built on first use (or by warm_up() in the prefork master,
+# never for the CLI commands) and fed by an after_flush listener. Names are added at flush time, before the commit: an
+# insert that is rolled back only leaves a false positive, which the EXISTS
+# query corrects. Rows written by other processes or by Core (the importer) are
+# picked up every PURPLE_AVAILABILITY_SYNC_INTERVAL seconds by reading the ids
+# above the last one seen; renames done elsewhere by a full rebuild every
+# PURPLE_AVAILABILITY_REBUILD_INTERVAL seconds. The unique indexes stay the
+# final word, registration handles the IntegrityError of a lost race.
+class _Filters:
+    def __init__(self, count, error_rate):
+        capacity = max(2 * count, 1024)  # room to grow before the next rebuild
+        self.email = BloomFilter(capacity, error_rate)
+        self.username = BloomFilter(capacity, error_rate)
+        self.last_id = 0
+        self.built_at = self.synced_at = time.monotonic()
+
+    def add(self, email, username):  # canonical values
+        if email:
+            self.email.add(email)
+        if username:
+            self.username.add(username)
+
+    def full(self):
+        return self.email.count > self.email.capacity
+
+
+class AvailabilityIndex:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_AVAILABILITY_ERROR_RATE', 0.01)
+        app.config.setdefault('PURPLE_AVAILABILITY_SYNC_INTERVAL', 5)
+        app.config.setdefault('PURPLE_AVAILABILITY_REBUILD_INTERVAL', 3600)
+        app.extensions['availability'] = {
+            'filters': None, 'lock': threading.Lock(),
+            'checks': 0, 'definitely_free': 0, 'maybe_taken': 0, 'false_positives': 0}
+
+    def _state(self):
+        return current_app.extensions['availability']
+
+    def rebuild(self):
+        from . import db
+        from .models import User
+        users = User.__table__
+        state = self._state()
+        with state['lock']:
+            count = db.session.execute(select(func.count()).select_from(users)).scalar()
+            filters = _Filters(count, current_app.config['PURPLE_AVAILABILITY_ERROR_RATE'])
+            self._load(filters, select(users.c.id, users.c.email_canonical, users.c.username_canonical))
+            state['filters'] = filters
+        return filters
+
+    def _load(self, filters, stmt):
+        from . import db
+        for user_id, email, username in db.session.execute(stmt):
+            filters.add(email, username)
+            filters.last_id = max(filters.last_id, user_id)
+
+    def _filters(self):
+        from .models import User
+        config = current_app.config
+        state = self._state()
+        filters = state['filters']
+        now = time.monotonic()
+        if filters is None or filters.full() or \
+                now - filters.built_at > config['PURPLE_AVAILABILITY_REBUILD_INTERVAL']:
+            return self.rebuild()
+        if now - filters.synced_at > config['PURPLE_AVAILABILITY_SYNC_INTERVAL']:
+            users = User.__table__
+            with state['lock']:
+                self._load(filters, select(users.c.id, users.c.email_canonical, users.c.username_canonical)
+                           .where(users.c.id > filters.last_id))
+                filters.synced_at = now
+        return filters
+
+    def _taken(self, field, value):
+        from . import db
+        from .models import User, canonical
+        state = self._state()
+        state['checks'] += 1
+        value = canonical(value)
+        if value not in getattr(self._filters(), field):
+            state['definitely_free'] += 1
+            return False
+        state['maybe_taken'] += 1
+        column = User.__table__.c[field + '_canonical']
+        taken = db.session.execute(select(exists().where(column == value))).scalar()
+        if not taken:
+            state['false_positives'] += 1
+        return taken
+
+    def email_taken(self, email):
+        return self._taken('email', email)
+
+    def username_taken(self, username):
+        return self._taken('username', username)
+
+    def stats(self):
+        state = self._state()
+        filters = state['filters']
+        stats = {name: state[name] for name in ('checks', 'definitely_free', 'maybe_taken', 'false_positives')}
+        if filters is not None:
+            stats.update(entries=filters.email.count, capacity=filters.email.capacity,
+                         bytes=len(filters.email.bits) + len(filters.username.bits),
+                         hashes=filters.email.hashes)
+        return stats
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _add_new_names(session, flush_context):
+    from .models import User
+    app = getattr(session, 'app', None)
+    state = app.extensions.get('availability') if app is not None else None
+    filters = state and state['filters']
+    if filters is None:
+        return
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, User):
+            filters.add(obj.email_canonical, obj.username_canonical)  # last_id stays, lower ids may come from elsewhere
+
+
+@event.listens_for(SignallingSession, 'after_bulk_update')
+def _rebuild_after_bulk_update(update_context):
+    # New values of a Query.update() are unknown here, build again on next use
+    app = getattr(update_context.session, 'app', None)
+    if app is not None and app.extensions.get('availability'):
+        app.extensions['availability']['filters'] = None
@@ -0,0 +1,263 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from markupsafe import Markup
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+
+# ----- Thread-safe LRU cache with optional TTL and memory budget -----
+# get() returns None both for a miss and for an expired entry.
+# With max_bytes set, set() takes the size of the value and the least recently
+# used entries are evicted until the total fits into the budget.
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None, max_bytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._data = OrderedDict()  # key -> (expires_at, value, size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] is not None and item[0] < time.monotonic():
+                self._remove(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, size=0):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (expires_at, value, size)
+            self.bytes += size
+            while len(self._data) > self.maxsize or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes and self._data):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.bytes -= item[2]
+        return item
+
+    def pop(self, key):
+        with self._lock:
+            item = self._remove(key)
+        return None if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(size=len(self._data), bytes=self.bytes, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions,
+                    hit_ratio=self.hits / lookups if lookups else 0.0)
+
+
+# ----- Detached copies of ORM rows -----
+# The copy has the column attributes loaded (all but 'exclude') and an identity
+# key, so it can be attached to any session with session.merge(copy, load=False)
+# without a SELECT. An excluded column is loaded from the database when it is
+# first read.
+def _snapshot(obj, exclude=()):
+    mapper = inspect(obj).mapper
+    copy = mapper.class_manager.new_instance()
+    for attr in mapper.column_attrs:
+        if attr.key not in exclude:
+            set_committed_value(copy, attr.key, getattr(obj, attr.key))
+    make_transient_to_detached(copy)
+    return copy
+
+
+def _user_snapshot(user):
+    # No password hash: another worker may have changed the password, checks
+    # always read the current one (one SELECT, only where a password is checked)
+    copy = _snapshot(user, exclude=('password_hash',))
+    set_committed_value(copy, 'role', _snapshot(user.role) if user.role is not None else None)
+    return copy
+
+
+# ----- Identity cache for load_user and username/email lookups -----
+# Snapshots are never handed out: every lookup merges a copy into db.session,
+# so callers get an ordinary persistent User (with 'role' loaded) they may modify.
+# Entries are dropped when a flush touches the user and again on commit/rollback.
+# The cache is per process: other workers only see a change after
+# PURPLE_USER_CACHE_TTL seconds. That is fine for profiles and load_user, not
+# for credentials: password_hash is not cached, and the auth views look users
+# up in the database for login and password reset.
+class UserCache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_USER_CACHE_ENABLED', True)
+        app.config.setdefault('PURPLE_USER_CACHE_SIZE', 10000)
+        app.config.setdefault('PURPLE_USER_CACHE_TTL', 60)
+        app.extensions['user_cache'] = LRUCache(app.config['PURPLE_USER_CACHE_SIZE'],
+                                                app.config['PURPLE_USER_CACHE_TTL'])
+
+    def get(self, user_id):
+        from .models import User
+        return self._lookup('id', user_id, lambda: User.query.get(user_id))
+
+    # Both match case-insensitively through the canonical columns
+    def get_by_username(self, username):
+        from .models import User, canonical
+        username = canonical(username)
+        return self._lookup('username', username,
+                            lambda: User.query.filter_by(username_canonical=username).first())
+
+    def get_by_email(self, email):
+        from .models import User, canonical
+        email = canonical(email)
+        return self._lookup('email', email,
+                            lambda: User.query.filter_by(email_canonical=email).first())
+
+    def stats(self):
+        return current_app.extensions['user_cache'].stats()
+
+    def clear(self):
+        current_app.extensions['user_cache'].clear()
+
+    def _lookup(self, key, value, loader):
+        from . import db
+        if not current_app.config['PURPLE_USER_CACHE_ENABLED']:
+            return loader()
+        cache = current_app.extensions['user_cache']
+        snapshot = cache.get((key, value))
+        if snapshot is not None:
+            # The instance this session already has wins: merge() would copy the
+            # snapshot over it, unflushed changes included, without any history
+            present = db.session.identity_map.get(identity_key(type(snapshot), snapshot.id))
+            if present is not None:
+                return present
+            return db.session.merge(snapshot, load=False)
+        user = loader()
+        if user is not None:  # misses are not cached, new users must be visible at once
+            snapshot = _user_snapshot(user)
+            cache.set(('id', user.id), snapshot)
+            cache.set(('username', user.username_canonical), snapshot)
+            cache.set(('email', user.email_canonical), snapshot)
+        return user
+
+
+# ----- Cache of rendered template blocks, per user and render variant -----
+# Keeps the output of one block (e.g. 'page_content' of user.html) keyed by
+# (template, block, user id, variant). Every entry also stores a fingerprint of
+# the data it was rendered from plus the template version and is re-rendered on
+# mismatch, which covers changes that bypass the ORM (the 'last_seen' buffer).
+# Entries of a user are dropped by the same flush/commit events as UserCache.
+# The full page is still rendered, but with the block passed in as Markup.
+class FragmentCache:
+    blocks = set()  # (template, block, variant) rendered so far, used for invalidation
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_FRAGMENT_CACHE_ENABLED', True)
+        app.config.setdefault('PURPLE_FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024)
+        app.extensions['fragment_cache'] = LRUCache(
+            maxsize=sys.maxsize, max_bytes=app.config['PURPLE_FRAGMENT_CACHE_BYTES'])
+
+    def render_block(self, template_name, block, user_id, variant, fingerprint, **context):
+        from .http_cache import template_version
+        app = current_app._get_current_object()
+        fingerprint = (template_version(), fingerprint)
+        cache = app.extensions['fragment_cache']
+        key = (template_name, block, user_id, variant)
+        if app.config['PURPLE_FRAGMENT_CACHE_ENABLED']:
+            entry = cache.get(key)
+            if entry is not None and entry[0] == fingerprint:
+                return entry[1]
+        template = app.jinja_env.get_template(template_name)
+        app.update_template_context(context)  # current_user, moment(), Permission ...
+        html = Markup(''.join(template.blocks[block](template.new_context(context))))
+        if app.config['PURPLE_FRAGMENT_CACHE_ENABLED']:
+            FragmentCache.blocks.add((template_name, block, variant))
+            cache.set(key, (fingerprint, html), size=len(html.encode('utf-8')))
+        return html
+
+    def stats(self):
+        return current_app.extensions['fragment_cache'].stats()
+
+
+def _cache_keys(user):
+    keys = {('id', user.id)}
+    state = inspect(user)
+    for name in ('username', 'email'):
+        history = state.attrs[name + '_canonical'].history
+        for values in (history.added, history.deleted, history.unchanged):
+            keys.update((name, value) for value in values or ())
+    return keys
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _collect_user_changes(session, flush_context):
+    from .models import User, Role
+    keys = session.info.setdefault('user_cache_keys', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            keys |= _cache_keys(obj)
+        elif isinstance(obj, Role) and session.is_modified(obj, include_collections=False):
+            session.info['user_cache_clear'] = True
+    _invalidate(session)
+
+
+@event.listens_for(SignallingSession, 'after_bulk_update')
+@event.listens_for(SignallingSession, 'after_bulk_delete')
+def _collect_bulk_changes(update_context):
+    session = update_context.session
+    session.info['user_cache_clear'] = True
+    _invalidate(session)
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+@event.listens_for(SignallingSession, 'after_soft_rollback')
+def _invalidate_on_transaction_end(session, *args):
+    # Evict again: another thread may have re-cached the pre-commit row meanwhile
+    _invalidate(session)
+    session.info.pop('user_cache_keys', None)
+    session.info.pop('user_cache_clear', None)
+
+
+def _invalidate(session):
+    app = getattr(session, 'app', None)
+    if app is None or 'user_cache' not in app.extensions:
+        return
+    cache = app.extensions['user_cache']
+    fragments = app.extensions['fragment_cache']
+    if session.info.get('user_cache_clear'):
+        cache.clear()
+        fragments.clear()
+        return
+    for key in session.info.get('user_cache_keys', ()):
+        cache.pop(key)
+        if key[0] == 'id':
+            for template_name, block, variant in list(FragmentCache.blocks):
+                fragments.pop((template_name, block, key[1], variant))
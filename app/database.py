@@ -0,0 +1,299 @@
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, has_request_context, request, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, _EngineConnector, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import UpdateBase
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----- Engine profile: SQLite pragmas and pool settings per config class -----
+# SQLALCHEMY_ENGINE_PROFILE is a dict of pragmas ({'journal_mode': 'WAL', ...}),
+# executed in the given order on every new DBAPI connection of a SQLite engine
+# (default and bound engines alike; other databases ignore it).
+# SQLALCHEMY_POOL_OPTIONS (pool_size, max_overflow, pool_pre_ping, pool_recycle,
+# pool_timeout) replace Flask-SQLAlchemy's NullPool for SQLite files with a
+# QueuePool, so connections and their page cache / mmap survive between requests.
+# Explicit SQLALCHEMY_ENGINE_OPTIONS still have the last word.
+def _pragma_statements(profile):
+    return ['PRAGMA %s = %s' % (name, value) for name, value in profile.items()]
+
+
+def apply_engine_profile(engine, profile):
+    if engine.dialect.name != 'sqlite' or not profile:
+        return
+    statements = _pragma_statements(profile)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+
+
+# ----- Read replicas -----
+# SQLALCHEMY_REPLICA_URLS (or create_app(..., replica_urls=[...])) become the
+# binds 'replica_0', 'replica_1', ... A RoutingSession sends SELECTs to one
+# replica, picked once per session (round_robin or least_loaded, i.e. fewest
+# checked out connections), when
+#   - the request is GET/HEAD, or the code runs inside db.read_only(),
+#   - and the session has not written yet: a flush or an UPDATE/DELETE/INSERT
+#     pins the rest of the session to the primary,
+#   - and the client did not write in the last PURPLE_READ_YOUR_WRITES seconds
+#     (a timestamp in the Flask session cookie), so a user who just confirmed
+#     or changed email does not read the old row from a lagging replica.
+# Everything else - POSTs, background threads, manage.py - uses the primary.
+class ReplicaSet:
+    def __init__(self, keys, strategy='round_robin'):
+        if strategy not in ('round_robin', 'least_loaded'):
+            raise ValueError('Unknown replica strategy %r' % strategy)
+        self.keys = keys
+        self.strategy = strategy
+        self.in_use = dict.fromkeys(keys, 0)
+        self.sessions = dict.fromkeys(keys, 0)
+        self.pinned = 0
+        self._next = itertools.cycle(keys)
+        self._lock = threading.Lock()
+
+    def choose(self):
+        with self._lock:
+            if self.strategy == 'least_loaded':
+                key = min(self.keys, key=lambda k: (self.in_use[k], self.sessions[k]))
+            else:
+                key = next(self._next)
+            self.sessions[key] += 1
+            return key
+
+    def track(self, key, engine):
+        @event.listens_for(engine, 'checkout')
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            with self._lock:
+                self.in_use[key] += 1
+
+        @event.listens_for(engine, 'checkin')
+        def checkin(dbapi_connection, connection_record):
+            with self._lock:
+                self.in_use[key] -= 1
+
+    def stats(self):
+        with self._lock:
+            stats = {'strategy': self.strategy, 'pinned_to_primary': self.pinned}
+            for key in self.keys:
+                stats[key + '_sessions'] = self.sessions[key]
+                stats[key + '_in_use'] = self.in_use[key]
+            return stats
+
+
+def _remember_write(session):
+    if session.info.get('wrote'):
+        return
+    session.info['wrote'] = True
+    replicas = session.app.extensions.get('replicas')
+    if replicas is None:
+        return
+    with replicas._lock:
+        replicas.pinned += 1
+    if has_request_context():
+        _read_your_writes(session.app)
+
+
+def _read_your_writes(app):
+    window = app.config['PURPLE_READ_YOUR_WRITES']
+    if window:
+        flask_session['_primary_until'] = int(time.time() + window)
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if isinstance(clause, UpdateBase):
+            _check_read_only(self, clause.__visit_name__.upper())
+            _remember_write(self)
+        elif isinstance(clause, Select) and self._reads_from_replica():
+            return self._replica_engine()
+        return super().get_bind(mapper, clause)
+
+    def _reads_from_replica(self):
+        if self.app.extensions.get('replicas') is None or self.info.get('wrote'):
+            return False
+        if self.info.get('read_only'):
+            return True
+        return has_request_context() and request.method in ('GET', 'HEAD') and \
+            flask_session.get('_primary_until', 0) <= time.time()
+
+    def _replica_engine(self):
+        key = self.info.get('replica')
+        if key is None:
+            key = self.info['replica'] = self.app.extensions['replicas'].choose()
+        return get_state(self.app).db.get_engine(self.app, bind=key)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def pin_to_primary(session, flush_context):
+    _remember_write(session)
+
+
+# ----- Read-only requests -----
+# A view marked @read_only (app/decorators.py), or a GET/HEAD/OPTIONS view not
+# marked @read_write, is a read-only request (PURPLE_READ_ONLY_REQUESTS):
+#   - its session is rolled back when the request ends instead of committed by
+#     SQLALCHEMY_COMMIT_ON_TEARDOWN; pysqlite only opens a transaction for a
+#     write, so a page view sends neither BEGIN nor COMMIT,
+#   - a flush with changes, an INSERT/UPDATE/DELETE through the session or
+#     changes still unflushed when the view returns are a bug:
+#     PURPLE_READ_ONLY_WRITES = 'raise' (development, testing) raises
+#     ReadOnlyRequestError, 'log' logs it and the request commits as before.
+# Writes outside the session (the outbox, the last_seen flush) are not affected.
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ReadOnlyRequestError(RuntimeError):
+    pass
+
+
+def request_is_read_only():
+    view = current_app.view_functions.get(request.endpoint)
+    policy = getattr(view, 'transaction', None)  # set by @read_only / @read_write
+    if policy is not None:
+        return policy == 'read'
+    return request.method in READ_METHODS
+
+
+def _check_read_only(session, what):
+    if not session.info.get('read_only_request'):
+        return
+    where = '%s %s' % (request.method, request.path) if has_request_context() else 'a request'
+    message = '%s in the read-only request %s, mark the view @read_write' % (what, where)
+    if session.app.config['PURPLE_READ_ONLY_WRITES'] == 'raise':
+        raise ReadOnlyRequestError(message)
+    logger.warning(message)
+    session.info['read_only_request'] = False  # committed at teardown after all
+
+
+def _has_changes(session):
+    return bool(session.new or session.deleted or any(session.is_modified(obj) for obj in session.dirty))
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def refuse_read_only_flush(session, flush_context, instances):
+    if _has_changes(session):
+        _check_read_only(session, 'Flush of changed objects')
+
+
+class _ProfiledEngineConnector(_EngineConnector):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._profiled = None
+        self._profile_lock = threading.Lock()
+
+    def get_engine(self):
+        with self._profile_lock:
+            # A changed SQLALCHEMY_DATABASE_URI makes a new engine, profile that one too
+            engine = super().get_engine()
+            if engine is not self._profiled:
+                apply_engine_profile(engine, self._app.config.get('SQLALCHEMY_ENGINE_PROFILE') or {})
+                replicas = self._app.extensions.get('replicas')
+                if replicas is not None and self._bind in replicas.keys:
+                    replicas.track(self._bind, engine)
+                for hook in self._app.extensions.get('engine_hooks', ()):  # e.g. app/metrics.py
+                    hook(engine, self._bind)
+                self._profiled = engine
+            return engine
+
+
+class Database(SQLAlchemy):
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICA_URLS', [])
+        app.config.setdefault('PURPLE_REPLICA_STRATEGY', 'round_robin')
+        app.config.setdefault('PURPLE_READ_YOUR_WRITES', 10)
+        urls = app.config['SQLALCHEMY_REPLICA_URLS']
+        if urls:
+            keys = ['replica_%d' % i for i in range(len(urls))]
+            app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {}, **dict(zip(keys, urls)))
+            app.extensions['replicas'] = ReplicaSet(keys, app.config['PURPLE_REPLICA_STRATEGY'])
+        else:
+            app.extensions['replicas'] = None
+        app.config.setdefault('PURPLE_READ_ONLY_REQUESTS', True)
+        app.config.setdefault('PURPLE_READ_ONLY_WRITES', 'log')
+        super().init_app(app)
+        app.before_request(self._begin_request)
+        app.after_request(self._pending_writes)
+        app.teardown_request(self._end_request)
+
+    def _begin_request(self):
+        if current_app.config['PURPLE_READ_ONLY_REQUESTS'] and request_is_read_only():
+            self.session().info['read_only_request'] = True
+
+    # Changes left to the teardown commit (SQLALCHEMY_COMMIT_ON_TEARDOWN) are
+    # flushed after the session cookie is saved, too late for _remember_write()
+    # and for the checks of a flush: both are done here, while the response and
+    # the cookie can still be changed
+    def _pending_writes(self, response):
+        if not self.session.registry.has():
+            return response
+        session = self.session()
+        if _has_changes(session):
+            _check_read_only(session, 'Unflushed changes')
+            if not session.info.get('read_only_request') and current_app.extensions.get('replicas') is not None:
+                _read_your_writes(current_app)
+        return response
+
+    def _end_request(self, exc):
+        # Before the teardown commit of Flask-SQLAlchemy, which then has nothing
+        # to do. In 'log' mode _check_read_only() cleared the flag of a request
+        # that wrote anyway, that one is committed
+        if self.session.registry.has() and self.session().info.pop('read_only_request', False):
+            self.session.rollback()
+
+    def read_only_request(self):
+        return self.session.registry.has() and self.session().info.get('read_only_request', False)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    # Reads inside the block may go to a replica whatever the request method
+    @contextmanager
+    def read_only(self):
+        session = self.session()
+        previous = session.info.get('read_only')
+        session.info['read_only'] = True
+        try:
+            yield session
+        finally:
+            session.info['read_only'] = previous
+
+    # Engine for Core reads outside the session (exports): a replica when there is one
+    def read_engine(self, app=None):
+        app = self.get_app(app)
+        replicas = app.extensions.get('replicas')
+        if replicas is None:
+            return self.get_engine(app)
+        return self.get_engine(app, bind=replicas.choose())
+
+    # Every engine of the app, replicas included (app/prefork.py). close=False
+    # only drops the pool, for a forked child whose connections are the parent's
+    def dispose_engines(self, app=None, close=True):
+        for connector in list(get_state(self.get_app(app)).connectors.values()):
+            connector.get_engine().dispose(close=close)
+
+    def make_connector(self, app=None, bind=None):
+        return _ProfiledEngineConnector(self, self.get_app(app), bind)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        pool_options = app.config.get('SQLALCHEMY_POOL_OPTIONS')
+        in_memory = sa_url.database in (None, '', ':memory:')
+        if sa_url.drivername.startswith('sqlite') and pool_options and not in_memory:
+            options.update(pool_options)
+            options['poolclass'] = QueuePool
+            # pooled connections move between request threads
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        return super().apply_driver_hacks(app, sa_url, options)
@@ -20,3 +20,15 @@ def permission_required(permission):
 
 def admin_required(f):
     return permission_required(Permission.ADMINISTER)(f)
+
+
+# ----- Transaction policy of a view: see 'Read-only requests' in app/database.py -----
+# Without one GET/HEAD/OPTIONS views are read-only, all others read-write
+def read_only(f):
+    f.transaction = 'read'  # copied by functools.wraps of outer decorators
+    return f
+
+
+def read_write(f):
+    f.transaction = 'write'
+    return f
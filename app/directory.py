@@ -0,0 +1,169 @@
+import base64
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import DateTime, func, literal, select, tuple_
+
+
+logger = logging.getLogger(__name__)
+
+SORTS = ('joined', 'username')
+
+
+# ----- Admin user directory: keyset pages -----
+# A page is 'the next per_page users after the last one shown', never
+# OFFSET n: the cursor holds the sort key of the last row and the next query
+# seeks to it on one of the composite indexes of 'users' (see User in
+# app/models.py), so page 20000 costs what page 1 costs.
+#
+#   joined   - newest first, by (member_since, id)
+#   username - A-Z, by username_canonical (unique)
+#
+# Users without a sort key (member_since is NULL for accounts older than the
+# profile migration, username for some imports) come after all the others,
+# by id. Every order is a list of such segments; a page that reaches the end
+# of one segment goes on with the next one, and the cursor says in which
+# segment it stopped.
+def _segments(sort):
+    from .models import User
+    if sort == 'joined':
+        return [(User.member_since.isnot(None), (User.member_since, User.id), True, (datetime.fromisoformat, int)),
+                (User.member_since.is_(None), (User.id,), True, (int,))]
+    return [(User.username_canonical.isnot(None), (User.username_canonical,), False, (str,)),
+            (User.username_canonical.is_(None), (User.id,), False, (int,))]
+
+
+def encode_cursor(segment, key):
+    text = json.dumps([segment] + [v.isoformat() if isinstance(v, datetime) else v for v in key])
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    # ValueError for anything that is not a cursor of this order
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        segment, key = values[0], values[1:]
+        parsers = _segments(sort)[segment][3]
+        if segment < 0 or len(key) != len(parsers):
+            raise IndexError(segment)
+        return segment, tuple(parse(value) for parse, value in zip(parsers, key))
+    except (TypeError, IndexError, KeyError):
+        raise ValueError('invalid cursor %r' % cursor)
+
+
+class UserDirectory:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_DIRECTORY_PER_PAGE', 50)
+        app.config.setdefault('PURPLE_DIRECTORY_COUNTS_INTERVAL', 300)
+        app.extensions['directory'] = {'lock': threading.Lock(), 'refreshing': False,
+                                       'pages': 0, 'queries': 0, 'refreshes': 0, 'refresh_seconds': None}
+
+    # role: a Role (its 'users' relationship is the query) or None for all;
+    # confirmed: True, False or None for both. Returns the users of the page
+    # and the cursor of the next one (None on the last page).
+    def page(self, role=None, confirmed=None, sort='joined', after=None, per_page=None):
+        from .models import User
+        per_page = per_page or current_app.config['PURPLE_DIRECTORY_PER_PAGE']
+        query = role.users if role is not None else User.query
+        if confirmed is not None:
+            query = query.filter(User.confirmed == confirmed)
+        segments = _segments(sort)
+        start, key = decode_cursor(after, sort) if after else (0, None)
+        rows, queries = [], 0
+        for number in range(start, len(segments)):
+            condition, columns, descending, _ = segments[number]
+            segment_query = query.filter(condition)
+            if number == start and key is not None:
+                position = tuple_(*columns) if len(columns) > 1 else columns[0]
+                value = tuple_(*[literal(v, c.type) for v, c in zip(key, columns)]) if len(columns) > 1 else key[0]
+                segment_query = segment_query.filter(position < value if descending else position > value)
+            users = segment_query.order_by(*[c.desc() if descending else c for c in columns]) \
+                .limit(per_page + 1 - len(rows)).all()
+            queries += 1
+            rows += [(number, user) for user in users]
+            if len(rows) > per_page:
+                break
+        state = current_app.extensions['directory']
+        state['pages'] += 1
+        state['queries'] += queries
+        next_cursor = None
+        if len(rows) > per_page:
+            number, last = rows[per_page - 1]
+            columns = segments[number][1]
+            next_cursor = encode_cursor(number, [getattr(last, c.key) for c in columns])
+        return {'users': [user for _, user in rows[:per_page]], 'next': next_cursor}
+
+    # ----- Approximate counts from table 'user_counts' -----
+    # COUNT(*) over a filtered 'users' reads every matching index entry, on
+    # each page. The counts per (role_id, confirmed) are written by
+    # refresh_counts() instead, by 'manage.py user-counts' or in a background
+    # thread once the newest row is PURPLE_DIRECTORY_COUNTS_INTERVAL seconds
+    # old (0 - never in the background). Returns (users, refreshed_at), or
+    # (None, None) when nothing was counted yet.
+    def count(self, role_id=None, confirmed=None):
+        from . import db
+        from .models import UserCount
+        counts = UserCount.__table__
+        rows = db.session.execute(select(counts.c.role_id, counts.c.confirmed, counts.c.users,
+                                         counts.c.refreshed_at)).fetchall()
+        refreshed_at = max((row.refreshed_at for row in rows), default=None)
+        interval = current_app.config['PURPLE_DIRECTORY_COUNTS_INTERVAL']
+        if interval > 0 and (refreshed_at is None or
+                             (datetime.utcnow() - refreshed_at).total_seconds() > interval):
+            self._refresh_in_background(current_app._get_current_object())
+        if refreshed_at is None:
+            return None, None
+        total = sum(row.users for row in rows
+                    if (role_id is None or row.role_id == role_id) and
+                    (confirmed is None or row.confirmed == confirmed))
+        return total, refreshed_at
+
+    def refresh_counts(self, app=None):
+        from . import db
+        from .models import User, UserCount
+        app = app or current_app._get_current_object()
+        users, counts = User.__table__, UserCount.__table__
+        start = time.perf_counter()
+        stmt = counts.insert().from_select(
+            ['role_id', 'confirmed', 'users', 'refreshed_at'],
+            select(users.c.role_id, users.c.confirmed, func.count(), literal(datetime.utcnow(), DateTime))
+            .group_by(users.c.role_id, users.c.confirmed))
+        with db.get_engine(app).begin() as conn:  # readers see the old rows or the new ones
+            conn.execute(counts.delete())
+            conn.execute(stmt)
+        seconds = time.perf_counter() - start
+        state = app.extensions['directory']
+        state['refreshes'] += 1
+        state['refresh_seconds'] = seconds
+        return seconds
+
+    def _refresh_in_background(self, app):
+        state = app.extensions['directory']
+        with state['lock']:
+            if state['refreshing']:
+                return
+            state['refreshing'] = True
+
+        def run():
+            try:
+                self.refresh_counts(app)
+            except Exception:
+                logger.exception('Failed to refresh user_counts')
+            finally:
+                state['refreshing'] = False
+
+        threading.Thread(target=run, name='user-counts', daemon=True).start()
+
+    def stats(self):
+        state = current_app.extensions['directory']
+        stats = {name: state[name] for name in ('pages', 'queries', 'refreshes')}
+        if state['refresh_seconds'] is not None:
+            stats['refresh_seconds'] = state['refresh_seconds']
+        return stats
@@ -1,20 +1,274 @@
-from flask_mail import Message
-from threading import Thread
-from flask import current_app, render_template
-from . import mail # from ./__init__.py
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context, render_template
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import bindparam, event, func, or_, select
+from . import db, metrics # from ./__init__.py
+from .models import OutboxMessage
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+logger = logging.getLogger(__name__)
 
 
+# ----- Outbox: messages are stored in table 'outbox' and sent by a worker pool -----
+# send_email() only renders the message and adds a row to db.session, so it is
+# committed together with the request. After the commit the workers are woken up;
+# each worker claims up to PURPLE_MAIL_OUTBOX_BATCH rows and sends them over one
+# SMTP connection (Flask-Mail's connect()). Failed messages are retried with exponential
+# backoff until PURPLE_MAIL_OUTBOX_MAX_ATTEMPTS is reached.
+# Rows left in 'sending' by a crashed process are claimed again after
+# PURPLE_MAIL_OUTBOX_LEASE seconds, so nothing is lost on restart.
+#
+# With PURPLE_MAIL_OUTBOX_SYNC = True (tests) the message is sent at once
+# in the calling thread.
 def send_email(to, subject, template, **kwargs):
     app = current_app._get_current_object()
-    msg = Message(app.config['PURPLE_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
-                  sender=app.config['PURPLE_MAIL_SENDER'], recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
-    msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    message = OutboxMessage(
+        recipient=to,
+        sender=app.config['PURPLE_MAIL_SENDER'],
+        subject=app.config['PURPLE_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
+        body=render_template(template + '.txt', **kwargs),
+        html=render_template(template + '.html', **kwargs))
+    db.session.add(message)
+    metrics.inc('emails_queued', template=template)
+    if app.config['PURPLE_MAIL_OUTBOX_SYNC']:
+        db.session.flush()
+        app.extensions['outbox'].send_now(message)
+    else:
+        db.session.info['outbox_wakeup'] = True
+    return message
+
+
+def _mail():
+    # Flask-Mail is imported and set up for the app by the first delivery, not
+    # by create_app(): see 'Extensions imported on first use' in app/__init__.py
+    from . import mail
+    app = current_app._get_current_object()
+    if 'mail' not in app.extensions:
+        mail.init_app(app)
+    return mail
+
+
+def _build_message(row):
+    from flask_mail import Message
+    msg = Message(row['subject'], sender=row['sender'], recipients=[row['recipient']])
+    msg.body = row['body']
+    msg.html = row['html']
+    return msg
+
+
+def _as_row(message):
+    return {c.name: getattr(message, c.name) for c in OutboxMessage.__table__.columns}
+
+
+class OutboxPool:
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config['PURPLE_MAIL_OUTBOX_WORKERS']
+        self.batch_size = app.config['PURPLE_MAIL_OUTBOX_BATCH']
+        self.max_attempts = app.config['PURPLE_MAIL_OUTBOX_MAX_ATTEMPTS']
+        self.backoff = app.config['PURPLE_MAIL_OUTBOX_BACKOFF']
+        self.poll = app.config['PURPLE_MAIL_OUTBOX_POLL']
+        self.lease = timedelta(seconds=app.config['PURPLE_MAIL_OUTBOX_LEASE'])
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.latencies = deque(maxlen=1000)  # seconds per sent message
+        self.counters = dict(sent=0, retried=0, failed=0, batches=0)
+
+    # ----- Worker threads -----
+    def start(self):
+        with self._lock:
+            if self._threads or self._stopping.is_set():
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name='outbox-%d' % i, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def wake(self):
+        self.start()
+        self._wakeup.set()
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.poll)
+            self._wakeup.clear()
+            try:
+                while not self._stopping.is_set() and self.drain_once() == self.batch_size:
+                    pass  # a full batch means more rows may be waiting
+            except Exception:
+                logger.exception('Outbox worker failed')
+
+    # ----- Claim a batch, send it over one connection, record the results -----
+    def drain_once(self):
+        rows = self._claim()
+        if rows:
+            self._record(self._deliver(rows))
+        return len(rows)
+
+    def drain(self):
+        total = 0
+        while True:
+            count = self.drain_once()
+            total += count
+            if count < self.batch_size:
+                return total
+
+    def send_now(self, message):
+        results = self._deliver([_as_row(message)])
+        sent, error = results[0][1], results[0][2]
+        message.attempts = (message.attempts or 0) + 1
+        if sent:
+            message.status = 'sent'
+            message.sent_at = datetime.utcnow()
+            with self._lock:
+                self.counters['sent'] += 1
+        else:
+            self._schedule_retry(message.attempts, error, apply=message)
+
+    def _claim(self):
+        table = OutboxMessage.__table__
+        token = uuid.uuid4().hex
+        now = datetime.utcnow()
+        candidates = select(table.c.id) \
+            .where(table.c.next_attempt_at <= now) \
+            .where(or_(table.c.status == 'pending',
+                       (table.c.status == 'sending') & (table.c.claimed_at < now - self.lease))) \
+            .order_by(table.c.id).limit(self.batch_size)
+        with self._engine().begin() as conn:
+            # One UPDATE ... WHERE id IN (SELECT ...) so two workers never claim the same row
+            conn.execute(table.update()
+                         .where(table.c.id.in_(candidates.scalar_subquery()))
+                         .values(status='sending', claimed_at=now, claim_token=token))
+            rows = conn.execute(select(table).where(table.c.claim_token == token)
+                                .order_by(table.c.id)).mappings().all()
+        return [dict(row) for row in rows]
+
+    def _deliver(self, rows):
+        if not has_app_context():  # worker thread
+            with self.app.app_context():
+                return self._deliver(rows)
+        results = []
+        try:
+            with _mail().connect() as connection:
+                for row in rows:
+                    start = time.perf_counter()
+                    try:
+                        connection.send(_build_message(row))
+                    except Exception as e:
+                        results.append((row, False, str(e)))
+                    else:
+                        self.latencies.append(time.perf_counter() - start)
+                        results.append((row, True, None))
+        except Exception as e:
+            # Could not connect: everything not tried yet goes back for a retry
+            results += [(row, False, 'connection: %s' % e) for row in rows[len(results):]]
+        return results
+
+    def _schedule_retry(self, attempts, error, apply=None):
+        if attempts >= self.max_attempts:
+            values = dict(status='failed', last_error=error)
+            counter = 'failed'
+        else:
+            delay = self.backoff * 2 ** (attempts - 1)
+            values = dict(status='pending', last_error=error,
+                          next_attempt_at=datetime.utcnow() + timedelta(seconds=delay))
+            counter = 'retried'
+        with self._lock:
+            self.counters[counter] += 1
+        if apply is not None:
+            for key, value in values.items():
+                setattr(apply, key, value)
+        return values
+
+    def _record(self, results):
+        table = OutboxMessage.__table__
+        now = datetime.utcnow()
+        sent = [{'row_id': row['id'], 'attempts': row['attempts'] + 1}
+                for row, ok, error in results if ok]
+        with self._engine().begin() as conn:
+            if sent:
+                conn.execute(table.update().where(table.c.id == bindparam('row_id'))
+                             .values(status='sent', sent_at=now, claim_token=None,
+                                     attempts=bindparam('attempts')), sent)
+            for row, ok, error in results:
+                if not ok:
+                    attempts = row['attempts'] + 1
+                    values = self._schedule_retry(attempts, error)
+                    conn.execute(table.update().where(table.c.id == row['id'])
+                                 .values(attempts=attempts, claim_token=None, **values))
+        with self._lock:
+            self.counters['sent'] += len(sent)
+            self.counters['batches'] += 1
+
+    def _engine(self):
+        return db.get_engine(self.app)
+
+    # ----- Queue depth and send latency -----
+    def stats(self):
+        table = OutboxMessage.__table__
+        with self._engine().connect() as conn:
+            depth = conn.execute(select(func.count()).select_from(table)
+                                 .where(table.c.status.in_(('pending', 'sending')))).scalar()
+        latencies = sorted(self.latencies)
+        with self._lock:
+            stats = dict(self.counters)
+        stats['queue_depth'] = depth
+        stats['workers'] = len(self._threads)
+        stats['latency_avg'] = sum(latencies) / len(latencies) if latencies else 0.0
+        stats['latency_p95'] = latencies[int(len(latencies) * 0.95)] if latencies else 0.0
+        return stats
+
+
+class Outbox:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_MAIL_OUTBOX_SYNC', False)
+        app.config.setdefault('PURPLE_MAIL_OUTBOX_WORKERS', 2)
+        app.config.setdefault('PURPLE_MAIL_OUTBOX_BATCH', 50)
+        app.config.setdefault('PURPLE_MAIL_OUTBOX_MAX_ATTEMPTS', 5)
+        app.config.setdefault('PURPLE_MAIL_OUTBOX_BACKOFF', 30)
+        app.config.setdefault('PURPLE_MAIL_OUTBOX_POLL', 10)
+        app.config.setdefault('PURPLE_MAIL_OUTBOX_LEASE', 300)
+        pool = OutboxPool(app)
+        app.extensions['outbox'] = pool
+        if not app.config['PURPLE_MAIL_OUTBOX_SYNC']:
+            # Pick up rows left over from a previous run as soon as traffic starts
+            app.before_first_request(pool.start)
+            atexit.register(pool.stop)
+
+    def drain(self):
+        return current_app.extensions['outbox'].drain()
+
+    def stats(self):
+        return current_app.extensions['outbox'].stats()
+
+
+outbox = Outbox()
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def wake_outbox(session):
+    if session.info.pop('outbox_wakeup', False):
+        session.app.extensions['outbox'].wake()
+
+
+@event.listens_for(SignallingSession, 'after_soft_rollback')
+def forget_outbox_wakeup(session, previous_transaction):
+    session.info.pop('outbox_wakeup', None)
@@ -0,0 +1,82 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from sqlalchemy import select
+from . import db
+from .models import User
+
+
+# ----- Streaming export of table 'users' -----
+# Rows are read with a server-side cursor (stream_results) through a Core select
+# of plain columns: no ORM objects, no identity map, memory stays constant.
+# A read replica is used when one is configured.
+# encode() turns them into NDJSON or CSV byte chunks, optionally as one gzip
+# stream; 'manage.py export-users' writes the chunks to a file and
+# /admin/users/export sends them as a chunked response.
+EXPORT_COLUMNS = ('id', 'email', 'username', 'role_id', 'confirmed', 'name', 'location',
+                  'about_me', 'member_since', 'last_seen')  # never 'password_hash'
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def iter_rows(since=None, batch_size=1000):
+    users = User.__table__
+    stmt = select(*[users.c[name] for name in EXPORT_COLUMNS]).order_by(users.c.id)
+    if since is not None:
+        stmt = stmt.where(users.c.last_seen >= since)
+    with db.read_engine().connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(stmt)
+        for rows in result.partitions(batch_size):
+            yield from rows
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _text_chunks(rows, fmt, batch_size):
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        write = lambda row: writer.writerow([_value(v) for v in row])
+    else:
+        write = lambda row: buffer.write(
+            json.dumps({k: _value(v) for k, v in zip(EXPORT_COLUMNS, row)}) + '\n')
+    count = 0
+    for row in rows:
+        write(row)
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def encode(rows, fmt='ndjson', compress=False, batch_size=1000):
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format %r' % fmt)
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 - gzip container
+    for text in _text_chunks(rows, fmt, batch_size):
+        data = text.encode('utf-8')
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def export_filename(fmt, compress):
+    return 'users.' + fmt + ('.gz' if compress else '')
+
+
+def export_users(out, fmt='ndjson', compress=False, since=None):
+    written = 0
+    for chunk in encode(iter_rows(since), fmt, compress):
+        out.write(chunk)
+        written += len(chunk)
+    return written
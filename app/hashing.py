@@ -0,0 +1,107 @@
+import logging
+import os
+import threading
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----- Password hashing service -----
+# PBKDF2 is CPU bound: with PURPLE_HASH_POOL_WORKERS > 0 hashing and verification
+# run in a ProcessPoolExecutor, so a login spike uses the pool's cores instead of
+# the request threads of the web worker. With 0 everything runs inline.
+#
+# The stored hash carries its parameters ('pbkdf2:sha256:260000$salt$hash'), so
+# PURPLE_PASSWORD_METHOD can be raised over time: needs_rehash() tells the model
+# to store a new hash after the next successful login.
+class HashPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        # A pool created before os.fork() is useless in the child, make a new one
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                from concurrent.futures import ProcessPoolExecutor  # only with PURPLE_HASH_POOL_WORKERS > 0
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def run(self, timeout, fn, *args, **kwargs):
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            return self.executor().submit(fn, *args, **kwargs).result(timeout)
+        except BrokenProcessPool:
+            logger.exception('Hashing pool is broken, running inline')
+            with self._lock:
+                self._executor = None
+            return fn(*args, **kwargs)
+
+    def map(self, fn, *iterables, chunksize=1):
+        return list(self.executor().map(fn, *iterables, chunksize=chunksize))
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def hash_password(password, method, salt_length):
+    return generate_password_hash(password, method=method, salt_length=salt_length)
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_PASSWORD_METHOD', 'pbkdf2:sha256:260000')
+        app.config.setdefault('PURPLE_PASSWORD_SALT_LENGTH', 8)
+        app.config.setdefault('PURPLE_HASH_POOL_WORKERS', 0)
+        app.config.setdefault('PURPLE_HASH_TIMEOUT', 10)
+        workers = app.config['PURPLE_HASH_POOL_WORKERS']
+        app.extensions['password_hasher'] = HashPool(workers) if workers else None
+
+    def _call(self, fn, *args):
+        pool = current_app.extensions['password_hasher']
+        if pool is None:
+            return fn(*args)
+        return pool.run(current_app.config['PURPLE_HASH_TIMEOUT'], fn, *args)
+
+    def hash(self, password):
+        config = current_app.config
+        return self._call(hash_password, password, config['PURPLE_PASSWORD_METHOD'],
+                          config['PURPLE_PASSWORD_SALT_LENGTH'])
+
+    def verify(self, pwhash, password):
+        return self._call(check_password_hash, pwhash, password)
+
+    # Hashes many passwords at once (bulk imports), in parallel when the pool is on.
+    # 'pool' may be a HashPool made for the job instead of the app's one
+    def hash_many(self, passwords, chunksize=16, pool=None):
+        config = current_app.config
+        method, salt_length = config['PURPLE_PASSWORD_METHOD'], config['PURPLE_PASSWORD_SALT_LENGTH']
+        pool = pool or current_app.extensions['password_hasher']
+        if pool is None:
+            return [hash_password(p, method, salt_length) for p in passwords]
+        return pool.map(hash_password, passwords, [method] * len(passwords),
+                        [salt_length] * len(passwords), chunksize=chunksize)
+
+    def needs_rehash(self, pwhash):
+        config = current_app.config
+        method, _, rest = pwhash.partition('$')
+        salt = rest.partition('$')[0]
+        return method != config['PURPLE_PASSWORD_METHOD'] or \
+            len(salt) < config['PURPLE_PASSWORD_SALT_LENGTH']
+
+    def shutdown(self):
+        pool = current_app.extensions['password_hasher']
+        if pool is not None:
+            pool.shutdown()
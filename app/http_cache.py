@@ -0,0 +1,61 @@
+import hashlib
+import os
+from datetime import datetime
+from flask import current_app, make_response, request, session
+from werkzeug.http import is_resource_modified
+
+
+# ----- Conditional GET (ETag / Last-Modified / 304) -----
+# Views pass a validator computed from cheap data (row values, viewer) and a
+# render() callback; the template is only rendered when the client's copy is stale.
+# Pages depend on the viewer (navbar, admin-only fields), so responses are
+# 'private, no-cache' with 'Vary: Cookie' and the viewer is part of every ETag.
+# Pass last_modified only for a page that nothing but that time changes: a
+# client sending only If-Modified-Since gets a 304 by it, whoever logged in.
+
+
+# Changes whenever a template file changes, so a deploy invalidates all ETags
+def template_version():
+    app = current_app._get_current_object()
+    version = app.extensions.get('template_version')
+    if version is None:
+        digest = hashlib.sha1()
+        root = os.path.join(app.root_path, app.template_folder)
+        for folder, _, files in sorted(os.walk(root)):
+            for name in sorted(files):
+                path = os.path.join(folder, name)
+                digest.update(('%s:%d' % (path, os.stat(path).st_mtime_ns)).encode())
+        version = app.extensions['template_version'] = digest.hexdigest()[:12]
+    return version
+
+
+def viewer_key():
+    from flask_login import current_user
+    if not current_user.is_authenticated:
+        return 'anonymous'
+    return '%s:%s:%d' % (current_user.id, current_user.username, current_user.is_administrator())
+
+
+def make_etag(*parts):
+    data = '\x1f'.join(str(part) for part in (template_version(), viewer_key()) + parts)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def current_minute():
+    return datetime.utcnow().replace(second=0, microsecond=0)
+
+
+def conditional_response(etag, render, last_modified=None):
+    # Pending flash messages are shown by the next render, never answer 304 then
+    validate = request.method in ('GET', 'HEAD') and not session.get('_flashes')
+    if validate and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
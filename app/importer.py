@@ -0,0 +1,201 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from . import db, password_hasher
+from .hashing import HashPool
+from .models import User, Role, canonical
+
+
+# ----- Bulk import of users from CSV or JSON lines -----
+# Input fields: email, username, password or password_hash (already hashed),
+# and optionally name, location, about_me, role (role name) and confirmed.
+#
+# The input is read as a stream and handled in chunks of 'chunk_size' records:
+#   1. records with missing fields, unknown roles or duplicate email/username
+#      (inside the file or already in the DB, compared in canonical form) go to
+#      the reject file
+#   2. passwords are hashed in 'workers' processes
+#   3. the chunk is written with one executemany INSERT in its own transaction
+#   4. the number of processed records is saved in the checkpoint file
+# A restarted import skips the records counted in the checkpoint file. A crash
+# between the commit of a chunk and its checkpoint leaves the next run with
+# rows that are already in the table: in the first chunk after the checkpoint,
+# a record whose email and username belong to one existing user is counted
+# as skipped instead of rejected as a duplicate.
+OPTIONAL_FIELDS = ('name', 'location', 'about_me')
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'on')
+
+
+def read_records(path, fmt=None):
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.ndjson', '.json')) else 'csv')
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _read_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    return 0
+
+
+def _write_checkpoint(path, done):
+    if path:
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(done))
+        os.replace(path + '.tmp', path)  # atomic, a crash never leaves half a number
+
+
+class UserImporter:
+    def __init__(self, chunk_size=1000, workers=None, reject_path=None,
+                 checkpoint_path=None, log=None):
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.reject_path = reject_path
+        self.checkpoint_path = checkpoint_path
+        self.log = log or (lambda message: None)
+        self.users = User.__table__
+        self.inserted = 0
+        self.rejected = 0
+        self.skipped = 0
+
+    def _resolve_roles(self):
+        # Once per import instead of once per User() object
+        roles = {role.name: role for role in Role.query.all()}
+        self.role_ids = {name: role.id for name, role in roles.items()}
+        self.default_role_id = next((r.id for r in roles.values() if r.default), None)
+        self.admin_role_id = next((r.id for r in roles.values() if r.permissions == 0xff), None)
+        self.admin_email = canonical(current_app.config['PURPLE_ADMIN'])
+
+    def run(self, records):
+        self._resolve_roles()
+        done = _read_checkpoint(self.checkpoint_path)
+        resumed = bool(self.checkpoint_path) and os.path.exists(self.checkpoint_path)
+        if not resumed:
+            _write_checkpoint(self.checkpoint_path, 0)  # a crash in the first chunk is a resume too
+        pool = HashPool(self.workers) if self.workers else None
+        rejects = open(self.reject_path, 'a', newline='', encoding='utf-8') if self.reject_path else None
+        start = time.perf_counter()
+        try:
+            records = iter(records)
+            self.skipped = sum(1 for _ in islice(records, done))  # imported by an earlier run
+            for chunk in _chunks(records, self.chunk_size):
+                self._import_chunk(chunk, pool, rejects, resumed)
+                resumed = False
+                done += len(chunk)
+                _write_checkpoint(self.checkpoint_path, done)
+                self.log('%d records, %.0f rows/s' % (done, self.inserted / (time.perf_counter() - start)))
+        finally:
+            if rejects is not None:
+                rejects.close()
+            if pool is not None:
+                pool.shutdown()
+        return self._report(start)
+
+    def _report(self, start):
+        elapsed = time.perf_counter() - start
+        return dict(inserted=self.inserted, rejected=self.rejected, skipped=self.skipped,
+                    seconds=elapsed, rows_per_sec=self.inserted / elapsed if elapsed else 0.0)
+
+    def _reject(self, rejects, record, reason):
+        self.rejected += 1
+        if rejects is not None:
+            rejects.write(json.dumps(dict(record, reject_reason=reason)) + '\n')
+
+    def _import_chunk(self, chunk, pool, rejects, resumed=False):
+        rows, passwords = self._validate(chunk, rejects, resumed)
+        if not rows:
+            return
+        to_hash = [i for i, password in enumerate(passwords) if password is not None]
+        hashes = password_hasher.hash_many([passwords[i] for i in to_hash], pool=pool)
+        for i, pwhash in zip(to_hash, hashes):
+            rows[i][0]['password_hash'] = pwhash
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(self.users.insert(), [row for row, record in rows])
+            self.inserted += len(rows)
+        except IntegrityError:
+            # Someone else inserted one of the names meanwhile: fall back to single rows
+            for row, record in rows:
+                try:
+                    with db.engine.begin() as conn:
+                        conn.execute(self.users.insert(), row)
+                    self.inserted += 1
+                except IntegrityError:
+                    self._reject(rejects, record, 'duplicate')
+
+    def _validate(self, chunk, rejects, resumed=False):
+        users = self.users
+        emails = [canonical(r['email']) for r in chunk if r.get('email')]
+        usernames = [canonical(r['username']) for r in chunk if r.get('username')]
+        with db.engine.connect() as conn:
+            existing = dict(conn.execute(  # email -> username of the users already there
+                select(users.c.email_canonical, users.c.username_canonical)
+                .where(users.c.email_canonical.in_(emails))).all())
+            taken_emails = set(existing)
+            taken_usernames = set(conn.execute(
+                select(users.c.username_canonical).where(users.c.username_canonical.in_(usernames))).scalars())
+        rows, passwords = [], []
+        for record in chunk:
+            email, username = record.get('email'), record.get('username')
+            email_canonical, username_canonical = canonical(email), canonical(username)
+            if not email or not username:
+                self._reject(rejects, record, 'missing email or username')
+                continue
+            if not record.get('password') and not record.get('password_hash'):
+                self._reject(rejects, record, 'missing password')
+                continue
+            if resumed and email_canonical in existing and existing[email_canonical] == username_canonical:
+                self.skipped += 1  # inserted by the crashed run, after its last checkpoint
+                continue
+            if email_canonical in taken_emails:
+                self._reject(rejects, record, 'duplicate email')
+                continue
+            if username_canonical in taken_usernames:
+                self._reject(rejects, record, 'duplicate username')
+                continue
+            if record.get('role'):
+                role_id = self.role_ids.get(record['role'])
+                if role_id is None:
+                    self._reject(rejects, record, 'unknown role')
+                    continue
+            elif self.admin_email and email_canonical == self.admin_email:
+                role_id = self.admin_role_id
+            else:
+                role_id = self.default_role_id
+            taken_emails.add(email_canonical)
+            taken_usernames.add(username_canonical)
+            row = dict(email=email, username=username, email_canonical=email_canonical,
+                       username_canonical=username_canonical, role_id=role_id,
+                       password_hash=record.get('password_hash') or None,
+                       confirmed=str(record.get('confirmed', '')).lower() in TRUE_VALUES)
+            for field in OPTIONAL_FIELDS:
+                row[field] = record.get(field) or None
+            rows.append((row, record))
+            passwords.append(None if record.get('password_hash') else record['password'])
+        return rows, passwords
+
+
+def import_users(path, fmt=None, **options):
+    return UserImporter(**options).run(read_records(path, fmt))
@@ -0,0 +1,170 @@
+import atexit
+import logging
+import threading
+import time
+import weakref
+from datetime import timedelta
+from flask import current_app
+from sqlalchemy import bindparam, or_
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----- Write-behind buffer for 'users.last_seen' -----
+# User.ping() is called on every authenticated request. Instead of turning each
+# page view into an UPDATE + COMMIT, the latest timestamp per user is kept here
+# and written out as one executemany UPDATE:
+#   - when PURPLE_LAST_SEEN_FLUSH_SIZE users are pending
+#   - when PURPLE_LAST_SEEN_FLUSH_INTERVAL seconds passed since the last flush
+#   - at interpreter shutdown (atexit, every buffer still alive)
+# Pings closer than PURPLE_LAST_SEEN_GRANULARITY seconds to the last known value
+# are not written at all.
+#
+# Neither the atexit hook nor the flusher thread keep a buffer (and its app and
+# engine) alive: apps made by tests or thrown away by the prefork master are
+# collected, and their flusher thread ends.
+_buffers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all():  # final flush at shutdown
+    for buffer in list(_buffers):
+        buffer.flush()
+
+
+class LastSeenBuffer:
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['PURPLE_LAST_SEEN_FLUSH_INTERVAL']
+        self.flush_size = app.config['PURPLE_LAST_SEEN_FLUSH_SIZE']
+        self.granularity = timedelta(seconds=app.config['PURPLE_LAST_SEEN_GRANULARITY'])
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # user_id -> datetime, not written yet
+        self._flushed = {}  # user_id -> datetime, written by the previous flush
+        self._last_flush = time.monotonic()
+        self._flusher = None
+        self.counters = dict(pings=0, skipped=0, merged=0, written=0, flushes=0, errors=0)
+        _buffers.add(self)
+
+    def record(self, user_id, seen, previous=None):
+        with self._lock:
+            self.counters['pings'] += 1
+            known = self._pending.get(user_id) or self._flushed.get(user_id)
+            if known is None or (previous is not None and previous > known):
+                known = previous
+            if known is not None and seen - known < self.granularity:
+                self.counters['skipped'] += 1
+                return
+            if user_id in self._pending:
+                self.counters['merged'] += 1
+            self._pending[user_id] = seen
+            due = len(self._pending) >= self.flush_size or \
+                time.monotonic() - self._last_flush >= self.interval
+            if self._flusher is None and self.interval > 0:
+                self._start_flusher()
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._last_flush = time.monotonic()
+            if not batch:
+                return 0
+            users = self.app.extensions['sqlalchemy'].db.metadata.tables['users']
+            # Only move 'last_seen' forward: another worker may have written a newer value
+            stmt = users.update() \
+                .where(users.c.id == bindparam('user_id')) \
+                .where(or_(users.c.last_seen.is_(None), users.c.last_seen < bindparam('seen'))) \
+                .values(last_seen=bindparam('seen'))
+            params = [{'user_id': k, 'seen': v} for k, v in batch.items()]
+            try:
+                engine = self.app.extensions['sqlalchemy'].db.get_engine(self.app)
+                with engine.begin() as conn:
+                    conn.execute(stmt, params)
+            except Exception:
+                # Put the batch back so the next flush retries it (newer pings win)
+                logger.exception('Failed to flush %d last_seen updates', len(batch))
+                with self._lock:
+                    self.counters['errors'] += 1
+                    for k, v in batch.items():
+                        if k not in self._pending or self._pending[k] < v:
+                            self._pending[k] = v
+                return 0
+            with self._lock:
+                self._flushed = batch
+                self.counters['flushes'] += 1
+                self.counters['written'] += len(batch)
+            return len(batch)
+
+    def write(self, user_id, seen):
+        with self._lock:
+            if user_id not in self._pending or self._pending[user_id] < seen:
+                self._pending[user_id] = seen
+        return self.flush()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['pending'] = len(self._pending)
+        stats['coalesced'] = stats['skipped'] + stats['merged']
+        return stats
+
+    # In a child of os.fork() (app/prefork.py): the flusher thread and any
+    # lock held by another thread of the parent did not come along
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+
+    def _start_flusher(self):
+        # Flushes idle buffers when no further pings arrive to trigger record().
+        # Holds the buffer only between two sleeps, ends once it is collected
+        def run(ref, interval):
+            while True:
+                time.sleep(interval)
+                buffer = ref()
+                if buffer is None or buffer._flusher is not threading.current_thread():
+                    return
+                interval = buffer.interval
+                if time.monotonic() - buffer._last_flush >= interval:
+                    buffer.flush()
+                del buffer
+
+        self._flusher = threading.Thread(target=run, args=(weakref.ref(self), self.interval),
+                                         name='last-seen-flusher', daemon=True)
+        self._flusher.start()
+
+
+class LastSeenTracker:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_LAST_SEEN_WRITE_BEHIND', True)
+        app.config.setdefault('PURPLE_LAST_SEEN_FLUSH_INTERVAL', 30)
+        app.config.setdefault('PURPLE_LAST_SEEN_FLUSH_SIZE', 500)
+        app.config.setdefault('PURPLE_LAST_SEEN_GRANULARITY', 60)
+        app.extensions['last_seen'] = LastSeenBuffer(app)
+
+    # Returns False when write-behind is disabled and the caller must write itself
+    def record(self, user_id, seen, previous=None):
+        app = current_app._get_current_object()
+        if not app.config['PURPLE_LAST_SEEN_WRITE_BEHIND'] or user_id is None:
+            return False
+        app.extensions['last_seen'].record(user_id, seen, previous)
+        return True
+
+    # Without write-behind: one UPDATE now, outside the request's session
+    def write(self, user_id, seen):
+        return current_app.extensions['last_seen'].write(user_id, seen)
+
+    def flush(self):
+        return current_app.extensions['last_seen'].flush()
+
+    def stats(self):
+        return current_app.extensions['last_seen'].stats()
@@ -1,4 +1,4 @@
-from flask import render_template
+from flask import render_template, make_response
 from . import main
 
 
@@ -16,3 +16,13 @@ def forbidden(e):
 @main.app_errorhandler(500)
 def internal_server_error(e):
     return render_template('500.html'), 500
+
+
+# ----- Rate limited (429) or too busy to check a password (503), see app/throttle.py -----
+@main.app_errorhandler(429)
+@main.app_errorhandler(503)
+def throttled(e):
+    response = make_response(render_template('%d.html' % e.code, description=e.description), e.code)
+    if getattr(e, 'retry_after', None):
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
@@ -1,15 +1,39 @@
-from flask import render_template
-from datetime import datetime
+from flask import render_template, abort
+from flask_login import current_user
 from . import main
-from ..models import User
+from .. import user_cache, fragment_cache
+from ..http_cache import conditional_response, current_minute, make_etag
+from ..query_budget import query_budget
 
 
 @main.route('/', methods=['GET', 'POST'])
+@query_budget(2)
 def index():
-    return render_template('index.html', current_time=datetime.utcnow())
+    # The page shows the time to the minute ('LLL'), so it stays valid for a
+    # minute; no Last-Modified, logging in within that minute changes it too
+    now = current_minute()
+    return conditional_response(make_etag('index', now.isoformat()),
+                                lambda: render_template('index.html', current_time=now))
 
 
 @main.route('/user/<username>')
+@query_budget(3)
 def user(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    return render_template('user.html', user=user)
+    user = user_cache.get_by_username(username)
+    if user is None:
+        abort(404)
+    # Everything user.html shows; the viewer's admin bit is added by make_etag()
+    data = (user.username, user.email, user.name, user.location, user.about_me,
+            user.member_since, user.last_seen)
+    etag = make_etag('user', user.id, *data)
+
+    # 'page_content' comes from the fragment cache, only the page around it is rendered
+    def render():
+        variant = 'admin' if current_user.is_administrator() else 'user'
+        page_content = fragment_cache.render_block('user.html', 'page_content', user.id,
+                                                   variant, data, user=user)
+        return render_template('user.html', user=user, page_content=page_content)
+
+    # No Last-Modified: last_seen stays the same through profile edits and
+    # logins of the viewer, only the ETag covers those
+    return conditional_response(etag, render)
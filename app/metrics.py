@@ -0,0 +1,249 @@
+import bisect
+import threading
+import time
+from flask import Response, abort, current_app, g, has_request_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+
+# ----- Request, SQL and template instrumentation -----
+# With PURPLE_METRICS_ENABLED every engine gets before/after_cursor_execute
+# timing, every request a duration histogram per endpoint (plus the number of
+# statements it ran and their time) and every render_template() its time. Emails
+# queued by send_email() are counted per template. Without it nothing is
+# hooked in at all, inc() is a dict lookup.
+#
+# Everything is per process. /metrics serves the Prometheus text format to
+# 'Authorization: Bearer <PURPLE_METRICS_TOKEN>' (without a token: 404, unless
+# DEBUG), together with the counters of the caches and buffers; /admin/metrics
+# shows a summary.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+BACKGROUND = '<background>'  # statements outside a request: outbox, last_seen flush, CLI
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Upper bound of the bucket holding the q-quantile, None when it is +Inf
+    def quantile(self, q):
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+class Registry:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.requests = {}  # (endpoint, method, status) -> Histogram of seconds
+        self.request_queries = {}  # endpoint -> Histogram of statements per request
+        self.sql = {}  # endpoint -> [statements, seconds]
+        self.templates = {}  # template name -> [renders, seconds]
+        self.counters = {}  # (name, label items) -> value
+
+    def observe_request(self, endpoint, method, status, seconds, queries, sql_seconds):
+        with self.lock:
+            histogram = self.requests.get((endpoint, method, status))
+            if histogram is None:
+                histogram = self.requests[(endpoint, method, status)] = Histogram(self.buckets)
+            histogram.observe(seconds)
+            histogram = self.request_queries.get(endpoint)
+            if histogram is None:
+                histogram = self.request_queries[endpoint] = Histogram(QUERY_BUCKETS)
+            histogram.observe(queries)
+            self._add(self.sql, endpoint, queries, sql_seconds)
+
+    def observe_sql(self, endpoint, seconds):
+        with self.lock:
+            self._add(self.sql, endpoint, 1, seconds)
+
+    def observe_template(self, name, seconds):
+        with self.lock:
+            self._add(self.templates, name, 1, seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @staticmethod
+    def _add(table, key, count, seconds):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = [0, 0.0]
+        entry[0] += count
+        entry[1] += seconds
+
+
+# ----- Hooks, only installed when enabled -----
+def _engine_hook(registry):
+    def hook(engine, bind):
+        # The start time goes on the execution context, which lives as long as
+        # the statement: after_cursor_execute is not called when it fails
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            context._metrics_start = time.perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - context._metrics_start
+            current = g.get('metrics') if has_request_context() else None
+            if current is None:
+                registry.observe_sql(BACKGROUND, elapsed)
+            else:
+                current['queries'] += 1
+                current['sql_seconds'] += elapsed
+    return hook
+
+
+def _start_request():
+    g.metrics = {'start': time.perf_counter(), 'queries': 0, 'sql_seconds': 0.0, 'templates': []}
+
+
+def _finish_request(response):
+    current = g.pop('metrics', None)
+    if current is not None:
+        current_app.extensions['metrics'].observe_request(
+            request.endpoint or '<unmatched>', request.method, response.status_code,
+            time.perf_counter() - current['start'], current['queries'], current['sql_seconds'])
+    return response
+
+
+def _before_render(sender, template, context, **extra):
+    current = g.get('metrics')
+    if current is not None:
+        current['templates'].append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    current = g.get('metrics')
+    if current is not None and current['templates']:
+        sender.extensions['metrics'].observe_template(
+            template.name, time.perf_counter() - current['templates'].pop())
+
+
+class Metrics:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_METRICS_ENABLED', True)
+        app.config.setdefault('PURPLE_METRICS_TOKEN', None)
+        if not app.config['PURPLE_METRICS_ENABLED']:
+            app.extensions['metrics'] = None
+            return
+        registry = app.extensions['metrics'] = Registry()
+        app.extensions.setdefault('engine_hooks', []).append(_engine_hook(registry))
+        app.before_request(_start_request)
+        app.after_request(_finish_request)
+        before_render_template.connect(_before_render, app)
+        template_rendered.connect(_rendered, app)
+        app.add_url_rule('/metrics', 'metrics', prometheus)
+
+    def inc(self, name, value=1, **labels):
+        registry = current_app.extensions['metrics']
+        if registry is not None:
+            registry.inc(name, value, **labels)
+
+    def registry(self):
+        return current_app.extensions['metrics']
+
+
+# ----- Counters of the caches and buffers: (key, title, stats) -----
+def stats_sections():
+    from . import availability, directory, fragment_cache, last_seen, templates, throttle, user_cache
+    from .email import outbox
+    sections = [
+        ('fragment_cache', 'Profile fragment cache', fragment_cache.stats()),
+        ('user_cache', 'User cache', user_cache.stats()),
+        ('last_seen', 'last_seen buffer', last_seen.stats()),
+        ('outbox', 'Email outbox', outbox.stats()),
+        ('availability', 'Username/email filters', availability.stats()),
+        ('throttle', 'Login throttling', throttle.stats()),
+        ('templates', 'Templates', templates.stats()),
+        ('directory', 'User directory', directory.stats()),
+    ]
+    replicas = current_app.extensions['replicas']
+    if replicas is not None:
+        sections.append(('replicas', 'Read replicas', replicas.stats()))
+    return sections
+
+
+# ----- Prometheus text format -----
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in labels.items()) if labels else ''
+
+
+def _histogram_lines(name, labels, histogram):
+    lines, cumulative = [], 0
+    for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+        cumulative += count
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append('%s_bucket%s %d' % (name, _labels(**dict(labels, le=le)), cumulative))
+    lines.append('%s_sum%s %r' % (name, _labels(**labels), histogram.sum))
+    lines.append('%s_count%s %d' % (name, _labels(**labels), histogram.count))
+    return lines
+
+
+def render_prometheus(registry, sections=()):
+    out = []
+
+    def header(name, kind, text):
+        out.append('# HELP %s %s' % (name, text))
+        out.append('# TYPE %s %s' % (name, kind))
+
+    with registry.lock:
+        header('purple_http_request_duration_seconds', 'histogram', 'Request duration by endpoint.')
+        for (endpoint, method, status), histogram in sorted(registry.requests.items()):
+            out += _histogram_lines('purple_http_request_duration_seconds',
+                                    dict(endpoint=endpoint, method=method, status=status), histogram)
+        header('purple_http_request_queries', 'histogram', 'SQL statements per request.')
+        for endpoint, histogram in sorted(registry.request_queries.items()):
+            out += _histogram_lines('purple_http_request_queries', dict(endpoint=endpoint), histogram)
+        header('purple_sql_queries_total', 'counter', 'SQL statements by endpoint.')
+        out += ['purple_sql_queries_total%s %d' % (_labels(endpoint=k), v[0]) for k, v in sorted(registry.sql.items())]
+        header('purple_sql_duration_seconds_total', 'counter', 'Time in SQL statements by endpoint.')
+        out += ['purple_sql_duration_seconds_total%s %r' % (_labels(endpoint=k), v[1])
+                for k, v in sorted(registry.sql.items())]
+        header('purple_template_renders_total', 'counter', 'render_template() calls.')
+        out += ['purple_template_renders_total%s %d' % (_labels(template=k), v[0])
+                for k, v in sorted(registry.templates.items())]
+        header('purple_template_render_seconds_total', 'counter', 'Time in render_template().')
+        out += ['purple_template_render_seconds_total%s %r' % (_labels(template=k), v[1])
+                for k, v in sorted(registry.templates.items())]
+        for name in sorted({name for name, _ in registry.counters}):
+            header('purple_%s_total' % name, 'counter', name.replace('_', ' ').capitalize() + '.')
+            out += ['purple_%s_total%s %r' % (name, _labels(**dict(labels)), value)
+                    for (n, labels), value in sorted(registry.counters.items()) if n == name]
+    for key, title, stats in sections:
+        for stat, value in sorted(stats.items()):
+            if isinstance(value, (int, float)):  # bools too
+                header('purple_%s_%s' % (key, stat), 'gauge', '%s: %s.' % (title, stat))
+                out.append('purple_%s_%s %r' % (key, stat, float(value)))
+    return '\n'.join(out) + '\n'
+
+
+def prometheus():
+    token = current_app.config['PURPLE_METRICS_TOKEN']
+    if not token and not current_app.debug:  # never open to anyone outside development
+        abort(404)
+    if token and request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(403)
+    text = render_prometheus(current_app.extensions['metrics'], stats_sections())
+    return Response(text, mimetype='text/plain; version=0.0.4')
@@ -1,9 +1,11 @@
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin, AnonymousUserMixin
-from . import db, login_manager
-from itsdangerous import TimedJSONWebSignatureSerializer as Serializer # for web-signature JSON
+from sqlalchemy.orm import validates
+from sqlalchemy.orm.attributes import set_committed_value
+from flask_sqlalchemy import SignallingSession
+from . import db, login_manager, last_seen, user_cache, password_hasher, tokens
 from flask import current_app
 from datetime import datetime
+import time
 
 
 # ----- [09a] Permission bitmask class -----
@@ -59,17 +61,84 @@ class Role(db.Model):
             role.default = roles[r][1]  # True or False
             db.session.add(role)
         db.session.commit()
+        Role.load_permission_table()  # publish role_id -> permissions for User.can()
+
+    # ----- In-memory table 'role_id -> permissions bitmask' -----
+    # Built at create_app() (or on first use) and dropped after a commit that
+    # changes roles, so User.can() never has to load 'self.role' from the DB.
+    # Roles changed by another process ('manage.py shell', another worker) are
+    # picked up by reading the table again every PURPLE_PERMISSION_TABLE_TTL
+    # seconds: one SELECT of a few rows.
+    @staticmethod
+    def load_permission_table():
+        roles = Role.__table__
+        table = {id: permissions or 0
+                 for id, permissions in db.session.execute(db.select(roles.c.id, roles.c.permissions))}
+        current_app.extensions['permissions'] = table
+        current_app.extensions['permissions_loaded_at'] = time.monotonic()
+        return table
+
+    @staticmethod
+    def permissions_for(role_id):
+        table = current_app.extensions.get('permissions')
+        if table is None or time.monotonic() - current_app.extensions['permissions_loaded_at'] > \
+                current_app.config['PURPLE_PERMISSION_TABLE_TTL']:
+            table = Role.load_permission_table()
+        return table.get(role_id)
 
     def __repr__(self):
         return '<Role %r>' % self.name
 
 
+@db.event.listens_for(SignallingSession, 'after_flush')
+def roles_changed(session, flush_context):
+    # Adding a user appends to 'Role.users' and makes the role dirty, so for
+    # dirty roles only a change of the columns counts
+    changed = [obj for obj in list(session.new) + list(session.deleted) if isinstance(obj, Role)] + \
+        [obj for obj in session.dirty
+         if isinstance(obj, Role) and session.is_modified(obj, include_collections=False)]
+    if changed:
+        session.info['roles_changed'] = True
+
+
+@db.event.listens_for(SignallingSession, 'after_commit')
+def reset_permission_table(session):
+    if session.info.pop('roles_changed', False):
+        session.app.extensions['permissions'] = None
+
+
+@db.event.listens_for(SignallingSession, 'after_soft_rollback')
+def forget_roles_changed(session, previous_transaction):
+    session.info.pop('roles_changed', None)
+
+
+# ----- Canonical form of emails and usernames -----
+# 'John@Example.com ' and 'john@example.com' are the same account: lookups and
+# uniqueness go through the indexed *_canonical columns, the typed value is kept
+# for display and for sending mail.
+def canonical(value):
+    return value.strip().lower() if value is not None else None
+
+
 # https://docs.sqlalchemy.org/en/14/core/type_basics.html
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
+    # Keyset pages of the admin directory (app/directory.py): an index per
+    # order (joined, username) with and without the role, so every page is a
+    # seek (username alone has ix_users_username_canonical). 'confirmed' is
+    # filtered on top while walking the index; an index with it would be
+    # rewritten on every confirmation for little gain, as would last_seen on
+    # every ping()
+    __table_args__ = (
+        db.Index('ix_users_member_since_id', 'member_since', 'id'),
+        db.Index('ix_users_role_id_member_since_id', 'role_id', 'member_since', 'id'),
+        db.Index('ix_users_role_id_username_canonical', 'role_id', 'username_canonical'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(64), unique=True, index=True)
     username = db.Column(db.String(64), unique=True, index=True)
+    email_canonical = db.Column(db.String(64), unique=True, index=True)  # set by _set_canonical()
+    username_canonical = db.Column(db.String(64), unique=True, index=True)
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
     password_hash = db.Column(db.String(128))  # This is like __init__ in ordinary class
     confirmed = db.Column(db.Boolean, default=False)
@@ -88,38 +157,44 @@ class User(UserMixin, db.Model):
         # in class 'Role'
         # https://flask-sqlalchemy-russian.readthedocs.io/ru/latest/models.html
         if self.role is None:
-            if self.email == current_app.config['PURPLE_ADMIN']:
+            if self.email_canonical == canonical(current_app.config['PURPLE_ADMIN']):
                 self.role = Role.query.filter_by(permissions=0xff).first()
             if self.role is None:
                 self.role = Role.query.filter_by(default=True).first()
 
+    @validates('email', 'username')
+    def _set_canonical(self, key, value):
+        setattr(self, key + '_canonical', canonical(value))
+        return value
+
     # Doc: https://www.tutorialsteacher.com/python/property-decorator
     @property
     def password(self): # This is like a getter
         raise AttributeError('password is not a readable attribute')
 
+    # Hashing goes through app/hashing.py (optionally a process pool)
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password, method='pbkdf2:sha256', salt_length=8)
+        self.password_hash = password_hasher.hash(password)
 
+    # A hash made with older PURPLE_PASSWORD_METHOD parameters is replaced after
+    # a successful check; the new hash is saved with the request
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not password_hasher.verify(self.password_hash, password):
+            return False
+        if password_hasher.needs_rehash(self.password_hash):
+            self.password = password
+        return True
 
     # Generate marker
+    # Tokens are signed by app/tokens.py with a separate salt for every purpose
     def generate_confirmation_token(self, expiration=3600):
-        s = Serializer(current_app.config['SECRET_KEY'], expiration)
-        # Method dumps() generates digital signature and create marker
-        return s.dumps({'confirm': self.id}) # 'confirm' default key, self.id - value
+        return tokens.generate('confirm', {'confirm': self.id}, expiration) # 'confirm' default key, self.id - value
 
     # Check marker and save it in confirmed
     def confirm(self, token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            # Method loads() decrypts marker
-            data = s.loads(token)
-        except:
-            return False
-        if data.get('confirm') != self.id:
+        data = tokens.load('confirm', token) # None if the marker is invalid or expired
+        if data is None or data.get('confirm') != self.id:
             return False
         self.confirmed = True
         db.session.add(self) # db.session.add() for prepare, db.session.commit() for for the record
@@ -127,16 +202,13 @@ class User(UserMixin, db.Model):
 
     # ----- [08g] Method to generate token to reset password -----
     def generate_reset_token(self, expiration=3600):
-        s = Serializer(current_app.config['SECRET_KEY'], expiration)
-        return s.dumps({'reset': self.id}).decode('utf-8')
+        return tokens.generate('reset', {'reset': self.id}, expiration)
 
     # ----- [08g] Method to reset password -----
     @staticmethod
     def reset_password(token, new_password):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token.encode('utf-8'))
-        except:
+        data = tokens.load('reset', token)
+        if data is None:
             return False
         user = User.query.get(data.get('reset'))  # {'reset': self.id}
         if user is None:
@@ -145,25 +217,26 @@ class User(UserMixin, db.Model):
         db.session.add(user)
         return True
 
+    # ----- Mint tokens for many users in one call (admin tasks, bulk resets) -----
+    # Returns {user_id: token}
+    @staticmethod
+    def generate_tokens(purpose, user_ids, expiration=3600):
+        return tokens.generate_many(purpose, user_ids, expiration)
+
     # ----- [08e] Method to generate token to change email address -----
     def generate_email_change_token(self, new_email, expiration=3600):
-        s = Serializer(current_app.config['SECRET_KEY'], expiration)
-        return s.dumps(
-            {'change_email': self.id, 'new_email': new_email}).decode('utf-8')  # Hash will include two parameters
+        return tokens.generate(
+            'change_email', {'change_email': self.id, 'new_email': new_email}, expiration)  # Token will include two parameters
 
     # ----- [08e] Method to change email address -----
     def change_email(self, token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token.encode('utf-8'))
-        except:
-            return False
-        if data.get('change_email') != self.id:
+        data = tokens.load('change_email', token)
+        if data is None or data.get('change_email') != self.id:
             return False
         new_email = data.get('new_email')
         if new_email is None:
             return False
-        if self.query.filter_by(email=new_email).first() is not None:
+        if self.query.filter_by(email_canonical=canonical(new_email)).first() is not None:
             return False
         self.email = new_email
         db.session.add(self)  # commit() in the view.py
@@ -174,22 +247,81 @@ class User(UserMixin, db.Model):
     # to show all roles connected with this user (role_id is Foreign Key)
     #
     # 'permissions' is property in class 'Role'
+    #
+    # The bitmask is taken from Role.permissions_for(role_id), an in-memory dict.
+    # 'self.role' is only used for a user whose role is not flushed yet (role_id is None)
     def can(self, permissions):
-        return self.role is not None and \
-            (self.role.permissions & permissions) == permissions
+        role_permissions = None
+        if self.role_id is not None:
+            role_permissions = Role.permissions_for(self.role_id)
+        if role_permissions is None:
+            if self.role is None:
+                return False
+            role_permissions = self.role.permissions
+        return (role_permissions & permissions) == permissions
 
     def is_administrator(self):
         return self.can(Permission.ADMINISTER)  # Invoke method can
 
     # ----- [10a] Method to update field 'last_seen' -----
+    # With write-behind enabled the new value goes to the 'last_seen' buffer and
+    # is only set in memory, so the session stays clean and no COMMIT is needed
     def ping(self):
-        self.last_seen = datetime.utcnow()
+        now = datetime.utcnow()
+        if last_seen.record(self.id, now, self.last_seen):
+            set_committed_value(self, 'last_seen', now)
+            return
+        if db.read_only_request():  # the session must stay clean, UPDATE right away
+            last_seen.write(self.id, now)
+            set_committed_value(self, 'last_seen', now)
+            return
+        self.last_seen = now
         db.session.add(self)
 
     def __repr__(self):
         return '<User %r>' % self.username
 
 
+# ----- Queue of outgoing emails, sent by the worker pool in app/email.py -----
+# status: 'pending' -> 'sending' (claimed by a worker) -> 'sent' or 'failed'
+class OutboxMessage(db.Model):
+    __tablename__ = 'outbox'
+    __table_args__ = (db.Index('ix_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(64))
+    sender = db.Column(db.String(128))
+    subject = db.Column(db.String(256))
+    body = db.Column(db.Text())
+    html = db.Column(db.Text())
+    status = db.Column(db.String(16), default='pending')
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text())
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime(), default=datetime.utcnow)
+    claimed_at = db.Column(db.DateTime())
+    claim_token = db.Column(db.String(32), index=True)
+    sent_at = db.Column(db.DateTime())
+
+    def __repr__(self):
+        return '<OutboxMessage %r %r>' % (self.recipient, self.status)
+
+
+# ----- Approximate number of users per role and confirmation state -----
+# Rebuilt every PURPLE_DIRECTORY_COUNTS_INTERVAL seconds by app/directory.py,
+# the admin directory reads these rows instead of a COUNT(*) over 'users'.
+# role_id and confirmed are NULL for users without a role or state.
+class UserCount(db.Model):
+    __tablename__ = 'user_counts'
+    id = db.Column(db.Integer, primary_key=True)
+    role_id = db.Column(db.Integer)
+    confirmed = db.Column(db.Boolean)
+    users = db.Column(db.Integer, default=0)
+    refreshed_at = db.Column(db.DateTime(), default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<UserCount %r %r %r>' % (self.role_id, self.confirmed, self.users)
+
+
 # ----- [09a] Separate class for Anonymous Users -----
 # No need to check login status for that users
 class AnonymousUser(AnonymousUserMixin):
@@ -205,4 +337,4 @@ login_manager.anonymous_user = AnonymousUser
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.get(int(user_id))  # see app/cache.py
@@ -0,0 +1,205 @@
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import exc
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----- Preforking servers: what the master and the workers do -----
+# wsgi.py builds the app once in the master and calls warm_up(): the
+# permission table, the username/email filters, every template and the URL
+# map are ready before os.fork(), so the workers share them copy-on-write and
+# answer their first request as fast as the thousandth. The master then
+# closes its database connections and freezes the heap for the garbage
+# collector (gc.freeze(), fewer pages copied after the fork).
+#
+# after_fork() runs first thing in every worker: pooled connections are never
+# shared between processes, and the background threads of the master do not
+# exist in the child. before_exit() runs when a worker stops (shutdown,
+# graceful reload, recycling): the last_seen buffer is written out and the
+# outbox workers finish their batch. Messages not sent yet stay in the outbox
+# table and are sent by the next generation of workers.
+#
+# gunicorn_conf.py wires these into gunicorn; PreforkServer below is a small
+# stdlib server with the same behaviour, for local runs and load tests.
+def warm_up(app):
+    from . import availability, db, templates
+    from .models import Role
+    start = time.perf_counter()
+    with app.app_context():
+        try:
+            if app.extensions.get('permissions') is None:  # empty database at create_app()
+                Role.load_permission_table()
+            availability.rebuild()
+        except exc.OperationalError:
+            db.session.rollback()
+    if not app.extensions['templates']['load_seconds']:
+        templates.prewarm(app)
+    app.url_map.update()  # sorts the rules, done on the first match otherwise
+    app.url_map.bind('localhost').match('/')
+    db.dispose_engines(app)
+    gc.collect()
+    gc.freeze()
+    seconds = time.perf_counter() - start
+    app.extensions['prefork'] = {'warm_up_seconds': seconds, 'master_pid': os.getpid()}
+    logger.info('App warmed up in %.3f s', seconds)
+    return seconds
+
+
+def after_fork(app):
+    from . import db
+    # The inherited pools still hold the master's connections: forget them
+    # without closing them (close=False), this process opens its own
+    db.dispose_engines(app, close=False)
+    app.extensions['last_seen'].after_fork()
+
+
+def before_exit(app, timeout=10):
+    from . import db
+    written = app.extensions['last_seen'].flush()
+    app.extensions['outbox'].stop(timeout)
+    db.dispose_engines(app)
+    logger.info('Worker %d stopped, %d last_seen updates written', os.getpid(), written)
+
+
+# ----- A worker: werkzeug with a fixed pool of request threads -----
+class QuietRequestHandler(WSGIRequestHandler):
+    def log(self, type, message, *args):
+        if type != 'info':  # the access log
+            super().log(type, message, *args)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    def __init__(self, host, port, app, threads, fd=None, handler=None):
+        super().__init__(host, port, app, handler=handler, fd=fd)
+        self.pool = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+# ----- The master: one listening socket, N workers, HUP reloads, TERM stops -----
+# SIGHUP starts a new generation of workers and stops the old one gracefully:
+# a stopping worker no longer accepts connections (the others do, the socket
+# is shared), finishes the requests it has and runs before_exit(). Workers that
+# do not stop within graceful_timeout seconds are killed. A worker that dies
+# is replaced.
+class PreforkServer:
+    def __init__(self, app, bind='127.0.0.1:8000', workers=2, threads=4, graceful_timeout=30, access_log=True):
+        self.app = app
+        host, _, port = bind.rpartition(':')
+        self.host, self.port = host or '127.0.0.1', int(port)
+        self.worker_count = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.handler = WSGIRequestHandler if access_log else QuietRequestHandler
+        self.workers = {}  # pid -> generation
+        self.generation = 0
+        self._stop = self._reload = False
+
+    def run(self):
+        self.socket = socket.create_server((self.host, self.port), backlog=2048)
+        self.port = self.socket.getsockname()[1]
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        print('Listening on http://%s:%d, %d workers x %d threads (master %d)'
+              % (self.host, self.port, self.worker_count, self.threads, os.getpid()), flush=True)
+        try:
+            while not self._stop:
+                if self._reload:
+                    self._reload = False
+                    old = list(self.workers)
+                    self.generation += 1
+                    self._spawn_missing()
+                    self._signal(old, signal.SIGTERM)
+                    logger.info('Reloading: generation %d, stopping %d old workers', self.generation, len(old))
+                self._reap()
+                self._spawn_missing()
+                time.sleep(0.1)
+        finally:
+            self._shutdown()
+
+    def _on_stop(self, signum, frame):
+        self._stop = True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _spawn_missing(self):
+        while sum(1 for g in self.workers.values() if g == self.generation) < self.worker_count:
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    self._work()
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    os._exit(code)
+            self.workers[pid] = self.generation
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.workers.pop(pid, None)
+            if generation == self.generation and not self._stop and os.waitstatus_to_exitcode(status) != 0:
+                logger.warning('Worker %d died with status %d, starting a new one', pid, status)
+
+    def _signal(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _shutdown(self):
+        self._signal(list(self.workers), signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.05)
+        self._signal(list(self.workers), signal.SIGKILL)
+        while self.workers:
+            pid, status = os.waitpid(-1, 0)
+            self.workers.pop(pid, None)
+        self.socket.close()
+
+    def _work(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole group, the master stops us
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        after_fork(self.app)
+        server = PooledWSGIServer(self.host, self.port, self.app, self.threads,
+                                  fd=self.socket.fileno(), handler=self.handler)
+        # serve_forever() runs in this thread, shutdown() waits for it to return
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        server.serve_forever()
+        server.server_close()
+        server.pool.shutdown(wait=True)  # requests in progress are answered
+        before_exit(self.app)
+        sys.stdout.flush()
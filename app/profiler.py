@@ -0,0 +1,168 @@
+import cProfile
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from flask import current_app, g, request
+from flask_login import current_user
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----- On-demand profiling of single requests -----
+# An administrator adds '?__profile=1' (or the header 'X-Profile: 1') to any
+# URL: the request is run under cProfile and answered as usual, the pstats file
+# lands in PURPLE_PROFILER_DIR and its name in the 'X-Profile' response header.
+# '__profile=stacks' uses the stack sampler instead: a thread looks at the
+# request's stack every PURPLE_PROFILER_INTERVAL seconds and the result is
+# saved as collapsed stacks ('module:func;module:func count' lines, the input
+# of flamegraph.pl or speedscope), cheap enough for production.
+#
+# With PURPLE_PROFILER_SAMPLE_EVERY = N one request in N of anybody is
+# profiled with the sampler. The directory is a ring: only the newest
+# PURPLE_PROFILER_KEEP files are kept. /admin/profiles lists and serves them.
+SUFFIXES = {'cprofile': '.pstats', 'stacks': '.stacks'}
+
+
+class StackSampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                stack.append('%s:%s' % (frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def dump(self, path):
+        with open(path, 'w') as out:
+            for stack, count in self.stacks.most_common():
+                out.write('%s %d\n' % (stack, count))
+
+
+class Profiler:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_PROFILER_DIR', os.path.join(app.instance_path, 'profiles'))
+        app.config.setdefault('PURPLE_PROFILER_KEEP', 50)
+        app.config.setdefault('PURPLE_PROFILER_SAMPLE_EVERY', 0)
+        app.config.setdefault('PURPLE_PROFILER_INTERVAL', 0.005)
+        app.extensions['profiler'] = {'requests': itertools.count(1), 'lock': threading.Lock()}
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+
+    # ----- Which requests are profiled, and how -----
+    def _requested_mode(self):
+        flag = request.args.get('__profile') or request.headers.get('X-Profile')
+        if flag:
+            if not current_user.is_administrator():
+                return None
+            return 'stacks' if flag == 'stacks' else 'cprofile'
+        every = current_app.config['PURPLE_PROFILER_SAMPLE_EVERY']
+        if every and next(current_app.extensions['profiler']['requests']) % every == 0:
+            return 'stacks'
+        return None
+
+    def _start(self):
+        mode = self._requested_mode()
+        if mode is None:
+            return
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            profiler = StackSampler(current_app.config['PURPLE_PROFILER_INTERVAL'])
+            profiler.start()
+        g.profile = (mode, profiler, time.perf_counter())
+
+    def _stop(self):
+        mode, profiler, start = g.pop('profile')
+        if mode == 'cprofile':
+            profiler.disable()
+        else:
+            profiler.stop()
+        try:
+            return self.save(mode, profiler, time.perf_counter() - start)
+        except OSError:
+            logger.exception('Cannot save the profile of %s', request.path)
+            return None
+
+    def _finish(self, response):
+        if 'profile' in g:
+            name = self._stop()
+            if name is not None:
+                response.headers['X-Profile'] = name
+        return response
+
+    def _teardown(self, exc):
+        if 'profile' in g:  # the view raised, after_request did not run
+            self._stop()
+
+    # ----- The ring directory -----
+    def save(self, mode, profiler, seconds):
+        directory = current_app.config['PURPLE_PROFILER_DIR']
+        os.makedirs(directory, exist_ok=True)
+        name = '%s-%s-%s-%dms-%s%s' % (
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), request.method,
+            (request.endpoint or 'unmatched').replace('.', '_'), seconds * 1000,
+            uuid.uuid4().hex[:6], SUFFIXES[mode])
+        path = os.path.join(directory, name)
+        if mode == 'cprofile':
+            profiler.dump_stats(path)
+        else:
+            profiler.dump(path)
+        with current_app.extensions['profiler']['lock']:
+            for old in self.names()[current_app.config['PURPLE_PROFILER_KEEP']:]:
+                try:
+                    os.remove(os.path.join(directory, old))
+                except FileNotFoundError:  # removed by another worker
+                    pass
+        return name
+
+    def names(self):
+        directory = current_app.config['PURPLE_PROFILER_DIR']
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return sorted((name for name in names if name.endswith(tuple(SUFFIXES.values()))), reverse=True)
+
+    def list(self):
+        directory = current_app.config['PURPLE_PROFILER_DIR']
+        profiles = []
+        for name in self.names():
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            profiles.append(dict(name=name, size=st.st_size, created=datetime.utcfromtimestamp(st.st_mtime),
+                                 mode='stacks' if name.endswith(SUFFIXES['stacks']) else 'cprofile'))
+        return profiles
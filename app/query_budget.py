@@ -0,0 +1,117 @@
+import logging
+import threading
+from collections import Counter
+from contextlib import ContextDecorator
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----- Query budgets: N+1 guard for tests and development -----
+# User.__init__ (role lookups), a lazy 'role' or the dynamic 'Role.users' make it
+# easy to add a query per row without noticing. Two tools:
+#
+#   with assert_max_queries(2):          # tests, also a decorator
+#       client.get('/user/john')
+#
+#   @main.route('/user/<username>')
+#   @query_budget(3)                     # views, checked by QueryBudget
+#   def user(username): ...
+#
+# With PURPLE_QUERY_BUDGET = 'log' or 'raise' every request counts its
+# statements; more than the view's budget, or the same statement more than
+# PURPLE_QUERY_REPEAT_LIMIT times (a loop doing one query per row), is logged
+# or raised as QueryBudgetExceeded. None (production) hooks nothing in.
+# Statements of the teardown commit and of streamed responses are not counted.
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def _describe(statements, limit=10):
+    repeats = Counter(statements).most_common(limit)
+    return '\n'.join('  %dx %s' % (count, ' '.join(statement.split())) for statement, count in repeats)
+
+
+# ----- Counting statements of the current thread on every engine -----
+class assert_max_queries(ContextDecorator):
+    def __init__(self, count):
+        self.count = count
+        self.statements = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread:
+            self.statements.append(statement)
+
+    def __enter__(self):
+        self.thread = threading.get_ident()
+        self.statements = []
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        event.remove(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        if exc_type is None and len(self.statements) > self.count:
+            raise QueryBudgetExceeded('%d queries, expected at most %d:\n%s' % (
+                len(self.statements), self.count, _describe(self.statements)))
+        return False
+
+
+def query_budget(count):
+    def decorator(f):
+        f.query_budget = count  # copied by functools.wraps of outer decorators
+        return f
+    return decorator
+
+
+# ----- Per-request check, only installed with PURPLE_QUERY_BUDGET -----
+def _engine_hook(engine, bind):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            statements = g.get('query_statements')
+            if statements is not None:
+                statements.append(statement)
+
+
+def _start_request():
+    g.query_statements = []
+
+
+def _check_request(response):
+    statements = g.pop('query_statements', None)
+    mode = current_app.config['PURPLE_QUERY_BUDGET']
+    if statements is None or mode not in ('log', 'raise'):  # may be switched off after init_app()
+        return response
+    view = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', None)
+    repeat_limit = current_app.config['PURPLE_QUERY_REPEAT_LIMIT']
+    problems = []
+    if budget is not None and len(statements) > budget:
+        problems.append('%d queries, budget %d' % (len(statements), budget))
+    repeated = [s for s, count in Counter(statements).items() if count > repeat_limit]
+    if repeated:
+        problems.append('%d statement(s) run more than %d times' % (len(repeated), repeat_limit))
+    if problems:
+        message = '%s %s: %s\n%s' % (request.method, request.path, ', '.join(problems), _describe(statements))
+        if mode == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+    return response
+
+
+class QueryBudget:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_QUERY_BUDGET', None)
+        app.config.setdefault('PURPLE_QUERY_REPEAT_LIMIT', 3)
+        if app.config['PURPLE_QUERY_BUDGET'] not in ('log', 'raise'):
+            return
+        app.extensions.setdefault('engine_hooks', []).append(_engine_hook)
+        app.before_request(_start_request)
+        app.after_request(_check_request)
@@ -0,0 +1,91 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----- Template bytecode cache and pre-warming -----
+# Jinja compiles a template to Python code the first time it is rendered, in
+# every worker, so the first requests after a deploy or a worker recycle pay
+# for base.html, bootstrap/base.html and the page itself.
+#
+# PURPLE_TEMPLATE_CACHE_DIR keeps the compiled code in a directory shared by
+# all workers (jinja2's FileSystemBytecodeCache, keyed by the template's name
+# and checked against a checksum of its source, so an edited template is
+# compiled again). The files are written to a temporary name and renamed, a
+# worker never reads one half written by another.
+#
+# With PURPLE_TEMPLATE_PREWARM create_app() loads every template the app can
+# find (app/templates, the blueprints', Flask-Bootstrap's) before it returns,
+# i.e. before the worker accepts traffic. The time per template is kept in
+# app.extensions['templates'] and shown on /admin/stats.
+class SharedBytecodeCache(FileSystemBytecodeCache):
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory)
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+        with self._lock:
+            if bucket.code is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+    def dump_bytecode(self, bucket):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp, self._get_cache_filename(bucket))
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+
+class Templates:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_TEMPLATE_CACHE_DIR', None)
+        app.config.setdefault('PURPLE_TEMPLATE_PREWARM', False)
+        directory = app.config['PURPLE_TEMPLATE_CACHE_DIR']
+        cache = SharedBytecodeCache(directory) if directory else None
+        app.jinja_env.bytecode_cache = cache
+        app.extensions['templates'] = {'cache': cache, 'load_seconds': {}, 'prewarm_seconds': None}
+
+    def prewarm(self, app):
+        state = app.extensions['templates']
+        env = app.jinja_env
+        start = time.perf_counter()
+        for name in env.list_templates():
+            t = time.perf_counter()
+            env.get_template(name)
+            state['load_seconds'][name] = time.perf_counter() - t
+        state['prewarm_seconds'] = time.perf_counter() - start
+        logger.info('Loaded %d templates in %.3f s', len(state['load_seconds']), state['prewarm_seconds'])
+        return state['load_seconds']
+
+    def stats(self):
+        state = current_app.extensions['templates']
+        cache = state['cache']
+        stats = {'bytecode_cache': cache.directory if cache is not None else 'off',
+                 'prewarmed': len(state['load_seconds'])}
+        if cache is not None:
+            stats.update(bytecode_cache_hits=cache.hits, bytecode_cache_misses=cache.misses)
+        if state['prewarm_seconds'] is not None:
+            stats['prewarm_seconds'] = state['prewarm_seconds']
+        return stats
@@ -0,0 +1,194 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from .cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+# ----- Rate limits and admission control for the password endpoints -----
+# Every POST to a limited view takes one token from a bucket per client IP and
+# one per account (the canonical email of the form), see PURPLE_THROTTLE_LIMITS:
+#   {'login': {'ip': (20, 60), 'account': (5, 300)}, ...}
+# (20, 60) is a bucket of 20 tokens refilled at 20 per 60 seconds: bursts of
+# 20, then one request every 3 seconds. An empty bucket answers 429 with
+# Retry-After before any hashing or email is done. That is a burst capacity
+# plus a refill rate, not a count per window: a full bucket lets through up to
+# 2 x 20 - 1 = 39 requests within 60 seconds (the burst, then the refill);
+# over longer spans the rate wins.
+#
+# Buckets live in process memory, or with PURPLE_THROTTLE_STORE (path of a
+# SQLite file) in a table shared by all workers of the host.
+#
+# verification() caps the concurrent password checks per worker at
+# PURPLE_VERIFY_CONCURRENCY; a request that gets no slot within
+# PURPLE_VERIFY_WAIT seconds is answered 503 at once instead of queueing.
+class TooBusy(ServiceUnavailable):
+    description = 'Too many logins are being checked right now, please try again.'
+
+
+class MemoryStore:
+    def __init__(self, maxsize=100000):
+        self.buckets = LRUCache(maxsize)
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        with self.lock:
+            tokens, updated = self.buckets.get(key) or (capacity, now)
+            tokens, wait = _take(tokens, updated, capacity, rate, now)
+            self.buckets.set(key, (tokens, now))
+        return wait
+
+
+class SQLiteStore:
+    PRUNE_EVERY = 1000  # takes between deletes of idle buckets
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.takes = 0
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():  # never share one across a fork
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS throttle_buckets '
+                         '(key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def take(self, key, capacity, rate, now):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM throttle_buckets WHERE key = ?',
+                               (key,)).fetchone()
+            tokens, wait = _take(*(row or (capacity, now)), capacity, rate, now)
+            conn.execute('INSERT INTO throttle_buckets (key, tokens, updated) VALUES (?, ?, ?) '
+                         'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                         (key, tokens, now))
+            self.takes += 1
+            if self.takes % self.PRUNE_EVERY == 0:
+                conn.execute('DELETE FROM throttle_buckets WHERE updated < ?', (now - 86400,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+
+# Returns (tokens left, seconds to wait); wait is 0 when a token was taken
+def _take(tokens, updated, capacity, rate, now):
+    tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class _State:
+    COUNTERS = ('allowed', 'limited_ip', 'limited_account', 'busy', 'store_errors')
+
+    def __init__(self, store, concurrency):
+        self.store = store
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.concurrency = concurrency
+        self.in_flight = self.peak = 0
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+
+class Throttle:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_THROTTLE_ENABLED', True)
+        app.config.setdefault('PURPLE_THROTTLE_STORE', None)
+        app.config.setdefault('PURPLE_THROTTLE_LIMITS', {})
+        app.config.setdefault('PURPLE_VERIFY_CONCURRENCY', 4)
+        app.config.setdefault('PURPLE_VERIFY_WAIT', 0.1)
+        path = app.config['PURPLE_THROTTLE_STORE']
+        store = SQLiteStore(path) if path else MemoryStore()
+        app.extensions['throttle'] = _State(store, app.config['PURPLE_VERIFY_CONCURRENCY'])
+
+    def _state(self):
+        return current_app.extensions['throttle']
+
+    def _take(self, state, key, limit):
+        capacity, period = limit
+        try:
+            return state.store.take(key, capacity, capacity / period, time.time())
+        except sqlite3.Error:
+            # A broken shared store must not lock everybody out
+            logger.exception('Throttle store failed, request let through')
+            state.count('store_errors')
+            return 0
+
+    def check(self, scope, account=None):
+        from .models import canonical
+        config = current_app.config
+        limits = config['PURPLE_THROTTLE_LIMITS'].get(scope)
+        if not config['PURPLE_THROTTLE_ENABLED'] or not limits:
+            return
+        state = self._state()
+        checks = [('ip', request.remote_addr or '-')]
+        if account:
+            checks.append(('account', canonical(account)))
+        for kind, value in checks:
+            if kind not in limits:
+                continue
+            wait = self._take(state, '%s:%s:%s' % (scope, kind, value), limits[kind])
+            if wait:
+                state.count('limited_' + kind)
+                raise TooManyRequests(retry_after=int(wait) + 1)
+        state.count('allowed')
+
+    # View decorator: POSTs are checked against the limits of 'scope', the
+    # account is read from the form field 'account_field'
+    def limit(self, scope, account_field=None, methods=('POST',)):
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if request.method in methods:
+                    account = request.form.get(account_field) if account_field else None
+                    self.check(scope, account)
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+    @contextmanager
+    def verification(self):
+        state = self._state()
+        if not state.slots.acquire(timeout=current_app.config['PURPLE_VERIFY_WAIT']):
+            state.count('busy')
+            raise TooBusy(retry_after=1)
+        with state.lock:
+            state.in_flight += 1
+            state.peak = max(state.peak, state.in_flight)
+        try:
+            yield
+        finally:
+            with state.lock:
+                state.in_flight -= 1
+            state.slots.release()
+
+    def stats(self):
+        state = self._state()
+        with state.lock:
+            stats = dict(state.counters, verifications_in_flight=state.in_flight,
+                         verifications_peak=state.peak, verify_concurrency=state.concurrency)
+        stats['store'] = 'sqlite' if isinstance(state.store, SQLiteStore) else 'memory'
+        return stats
@@ -0,0 +1,90 @@
+import time
+from flask import current_app
+from itsdangerous import URLSafeTimedSerializer, TimestampSigner, BadData
+from itsdangerous import TimedJSONWebSignatureSerializer as LegacySerializer  # tokens issued before this module
+
+
+# ----- Signed tokens for account confirmation, password reset and email change -----
+# One URLSafeTimedSerializer per purpose and app, each with its own salt, so a
+# reset token never verifies as a confirmation token. The payload keeps the old
+# key names ({'confirm': id}, {'reset': id}, {'change_email': id, 'new_email': ...})
+# plus 'e' - the lifetime in seconds, checked against the signed timestamp.
+#
+# With PURPLE_TOKEN_ACCEPT_LEGACY tokens made by TimedJSONWebSignatureSerializer
+# are still accepted until they expire.
+PURPOSES = ('confirm', 'reset', 'change_email')
+
+
+class _CachedKeySigner(TimestampSigner):
+    # The serializer makes a new signer for every call, so the derived keys are
+    # kept on the class: (salt, secret key) -> key
+    _derived_keys = {}
+
+    def derive_key(self, secret_key=None):
+        cache_key = (self.salt, secret_key if secret_key is not None else self.secret_keys[-1])
+        key = self._derived_keys.get(cache_key)
+        if key is None:
+            key = self._derived_keys[cache_key] = super().derive_key(secret_key)
+        return key
+
+
+class _Signers:
+    def __init__(self, secret_key):
+        self.secret_key = secret_key
+        self.serializers = {
+            purpose: URLSafeTimedSerializer(secret_key, salt='purple.' + purpose,
+                                            signer=_CachedKeySigner)
+            for purpose in PURPOSES}
+        self.legacy = LegacySerializer(secret_key)
+
+
+class TokenSigner:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PURPLE_TOKEN_MAX_AGE', 7 * 24 * 3600)
+        app.config.setdefault('PURPLE_TOKEN_ACCEPT_LEGACY', True)
+        app.extensions['tokens'] = None  # built on first use, SECRET_KEY may still change
+
+    def _signers(self):
+        app = current_app._get_current_object()
+        signers = app.extensions['tokens']
+        if signers is None or signers.secret_key != app.config['SECRET_KEY']:
+            signers = app.extensions['tokens'] = _Signers(app.config['SECRET_KEY'])
+        return signers
+
+    def generate(self, purpose, payload, expiration=3600):
+        return self._signers().serializers[purpose].dumps(dict(payload, e=expiration))
+
+    # Mints tokens for many users with one signer, e.g. for a bulk password reset
+    def generate_many(self, purpose, user_ids, expiration=3600):
+        serializer = self._signers().serializers[purpose]
+        return {user_id: serializer.dumps({purpose: user_id, 'e': expiration})
+                for user_id in user_ids}
+
+    # Returns the payload, or None for a bad, expired or foreign-purpose token
+    def load(self, purpose, token):
+        signers = self._signers()
+        if isinstance(token, bytes):
+            token = token.decode('utf-8')
+        try:
+            data, issued = signers.serializers[purpose].loads(
+                token, max_age=current_app.config['PURPLE_TOKEN_MAX_AGE'], return_timestamp=True)
+        except BadData:
+            return self._load_legacy(signers, purpose, token)
+        if not isinstance(data, dict) or time.time() - issued.timestamp() > data.pop('e', 0):
+            return None
+        return data
+
+    def _load_legacy(self, signers, purpose, token):
+        if not current_app.config['PURPLE_TOKEN_ACCEPT_LEGACY']:
+            return None
+        try:
+            data = signers.legacy.loads(token)
+        except Exception:  # anything that is not a valid legacy token
+            return None
+        if not isinstance(data, dict) or purpose not in data:
+            return None
+        return data
@@ -6,6 +6,18 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'hard to guess string'
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # SQLite pragmas run on every new connection and the pool of SQLite file
+    # databases: see app/database.py. None - Flask-SQLAlchemy's NullPool
+    SQLALCHEMY_ENGINE_PROFILE = {'foreign_keys': 'ON', 'busy_timeout': 5000}
+    SQLALCHEMY_POOL_OPTIONS = None
+    # GET views (or @read_only) never commit; a session write in one is logged
+    # or, with 'raise', an error: see 'Read-only requests' in app/database.py
+    PURPLE_READ_ONLY_REQUESTS = True
+    PURPLE_READ_ONLY_WRITES = 'log'
+    # Read replicas for GET requests: see app/database.py
+    SQLALCHEMY_REPLICA_URLS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+    PURPLE_REPLICA_STRATEGY = os.environ.get('PURPLE_REPLICA_STRATEGY', 'round_robin')  # or 'least_loaded'
+    PURPLE_READ_YOUR_WRITES = 10  # seconds on the primary after a client's write
     MAIL_SERVER = os.environ.get('MAIL_SERVER', 'localhost')
     MAIL_PORT = int(os.environ.get('MAIL_PORT', '8025'))
     # MAIL_SERVER = os.environ.get('MAIL_SERVER', 'smtp.googlemail.com')
@@ -17,6 +29,73 @@ class Config:
     PURPLE_MAIL_SUBJECT_PREFIX = '[Purple]'
     PURPLE_MAIL_SENDER = 'Purple Admin <purple@example.com>'
     PURPLE_ADMIN = os.environ.get('PURPLE_ADMIN')
+    # Seconds before the in-memory role_id -> permissions table is read again
+    # (roles changed by other processes), see Role in app/models.py
+    PURPLE_PERMISSION_TABLE_TTL = int(os.environ.get('PURPLE_PERMISSION_TABLE_TTL', '30'))
+    # Password hashing: see app/hashing.py. The method includes the iteration count,
+    # raising it re-hashes every password at the next login
+    PURPLE_PASSWORD_METHOD = os.environ.get('PURPLE_PASSWORD_METHOD', 'pbkdf2:sha256:260000')
+    PURPLE_PASSWORD_SALT_LENGTH = 8
+    PURPLE_HASH_POOL_WORKERS = int(os.environ.get('PURPLE_HASH_POOL_WORKERS', '0'))  # 0 - hash inline
+    PURPLE_HASH_TIMEOUT = 10  # seconds
+    # Confirmation/reset/email-change tokens: see app/tokens.py
+    PURPLE_TOKEN_MAX_AGE = 7 * 24 * 3600  # seconds, upper bound for any token
+    PURPLE_TOKEN_ACCEPT_LEGACY = True  # accept tokens of TimedJSONWebSignatureSerializer
+    # Email outbox and its worker pool: see app/email.py
+    PURPLE_MAIL_OUTBOX_SYNC = False
+    PURPLE_MAIL_OUTBOX_WORKERS = int(os.environ.get('PURPLE_MAIL_OUTBOX_WORKERS', '2'))
+    PURPLE_MAIL_OUTBOX_BATCH = 50  # messages per SMTP connection
+    PURPLE_MAIL_OUTBOX_MAX_ATTEMPTS = 5
+    PURPLE_MAIL_OUTBOX_BACKOFF = 30  # seconds before the first retry, doubled every time
+    PURPLE_MAIL_OUTBOX_POLL = 10  # seconds between checks for due retries
+    PURPLE_MAIL_OUTBOX_LEASE = 300  # seconds before a claimed message may be claimed again
+    # Write-behind for User.ping(): see app/last_seen.py
+    PURPLE_LAST_SEEN_WRITE_BEHIND = True
+    PURPLE_LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('PURPLE_LAST_SEEN_FLUSH_INTERVAL', '30'))  # seconds
+    PURPLE_LAST_SEEN_FLUSH_SIZE = int(os.environ.get('PURPLE_LAST_SEEN_FLUSH_SIZE', '500'))  # users
+    PURPLE_LAST_SEEN_GRANULARITY = int(os.environ.get('PURPLE_LAST_SEEN_GRANULARITY', '60'))  # seconds
+    # Identity cache for load_user and username/email lookups: see app/cache.py
+    PURPLE_USER_CACHE_ENABLED = True
+    PURPLE_USER_CACHE_SIZE = int(os.environ.get('PURPLE_USER_CACHE_SIZE', '10000'))  # entries
+    PURPLE_USER_CACHE_TTL = int(os.environ.get('PURPLE_USER_CACHE_TTL', '60'))  # seconds
+    # Bloom filters of taken usernames/emails for the register form: see app/availability.py
+    PURPLE_AVAILABILITY_ERROR_RATE = 0.01
+    PURPLE_AVAILABILITY_SYNC_INTERVAL = 5  # seconds, reads users added by other processes
+    PURPLE_AVAILABILITY_REBUILD_INTERVAL = 3600  # seconds, full rebuild catches renames
+    # Rate limits (burst, seconds to refill it) per IP and per account: see app/throttle.py
+    PURPLE_THROTTLE_ENABLED = True
+    PURPLE_THROTTLE_STORE = os.environ.get('PURPLE_THROTTLE_STORE')  # SQLite file shared by workers, None - per process
+    PURPLE_THROTTLE_LIMITS = {
+        'login': {'ip': (20, 60), 'account': (5, 300)},
+        'reset': {'ip': (5, 3600), 'account': (3, 3600)},
+        'availability': {'ip': (60, 60)},
+    }
+    PURPLE_VERIFY_CONCURRENCY = int(os.environ.get('PURPLE_VERIFY_CONCURRENCY', '4'))  # password checks per worker
+    PURPLE_VERIFY_WAIT = 0.1  # seconds for a free slot before answering 503
+    # Request/SQL/template metrics, /metrics and /admin/metrics: see app/metrics.py
+    PURPLE_METRICS_ENABLED = os.environ.get('PURPLE_METRICS_ENABLED', '1') not in ('0', 'false', 'off')
+    PURPLE_METRICS_TOKEN = os.environ.get('PURPLE_METRICS_TOKEN')  # bearer token for /metrics, None - 404 unless DEBUG
+    # Queries per request over a view's @query_budget(n), or one statement run
+    # again and again: 'log', 'raise' or None. See app/query_budget.py
+    PURPLE_QUERY_BUDGET = None
+    PURPLE_QUERY_REPEAT_LIMIT = 3
+    # Profiles of single requests ('?__profile=1' for admins): see app/profiler.py
+    PURPLE_PROFILER_DIR = os.environ.get('PURPLE_PROFILER_DIR') or os.path.join(basedir, 'profiles')
+    PURPLE_PROFILER_KEEP = 50  # newest files kept
+    PURPLE_PROFILER_SAMPLE_EVERY = int(os.environ.get('PURPLE_PROFILER_SAMPLE_EVERY', '0'))  # 1 in N requests, 0 - off
+    PURPLE_PROFILER_INTERVAL = 0.005  # seconds between stack samples
+    # Rendered 'page_content' of profile pages: see FragmentCache in app/cache.py
+    PURPLE_FRAGMENT_CACHE_ENABLED = True
+    PURPLE_FRAGMENT_CACHE_BYTES = int(os.environ.get('PURPLE_FRAGMENT_CACHE_BYTES', str(16 * 1024 * 1024)))
+    # Compiled templates shared by the workers and loaded before the first
+    # request: see app/templating.py. None - every worker compiles on first use
+    PURPLE_TEMPLATE_CACHE_DIR = os.environ.get('PURPLE_TEMPLATE_CACHE_DIR')
+    PURPLE_TEMPLATE_PREWARM = os.environ.get('PURPLE_TEMPLATE_PREWARM', '0') not in ('0', 'false', 'off')
+    # Admin user directory, /admin/users: see app/directory.py. The counts of
+    # table 'user_counts' are refreshed in the background when older than the
+    # interval (seconds, 0 - only by 'manage.py user-counts')
+    PURPLE_DIRECTORY_PER_PAGE = 50
+    PURPLE_DIRECTORY_COUNTS_INTERVAL = int(os.environ.get('PURPLE_DIRECTORY_COUNTS_INTERVAL', '300'))
 
     # static method is easier to import than regular functions because each function does not need to be separately imported
     # Myclass.staticmethod()
@@ -30,17 +109,55 @@ class Config:
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    PURPLE_QUERY_BUDGET = 'log'
+    PURPLE_READ_ONLY_WRITES = 'raise'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data.sqlite')
 
 
 class TestingConfig(Config):
     TESTING = True
+    WTF_CSRF_ENABLED = False  # forms can be posted by the test client
+    PURPLE_MAIL_OUTBOX_SYNC = True
+    PURPLE_LAST_SEEN_WRITE_BEHIND = False
+    PURPLE_USER_CACHE_ENABLED = False
+    PURPLE_FRAGMENT_CACHE_ENABLED = False
+    PURPLE_QUERY_BUDGET = 'raise'
+    PURPLE_READ_ONLY_WRITES = 'raise'
+    PURPLE_PASSWORD_METHOD = 'pbkdf2:sha256:1000'  # fast hashing profile, never for real passwords
+    PURPLE_DIRECTORY_COUNTS_INTERVAL = 0  # tests call refresh_counts() themselves
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
 
 
 class ProductionConfig(Config):
+    PURPLE_TEMPLATE_CACHE_DIR = os.environ.get('PURPLE_TEMPLATE_CACHE_DIR') or os.path.join(basedir, 'template-cache')
+    PURPLE_TEMPLATE_PREWARM = os.environ.get('PURPLE_TEMPLATE_PREWARM', '1') not in ('0', 'false', 'off')
+    # The web workers of gunicorn_conf.py (CPUs + 1) hash in their request
+    # threads: pbkdf2_hmac releases the GIL, PURPLE_VERIFY_CONCURRENCY caps the
+    # checks per worker. A pool adds WEB_CONCURRENCY x PURPLE_HASH_POOL_WORKERS
+    # processes, forked from threaded workers; if one is wanted, about
+    # max(1, CPUs // WEB_CONCURRENCY) each
+    PURPLE_HASH_POOL_WORKERS = int(os.environ.get('PURPLE_HASH_POOL_WORKERS', '0'))
+    PURPLE_THROTTLE_STORE = os.environ.get('PURPLE_THROTTLE_STORE') or os.path.join(basedir, 'throttle-prod.sqlite')
+    # WAL lets readers run next to the single writer, a writer waits up to
+    # busy_timeout ms for the lock instead of failing with 'database is locked'
+    SQLALCHEMY_ENGINE_PROFILE = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',  # with WAL: durable up to the last checkpoint, no fsync per commit
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,  # negative - KiB, 64 MiB per connection
+        'temp_store': 'MEMORY',
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', '10000')),  # ms
+        'foreign_keys': 'ON',
+    }
+    SQLALCHEMY_POOL_OPTIONS = {
+        'pool_size': int(os.environ.get('SQLALCHEMY_POOL_SIZE', '8')),
+        'max_overflow': 8,
+        'pool_timeout': 30,
+        'pool_pre_ping': True,
+        'pool_recycle': 3600,  # seconds
+    }
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-prod.sqlite')
 
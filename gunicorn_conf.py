@@ -0,0 +1,37 @@
+# ----- gunicorn settings: gunicorn -c gunicorn_conf.py wsgi:app -----
+# wsgi.py builds and warms the app once in the master (preload_app), the hooks
+# below make every worker fork-safe and flush its buffers when it stops: see
+# app/prefork.py. 'kill -HUP <master>' replaces the workers gracefully.
+# 'python wsgi.py' serves with the same settings without gunicorn.
+import os
+
+cpus = os.cpu_count() or 1
+
+bind = os.environ.get('PURPLE_BIND', '127.0.0.1:8000')
+# One worker per core plus one, so a core is busy while a worker waits on
+# SQLite or the network; threads cover the waiting inside a worker. Password
+# hashing is CPU bound and does not get faster with more threads.
+# Processes in all: 1 master + workers x (1 + PURPLE_HASH_POOL_WORKERS); the
+# hashing pool is off by default in production, each worker hashes inline
+# (see ProductionConfig), so that is 1 + cpus + 1.
+workers = int(os.environ.get('WEB_CONCURRENCY', cpus + 1))
+threads = int(os.environ.get('PURPLE_WEB_THREADS', '4'))
+worker_class = 'gthread'
+preload_app = True
+graceful_timeout = int(os.environ.get('PURPLE_GRACEFUL_TIMEOUT', '30'))  # seconds for a stopping worker
+timeout = 60
+keepalive = 5
+# Recycle workers now and then, before_exit() writes out what they buffered
+max_requests = int(os.environ.get('PURPLE_MAX_REQUESTS', '0'))  # 0 - never
+max_requests_jitter = max_requests // 10
+accesslog = os.environ.get('PURPLE_ACCESS_LOG')  # '-' for stdout, None - off
+
+
+def post_fork(server, worker):
+    from app.prefork import after_fork
+    after_fork(server.app.wsgi())
+
+
+def worker_exit(server, worker):
+    from app.prefork import before_exit
+    before_exit(server.app.wsgi())
@@ -1,29 +1,148 @@
 #!/usr/bin/env python
 import os
-from app import create_app, db # from app/__init__.py
-from app.models import User, Role, Permission # from app/models.py
-from flask_script import Manager, Shell
-from flask_migrate import Migrate
+import sys
+from flask_script import Manager, Shell, Command, Option
 
 
-app = create_app(os.getenv('FLASK_CONFIG') or 'default')
-manager = Manager(app)
-migrate = Migrate(app, db)
+# ----- Every command loads only what it needs -----
+# The app is made when the command runs, by app_for_command(): 'test' and
+# 'bench' make their own apps and get an empty one, the data commands get
+# create_app(blueprints=False) without pages, forms, Bootstrap and Moment,
+# everything else ('shell', 'runserver') the whole app. Models and commands'
+# modules are imported inside the commands. Flask-Migrate is only loaded for
+# 'FLASK_APP=manage.py flask db ...', which asks this module for 'app'.
+# tests/bench/bench_import_time.py keeps an eye on the startup time.
+NO_APP_COMMANDS = ('test', 'bench')
+DATA_COMMANDS = ('tokens', 'import-users', 'export-users', 'user-counts')
+
+
+def app_for_command(command):
+    if command in NO_APP_COMMANDS:
+        from flask import Flask
+        return Flask(__name__)
+    from app import create_app
+    return create_app(os.getenv('FLASK_CONFIG') or 'default', blueprints=command not in DATA_COMMANDS)
+
+
+def __getattr__(name):
+    if name == 'app':
+        from flask_migrate import Migrate
+        from app import db
+        app = globals()['app'] = app_for_command(None)
+        Migrate(app, db)
+        return app
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+manager = Manager(lambda: app_for_command(sys.argv[1] if len(sys.argv) > 1 else None))
 
 
 def make_shell_context():
-    return dict(app=app, db=db, User=User, Role=Role, Permission=Permission)
+    from flask import current_app
+    from app import db
+    from app.models import User, Role, Permission
+    return dict(app=current_app._get_current_object(), db=db, User=User, Role=Role, Permission=Permission)
 
 
-@manager.command
-def test():
+@manager.option('-p', '--processes', dest='processes', type=int, default=1, help='test processes')
+def test(processes):
     """Run the unit tests."""
-    import unittest
-    tests = unittest.TestLoader().discover('tests')
-    unittest.TextTestRunner(verbosity=2).run(tests)
+    import sys
+    from tests.run import run
+    sys.exit(run(processes, verbosity=2))
+
+
+@manager.option('-p', '--purpose', dest='purpose', choices=['confirm', 'reset'], default='reset')
+@manager.option('-e', '--expiration', dest='expiration', type=int, default=3600, help='lifetime in seconds')
+@manager.option('user_ids', nargs='+', type=int, help='user ids')
+def tokens(purpose, expiration, user_ids):
+    """Print confirmation or reset tokens for many users."""
+    from app.models import User
+    for user_id, token in User.generate_tokens(purpose, user_ids, expiration).items():
+        print('%d\t%s' % (user_id, token))
+
+
+class ImportUsers(Command):
+    """Import users from a CSV or JSON lines file."""
+
+    option_list = (
+        Option('path', help='CSV or JSONL file'),
+        Option('--format', dest='fmt', choices=['csv', 'jsonl'], help='default: by file extension'),
+        Option('--chunk-size', dest='chunk_size', type=int, default=1000, help='rows per transaction'),
+        Option('--workers', dest='workers', type=int, default=os.cpu_count(), help='hashing processes'),
+        Option('--rejects', dest='rejects', help='reject file, default: <path>.rejects.jsonl'),
+        Option('--checkpoint', dest='checkpoint', help='progress file, default: <path>.progress'),
+    )
+
+    def run(self, path, fmt, chunk_size, workers, rejects, checkpoint):
+        from app.importer import import_users
+        report = import_users(path, fmt, chunk_size=chunk_size, workers=workers,
+                              reject_path=rejects or path + '.rejects.jsonl',
+                              checkpoint_path=checkpoint or path + '.progress', log=print)
+        print('Imported %(inserted)d users, rejected %(rejected)d, skipped %(skipped)d '
+              '(already imported) in %(seconds).1f s: %(rows_per_sec).0f rows/s' % report)
+
+
+class ExportUsers(Command):
+    """Export users as NDJSON or CSV, optionally gzip-compressed."""
+
+    option_list = (
+        Option('--format', dest='fmt', choices=['ndjson', 'csv'], default='ndjson'),
+        Option('--gzip', dest='compress', action='store_true', help='gzip the output'),
+        Option('--since', dest='since', help='only users seen since this ISO date'),
+        Option('-o', '--output', dest='output', help='file name, default: stdout'),
+    )
+
+    def run(self, fmt, compress, since, output):
+        import sys
+        from datetime import datetime
+        from app.exporter import export_users
+        since = datetime.fromisoformat(since) if since else None
+        if output:
+            with open(output, 'wb') as out:
+                written = export_users(out, fmt, compress, since)
+            print('Wrote %d bytes to %s' % (written, output))
+        else:
+            export_users(sys.stdout.buffer, fmt, compress, since)
+
+
+class UserCounts(Command):
+    """Count the users per role and confirmation state for /admin/users."""
+
+    def run(self):
+        from app import directory
+        print('Counted the users in %.2f s' % directory.refresh_counts())
+
+
+class Bench(Command):
+    """Load-test the auth and profile endpoints (tests/bench/load.py)."""
+
+    option_list = (
+        Option('--users', dest='users', type=int, default=200, help='users to seed'),
+        Option('--requests', dest='requests', type=int, default=500),
+        Option('--mix', dest='mix', default='browse', help='browse, auth or profile'),
+        Option('--concurrency', dest='concurrency', type=int, default=4, help='virtual users'),
+        Option('--server', dest='server', action='store_true', help='over HTTP against a werkzeug server'),
+        Option('--server-threads', dest='server_threads', type=int, default=8),
+        Option('--hash-method', dest='hash_method', help='e.g. pbkdf2:sha256:1000'),
+        Option('-o', '--output', dest='output', help='write the result as JSON'),
+        Option('--baseline', dest='baseline', help='JSON of an earlier run, fail on regressions'),
+        Option('--threshold', dest='threshold', type=float, default=0.1, help='allowed relative regression'),
+    )
+
+    def run(self, users, requests, mix, concurrency, server, server_threads, hash_method,
+            output, baseline, threshold):
+        import sys
+        from tests.bench.load import bench
+        sys.exit(bench(users, requests, mix, concurrency, server, server_threads, hash_method,
+                       output, baseline, threshold))
 
 
 manager.add_command("shell", Shell(make_context=make_shell_context))
+manager.add_command('import-users', ImportUsers())
+manager.add_command('export-users', ExportUsers())
+manager.add_command('user-counts', UserCounts())
+manager.add_command('bench', Bench())
 
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,80 @@
+"""canonical email and username
+
+Revision ID: 9d3f5a1c2b84
+Revises: 4c1e8d2f7a90
+Create Date: 2026-10-18 14:02:17.448215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3f5a1c2b84'
+down_revision = '4c1e8d2f7a90'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 5000  # rows per transaction of the backfill
+
+
+def canonical(value):
+    # Same as app.models.canonical(), copied so the migration never changes
+    return value.strip().lower() if value is not None else None
+
+
+users = sa.table('users', sa.column('id', sa.Integer), sa.column('email', sa.String),
+                 sa.column('username', sa.String), sa.column('email_canonical', sa.String),
+                 sa.column('username_canonical', sa.String))
+
+
+def backfill_batch(conn, last_id):
+    rows = conn.execute(sa.select(users.c.id, users.c.email, users.c.username).where(
+        users.c.id > last_id, users.c.email_canonical.is_(None) | users.c.username_canonical.is_(None))
+        .order_by(users.c.id).limit(BATCH_SIZE)).fetchall()
+    if not rows:
+        return None
+    conn.execute(users.update().where(users.c.id == sa.bindparam('row_id')).values(
+        email_canonical=sa.bindparam('email_c'), username_canonical=sa.bindparam('username_c')),
+        [dict(row_id=id, email_c=canonical(email), username_c=canonical(username))
+         for id, email, username in rows])
+    return rows[-1][0]
+
+
+def check_duplicates(conn):
+    for column in ('email_canonical', 'username_canonical'):
+        duplicates = conn.execute(sa.text(
+            'SELECT %s FROM users WHERE %s IS NOT NULL GROUP BY %s HAVING count(*) > 1'
+            % (column, column, column))).scalars().all()
+        if duplicates:
+            raise RuntimeError('users differing only in case, merge them before upgrading: %s = %r'
+                               % (column, duplicates[:20]))
+
+
+def upgrade():
+    op.add_column('users', sa.Column('email_canonical', sa.String(length=64), nullable=True))
+    op.add_column('users', sa.Column('username_canonical', sa.String(length=64), nullable=True))
+    # One short transaction per batch, the app keeps writing between them
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        last_id = 0
+        while last_id is not None:
+            conn.exec_driver_sql('BEGIN')
+            last_id = backfill_batch(conn, last_id)
+            conn.exec_driver_sql('COMMIT')
+    # Rows written by the old code meanwhile, in the migration's own transaction
+    conn = op.get_bind()
+    last_id = 0
+    while last_id is not None:
+        last_id = backfill_batch(conn, last_id)
+    check_duplicates(conn)
+    op.create_index(op.f('ix_users_email_canonical'), 'users', ['email_canonical'], unique=True)
+    op.create_index(op.f('ix_users_username_canonical'), 'users', ['username_canonical'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_users_username_canonical'), table_name='users')
+    op.drop_index(op.f('ix_users_email_canonical'), table_name='users')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('username_canonical')
+        batch_op.drop_column('email_canonical')
@@ -0,0 +1,45 @@
+"""user directory indexes and counts
+
+Revision ID: e5b7c3d9a1f6
+Revises: 9d3f5a1c2b84
+Create Date: 2026-10-18 16:41:05.117392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b7c3d9a1f6'
+down_revision = '9d3f5a1c2b84'
+branch_labels = None
+depends_on = None
+
+# Keyset pages of /admin/users, see app/directory.py
+INDEXES = {
+    'ix_users_member_since_id': ['member_since', 'id'],
+    'ix_users_role_id_member_since_id': ['role_id', 'member_since', 'id'],
+    'ix_users_role_id_username_canonical': ['role_id', 'username_canonical'],
+}
+
+
+def upgrade():
+    op.create_table('user_counts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('role_id', sa.Integer(), nullable=True),
+    sa.Column('confirmed', sa.Boolean(), nullable=True),
+    sa.Column('users', sa.Integer(), nullable=True),
+    sa.Column('refreshed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    for name, columns in INDEXES.items():
+        op.create_index(name, 'users', columns, unique=False)
+    # First counts, the app refreshes them from now on
+    op.execute('INSERT INTO user_counts (role_id, confirmed, users, refreshed_at) '
+               'SELECT role_id, confirmed, count(*), CURRENT_TIMESTAMP FROM users GROUP BY role_id, confirmed')
+
+
+def downgrade():
+    for name in reversed(list(INDEXES)):
+        op.drop_index(name, table_name='users')
+    op.drop_table('user_counts')
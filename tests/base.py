@@ -0,0 +1,108 @@
+import sqlite3
+import threading
+import unittest
+from unittest import mock
+from sqlalchemy.pool import StaticPool
+from app import create_app, db
+from app.models import Role
+from config import config, TestingConfig
+
+
+# ----- One in-memory database per test process -----
+# Every engine of every test app gets the same sqlite3 connection (StaticPool
+# and a creator), so the schema and the roles are created once per process
+# instead of create_all()/drop_all() on data-test.sqlite around every test.
+#
+# A test runs inside SAVEPOINT 'test'. While it runs, commit() and rollback()
+# of the connection only end the savepoint 'tx' nested in it: the application,
+# the outbox and the last_seen flush commit as usual (whatever engine.begin()
+# or session they use) and tearDown() rolls everything back with
+# ROLLBACK TO test. Nothing is written to disk, so test processes can run in
+# parallel (see tests/run.py).
+#
+# Tests with threads or processes of their own that use the database, replicas
+# or pragmas of a file database stay on plain unittest.TestCase.
+class SavepointConnection:
+    def __init__(self):
+        # isolation_level=None: sqlite3 never starts or ends a transaction itself
+        self._conn = sqlite3.connect(':memory:', check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        self.in_test = False
+        self.schema = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def begin_test(self):
+        with self._lock:
+            self._conn.execute('SAVEPOINT test')
+            self._conn.execute('SAVEPOINT tx')
+            self.in_test = True
+
+    def end_test(self):
+        with self._lock:
+            self.in_test = False
+            self._conn.execute('ROLLBACK TO test')
+            self._conn.execute('RELEASE test')
+
+    def commit(self):
+        with self._lock:
+            if self.in_test:
+                self._conn.execute('RELEASE tx')
+                self._conn.execute('SAVEPOINT tx')
+            elif self._conn.in_transaction:
+                self._conn.commit()
+
+    def rollback(self):
+        with self._lock:
+            if self.in_test:
+                self._conn.execute('ROLLBACK TO tx')
+            elif self._conn.in_transaction:
+                self._conn.rollback()
+
+    def close(self):
+        pass  # engines come and go with the apps, the database stays
+
+
+connection = SavepointConnection()
+
+
+class MemoryTestingConfig(TestingConfig):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_ENGINE_OPTIONS = {'creator': lambda: connection, 'poolclass': StaticPool}
+
+
+config['testing-memory'] = MemoryTestingConfig
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        if not connection.schema:
+            self.create_schema()
+        self.app = create_app('testing-memory')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        connection.begin_test()
+
+    def tearDown(self):
+        db.session.remove()
+        connection.end_test()
+        self.app_context.pop()
+
+    @staticmethod
+    def create_schema():
+        app = create_app('testing-memory')
+        with app.app_context():
+            db.create_all()
+            Role.insert_roles()
+            db.session.remove()
+        connection.schema = True
+
+
+# ----- A database file of its own -----
+# For the tests on plain unittest.TestCase: the app is made on a file in the
+# test's temporary directory, so create_all()/drop_all() never touch the
+# tracked data-test.sqlite, with or without tests/run.py.
+def file_app(path, **kwargs):
+    with mock.patch.object(TestingConfig, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///' + path):
+        return create_app('testing', **kwargs)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# ----- Benchmark: pages of /admin/users at depth, keyset vs OFFSET -----
+# Seeds a SQLite file with 1M users (Core executemany, several roles, a fifth
+# not confirmed, a few without member_since) and the indexes of the
+# directory. From the first page to one near the end (page 11900 of 50 users
+# at 1M) it times the keyset query of app/directory.py against the same page
+# fetched with OFFSET, without a filter, filtered by role and confirmation
+# state and by confirmation state alone. Both run on a fresh session and a
+# warm page cache; the cursor of the keyset page is made from the previous
+# page's last row beforehand. Then the count shown above the
+# page: COUNT(*) with the filter against a read of 'user_counts', and the
+# time refresh_counts() takes to rebuild that table. Last, what the indexes
+# cost the writes: 10000 more users inserted (one transaction per 100) and
+# 'confirmed' set on 10000 users one UPDATE at a time.
+#
+#   (venv) $ python -m tests.bench.bench_directory [users]
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+from app import db, directory
+from app.directory import _segments, encode_cursor
+from app.models import Role, User
+from tests.bench.load import make_app
+
+PER_PAGE = 50
+
+
+def seed(users, batch=20000):
+    db.create_all()
+    Role.insert_roles()
+    roles = {role.name: role.id for role in Role.query.all()}
+    table = User.__table__
+    rng = random.Random(25)
+    start = datetime(2015, 1, 1)
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql('PRAGMA synchronous = OFF')
+        for first in range(0, users, batch):
+            rows = []
+            for i in range(first, min(first + batch, users)):
+                role = rng.random()
+                rows.append(dict(
+                    email='user%d@example.com' % i, email_canonical='user%d@example.com' % i,
+                    username='User%07d' % rng.randrange(10 ** 7) + str(i), password_hash='x',
+                    role_id=roles['User'] if role < 0.9 else roles['Moderator'] if role < 0.99 else roles['Administrator'],
+                    confirmed=rng.random() < 0.8,
+                    member_since=None if i < users // 100 else start + timedelta(seconds=i * 200 + rng.randrange(100))))
+                rows[-1]['username_canonical'] = rows[-1]['username'].lower()
+            conn.execute(table.insert(), rows)
+    db.session.execute(db.text('ANALYZE'))
+    db.session.commit()
+
+
+def _timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        db.session.remove()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def _base_query(role, confirmed):
+    query = role.users if role is not None else User.query
+    return query.filter(User.confirmed == confirmed) if confirmed is not None else query
+
+
+def measure_depth(page_number, role_id, confirmed, repeat):
+    role = Role.query.get(role_id) if role_id else None
+    condition, columns, descending, _ = _segments('joined')[0]
+    ordered = _base_query(role, confirmed).filter(condition) \
+        .order_by(*[c.desc() if descending else c for c in columns])
+    offset = (page_number - 1) * PER_PAGE
+    cursor = None
+    if offset:
+        last = ordered.offset(offset - 1).first()
+        cursor = encode_cursor(0, [getattr(last, c.key) for c in columns])
+
+    def keyset():
+        r = Role.query.get(role_id) if role_id else None
+        assert len(directory.page(r, confirmed, 'joined', cursor, PER_PAGE)['users']) == PER_PAGE
+
+    def with_offset():
+        r = Role.query.get(role_id) if role_id else None
+        query = _base_query(r, confirmed).filter(condition).order_by(*[c.desc() if descending else c for c in columns])
+        assert len(query.offset(offset).limit(PER_PAGE).all()) == PER_PAGE
+
+    return _timed(keyset, repeat), _timed(with_offset, repeat)
+
+
+def measure_writes(users, inserts=10000, updates=10000):
+    table = User.__table__
+    user_role = Role.query.filter_by(name='User').first().id
+    start = time.perf_counter()
+    for first in range(0, inserts, 100):
+        with db.engine.begin() as conn:
+            conn.execute(table.insert(), [dict(
+                email='new%d@example.com' % i, email_canonical='new%d@example.com' % i,
+                username='New%07d' % i, username_canonical='new%07d' % i, password_hash='x',
+                role_id=user_role, confirmed=False, member_since=datetime.utcnow()) for i in range(first, first + 100)])
+    insert_ms = (time.perf_counter() - start) * 1000
+    ids = random.Random(26).sample(range(1, users + 1), updates)
+    start = time.perf_counter()
+    with db.engine.begin() as conn:
+        for user_id in ids:
+            conn.execute(table.update().where(table.c.id == user_id).values(confirmed=True))
+    update_ms = (time.perf_counter() - start) * 1000
+    return insert_ms, update_ms
+
+
+def run(users=1000000, repeat=5):
+    def depths(share):  # share: about how many of the users the filter keeps
+        deepest = int(users * share * 0.85) // PER_PAGE
+        return sorted(d for d in {1, 10, 100, 1000, deepest // 4, deepest // 2, deepest} if 0 < d <= deepest)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        app = make_app(os.path.join(tmpdir, 'bench.sqlite'))
+        app.config['PURPLE_DIRECTORY_COUNTS_INTERVAL'] = 0
+        with app.app_context():
+            start = time.perf_counter()
+            seed(users)
+            seed_seconds = time.perf_counter() - start
+            user_role = Role.query.filter_by(name='User').first().id
+            filters = {'all users': (None, None, 0.7), 'role User, confirmed': (user_role, True, 0.7),
+                       'not confirmed': (None, False, 0.2)}
+            pages = {}
+            for name, (role_id, confirmed, share) in filters.items():
+                pages[name] = [(depth,) + measure_depth(depth, role_id, confirmed, repeat)
+                               for depth in depths(share)]
+            refresh_ms = directory.refresh_counts() * 1000
+            counts = {}
+            for name, (role_id, confirmed, _) in filters.items():
+                query = select(func.count()).select_from(_base_query(
+                    Role.query.get(role_id) if role_id else None, confirmed).subquery())
+                counts[name] = (_timed(lambda: db.session.execute(query).scalar(), repeat),
+                                _timed(lambda: directory.count(role_id, confirmed), repeat))
+            db.session.remove()
+            writes = measure_writes(users)
+        return {'users': users, 'seed_seconds': seed_seconds, 'pages': pages, 'counts': counts,
+                'refresh_ms': refresh_ms, 'writes': writes,
+                'indexes': sorted(index.name for index in User.__table__.indexes)}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    result = run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
+    print('%d users, seeded in %.0f s, %d per page, best of 5' % (result['users'], result['seed_seconds'], PER_PAGE))
+    for name, rows in result['pages'].items():
+        print('\n%s' % name)
+        print('  %8s %12s %12s' % ('page', 'keyset ms', 'OFFSET ms'))
+        for depth, keyset, offset in rows:
+            print('  %8d %12.2f %12.2f' % (depth, keyset, offset))
+    print('\n%-24s %12s %12s' % ('count', 'COUNT(*) ms', 'counts ms'))
+    for name, (count_ms, table_ms) in result['counts'].items():
+        print('%-24s %12.2f %12.2f' % (name, count_ms, table_ms))
+    print('refresh_counts(): %.0f ms' % result['refresh_ms'])
+    print('\n%d indexes on users: %s' % (len(result['indexes']), ', '.join(result['indexes'])))
+    print('10000 inserts: %.0f ms, 10000 updates of confirmed: %.0f ms' % result['writes'])
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# ----- Benchmark: time to the first responses of a fresh worker -----
+# Every run is a new interpreter, like a worker after a deploy or a recycle:
+# it imports the app, calls create_app() and fetches the pages a visitor sees
+# first (index, login, register, a profile) once each. Reported per setting,
+# median of the runs: create_app(), the first response, the four pages, and
+# create_app() plus the pages, i.e. the time before the fourth visitor has
+# an answer. 'bytecode cache (warm)' is a worker started after another one
+# filled PURPLE_TEMPLATE_CACHE_DIR.
+#
+#   (venv) $ python -m tests.bench.bench_first_response [runs]
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PAGES = ('/', '/auth/login', '/auth/register', '/user/bench1')
+SETTINGS = (
+    ('lazy', {}),
+    ('prewarm', {'PURPLE_TEMPLATE_PREWARM': '1'}),
+    ('bytecode cache (cold)', {'PURPLE_TEMPLATE_CACHE_DIR': 'cache', 'PURPLE_TEMPLATE_PREWARM': '1', 'fresh': True}),
+    ('bytecode cache (warm)', {'PURPLE_TEMPLATE_CACHE_DIR': 'cache', 'PURPLE_TEMPLATE_PREWARM': '1'}),
+    ('cache, no prewarm', {'PURPLE_TEMPLATE_CACHE_DIR': 'cache'}),
+)
+
+
+def child():
+    from app import create_app
+    start = time.perf_counter()
+    app = create_app('testing')
+    app.config.update(PURPLE_QUERY_BUDGET=None, PURPLE_THROTTLE_ENABLED=False)
+    created = time.perf_counter()
+    client = app.test_client()
+    times = []
+    for path in PAGES:
+        t = time.perf_counter()
+        assert client.get(path).status_code == 200, path
+        times.append(time.perf_counter() - t)
+    json.dump({'create_app': created - start, 'first': times[0], 'pages': sum(times),
+               'total': time.perf_counter() - start}, sys.stdout)
+
+
+def seed(db_path):
+    from app import db
+    from tests.bench.load import make_app, seed
+    app = make_app(db_path)
+    with app.app_context():
+        seed(10)
+        db.session.remove()
+        db.engine.dispose()
+
+
+def run(runs=5):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(tmpdir, 'bench.sqlite')
+        seed(db_path)
+        results = {}
+        for name, setting in SETTINGS:
+            samples = []
+            for _ in range(runs):
+                env = dict(os.environ, TEST_DATABASE_URL='sqlite:///' + db_path)
+                env.pop('PURPLE_TEMPLATE_CACHE_DIR', None)
+                env.pop('PURPLE_TEMPLATE_PREWARM', None)
+                if 'PURPLE_TEMPLATE_CACHE_DIR' in setting:
+                    directory = os.path.join(tmpdir, setting['PURPLE_TEMPLATE_CACHE_DIR'])
+                    if setting.get('fresh'):
+                        shutil.rmtree(directory, ignore_errors=True)
+                    env['PURPLE_TEMPLATE_CACHE_DIR'] = directory
+                if 'PURPLE_TEMPLATE_PREWARM' in setting:
+                    env['PURPLE_TEMPLATE_PREWARM'] = setting['PURPLE_TEMPLATE_PREWARM']
+                out = subprocess.run([sys.executable, '-m', 'tests.bench.bench_first_response', '--child'],
+                                     env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+                samples.append(json.loads(out))
+            results[name] = {key: statistics.median(s[key] for s in samples) for key in samples[0]}
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--child']:
+        child()
+        sys.exit(0)
+    result = run(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
+    print('%-22s %14s %14s %12s %12s' % ('templates', 'create_app ms', 'first resp ms', '4 pages ms', 'total ms'))
+    for name, r in result.items():
+        print('%-22s %14.1f %14.1f %12.1f %12.1f' % (name, r['create_app'] * 1000, r['first'] * 1000,
+                                                     r['pages'] * 1000, r['total'] * 1000))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# ----- Benchmark: password checks inline vs in the hashing process pool -----
+# CLIENTS threads log in concurrently (User.verify_password) while a heartbeat
+# thread measures how long a trivial request would wait meanwhile.
+#
+#   (venv) $ python -m tests.bench.bench_hashing [logins] [clients]
+import os
+import sys
+import threading
+import time
+from app import create_app, password_hasher
+from app.hashing import PasswordHasher
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def run_once(workers, logins, clients):
+    app = create_app('testing')
+    app.config.update(PURPLE_HASH_POOL_WORKERS=workers,
+                      PURPLE_PASSWORD_METHOD='pbkdf2:sha256:260000')
+    PasswordHasher().init_app(app)
+    latencies, heartbeats = [], []
+    done = threading.Event()
+    with app.app_context():
+        pwhash = password_hasher.hash('cat')
+        password_hasher.verify(pwhash, 'cat')  # start the pool processes
+
+    def client(count):
+        with app.app_context():
+            for _ in range(count):
+                start = time.perf_counter()
+                password_hasher.verify(pwhash, 'cat')
+                latencies.append(time.perf_counter() - start)
+
+    def heartbeat():
+        while not done.is_set():
+            start = time.perf_counter()
+            time.sleep(0.001)
+            heartbeats.append(time.perf_counter() - start - 0.001)
+
+    threads = [threading.Thread(target=client, args=[logins // clients]) for _ in range(clients)]
+    beat = threading.Thread(target=heartbeat)
+    beat.start()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    beat.join()
+    with app.app_context():
+        password_hasher.shutdown()
+    return {
+        'workers': workers,
+        'logins_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'heartbeat_p99_ms': percentile(heartbeats, 99) * 1000,
+    }
+
+
+def run(logins=64, clients=8):
+    workers = os.cpu_count() or 1
+    return {'inline': run_once(0, logins, clients), 'pool': run_once(workers, logins, clients)}
+
+
+if __name__ == '__main__':
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    for name, result in run(logins, clients).items():
+        print('%-6s (%d pool workers): %6.1f logins/s, p50 %7.1f ms, p99 %7.1f ms, '
+              'heartbeat p99 %6.1f ms' % (name, result['workers'], result['logins_per_sec'],
+                                          result['p50_ms'], result['p99_ms'],
+                                          result['heartbeat_p99_ms']))
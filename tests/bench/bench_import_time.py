@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# ----- Benchmark: startup import time against tests/bench/import_budget.json -----
+# Each scenario runs in a new interpreter with '-X importtime': importing the
+# app, create_app(blueprints=False) as the data commands of manage.py use it,
+# and the whole app of a web worker. Reported: the import time of the
+# top-level imports and the wall clock time of the scenario (median of the
+# runs) and the number of modules loaded.
+#
+# The budget file is tracked in the repo. Per scenario it has 'import_ms', the
+# most the imports may take on the reference machine (1 CPU, CPython 3.11),
+# and 'forbidden', modules that must not be loaded at all (checked by
+# tests/test_startup.py too). --check fails on a scenario over its budget,
+# --update writes the measured times plus 25% as the new budgets.
+#
+#   (venv) $ python -m tests.bench.bench_import_time [--runs N] [--check | --update]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BUDGET = os.path.join(os.path.dirname(__file__), 'import_budget.json')
+SCENARIOS = {
+    'import app': 'import app',
+    'create_app cli': "from app import create_app; create_app('testing', blueprints=False)",
+    'create_app web': "from app import create_app; create_app('testing')",
+}
+CHILD = '''import time
+start = time.perf_counter()
+%s
+wall = time.perf_counter() - start
+import json, sys
+json.dump({'wall': wall, 'modules': sorted(sys.modules)}, sys.stdout)
+'''
+
+
+def _import_ms(stderr):
+    # 'import time: self [us] | cumulative | name', nested imports are indented
+    total = 0
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            fields = line.split('|')
+            if fields[1].strip().isdigit() and not fields[2][1:].startswith(' '):
+                total += int(fields[1])
+    return total / 1000
+
+
+def run_scenario(code):
+    # An in-memory database: create_app() finds no tables and carries on
+    env = dict(os.environ, TEST_DATABASE_URL='sqlite://')
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD % code], env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    result = json.loads(proc.stdout)
+    return {'import_ms': _import_ms(proc.stderr), 'wall_ms': result['wall'] * 1000, 'modules': result['modules']}
+
+
+def measure(runs=5, scenarios=None):
+    results = {}
+    for name in scenarios or SCENARIOS:
+        samples = [run_scenario(SCENARIOS[name]) for _ in range(runs)]
+        results[name] = {'import_ms': statistics.median(s['import_ms'] for s in samples),
+                         'wall_ms': statistics.median(s['wall_ms'] for s in samples),
+                         'modules': samples[-1]['modules']}
+    return results
+
+
+def load_budget(path=BUDGET):
+    with open(path) as f:
+        return json.load(f)
+
+
+def forbidden_loaded(modules, forbidden):
+    return sorted(m for m in modules if any(m == f or m.startswith(f + '.') for f in forbidden))
+
+
+def check(results, budget, times=True):
+    problems = []
+    for name, result in results.items():
+        limits = budget[name]
+        loaded = forbidden_loaded(result['modules'], limits.get('forbidden', ()))
+        if loaded:
+            problems.append('%s: loads %s' % (name, ', '.join(loaded)))
+        if times and result['import_ms'] > limits['import_ms']:
+            problems.append('%s: imports took %.0f ms, budget %d ms' % (name, result['import_ms'], limits['import_ms']))
+    return problems
+
+
+def update(results, budget, path=BUDGET):
+    for name, result in results.items():
+        budget.setdefault(name, {'forbidden': []})['import_ms'] = int(result['import_ms'] * 1.25 + 0.5)
+    with open(path, 'w') as f:
+        json.dump(budget, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure startup import time.')
+    parser.add_argument('--runs', type=int, default=5)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--check', action='store_true', help='fail on a scenario over its budget')
+    group.add_argument('--update', action='store_true', help='write the measured times as new budgets')
+    args = parser.parse_args(argv)
+    budget = load_budget()
+    results = measure(args.runs)
+    print('%-16s %10s %10s %8s %10s' % ('scenario', 'import ms', 'wall ms', 'modules', 'budget ms'))
+    for name, r in results.items():
+        print('%-16s %10.1f %10.1f %8d %10s' % (name, r['import_ms'], r['wall_ms'], len(r['modules']),
+                                                budget.get(name, {}).get('import_ms', '-')))
+    if args.update:
+        update(results, budget)
+        return 0
+    problems = check(results, budget)
+    for problem in problems:
+        print(problem)
+    return 1 if args.check and problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# ----- Benchmark: one Thread + SMTP connection per message vs the outbox pool -----
+# Both paths send to a local SMTP sink (tests/bench/smtp_sink.py).
+#
+#   (venv) $ python -m tests.bench.bench_outbox [messages]
+import os
+import sys
+import tempfile
+import threading
+import time
+from flask_mail import Message
+from app import create_app, db, mail
+from app.models import OutboxMessage
+from .smtp_sink import SMTPSink
+
+
+def make_app(db_path, port, workers):
+    app = create_app('testing')
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + db_path,
+                      MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_SUPPRESS_SEND=False,
+                      PURPLE_MAIL_OUTBOX_SYNC=False, PURPLE_MAIL_OUTBOX_WORKERS=workers)
+    mail.init_app(app)  # pick up the sink settings
+    return app
+
+
+def legacy(app, count):
+    # send_email() before the outbox: a new Thread and connection per message
+    def send(msg):
+        with app.app_context():
+            mail.send(msg)
+
+    start = time.perf_counter()
+    threads = []
+    for i in range(count):
+        msg = Message('bench %d' % i, sender='bench@example.com', recipients=['to@example.com'])
+        msg.body = 'hello'
+        thread = threading.Thread(target=send, args=[msg])
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def pooled(app, count):
+    with app.app_context():
+        db.session.bulk_insert_mappings(OutboxMessage, [
+            dict(recipient='to@example.com', sender='bench@example.com', subject='bench %d' % i,
+                 body='hello', html=None, status='pending', attempts=0)
+            for i in range(count)])
+        db.session.commit()
+        pool = app.extensions['outbox']
+        start = time.perf_counter()
+        threads = [threading.Thread(target=pool.drain) for _ in range(pool.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return elapsed, pool.stats()
+
+
+def run(count=500, workers=4):
+    sink = SMTPSink().start()
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(os.path.join(tmp, 'bench.sqlite'), sink.port, workers)
+        with app.app_context():
+            db.create_all()
+        legacy_time = legacy(app, count)
+        legacy_connections = sink.connections
+        pooled_time, stats = pooled(app, count)
+    sink.stop()
+    return {
+        'messages': count,
+        'legacy_msgs_per_sec': count / legacy_time,
+        'legacy_connections': legacy_connections,
+        'outbox_msgs_per_sec': count / pooled_time,
+        'outbox_connections': sink.connections - legacy_connections,
+        'outbox_latency_avg_ms': stats['latency_avg'] * 1000,
+        'outbox_latency_p95_ms': stats['latency_p95'] * 1000,
+        'sink_received': sink.messages,
+    }
+
+
+if __name__ == '__main__':
+    result = run(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
+    print('%d messages to a local SMTP sink' % result['messages'])
+    print('  thread per message: %8.1f msg/s, %d connections'
+          % (result['legacy_msgs_per_sec'], result['legacy_connections']))
+    print('  outbox pool       : %8.1f msg/s, %d connections, send avg %.2f ms, p95 %.2f ms'
+          % (result['outbox_msgs_per_sec'], result['outbox_connections'],
+             result['outbox_latency_avg_ms'], result['outbox_latency_p95_ms']))
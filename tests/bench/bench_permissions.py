@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# ----- Micro-benchmark: User.can() through 'self.role' vs the permission table -----
+# Every iteration starts with a fresh session (as a request does), so the ORM
+# path pays for the lazy load of 'role' and the table path does not.
+#
+#   (venv) $ python -m tests.bench.bench_permissions
+import time
+from app import create_app, db
+from app.models import User, Role, Permission
+
+
+def can_via_relationship(user, permissions):
+    # User.can() before the permission table
+    return user.role is not None and \
+        (user.role.permissions & permissions) == permissions
+
+
+def measure(check, user_id, iterations):
+    elapsed = 0.0
+    for _ in range(iterations):
+        db.session.remove()
+        user = User.query.get(user_id)
+        start = time.perf_counter()
+        check(user, Permission.WRITE_ARTICLES)
+        elapsed += time.perf_counter() - start
+    return elapsed / iterations
+
+
+def run(iterations=2000):
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    with app.app_context():
+        db.create_all()
+        Role.insert_roles()
+        user = User(email='bench@example.com', username='bench', password='cat')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        relationship = measure(can_via_relationship, user_id, iterations)
+        table = measure(lambda u, p: u.can(p), user_id, iterations)
+        db.session.remove()
+    return {
+        'iterations': iterations,
+        'relationship_us': relationship * 1e6,
+        'table_us': table * 1e6,
+        'speedup': relationship / table if table else None,
+    }
+
+
+if __name__ == '__main__':
+    result = run()
+    print('User.can() over %d fresh sessions' % result['iterations'])
+    print('  via self.role       : %8.2f us/call' % result['relationship_us'])
+    print('  via permission table: %8.2f us/call' % result['table_us'])
+    print('  speedup             : %8.1fx' % result['speedup'])
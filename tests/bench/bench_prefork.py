@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# ----- Benchmark: python wsgi.py under load, with a graceful reload -----
+# Seeds users into a SQLite file and starts 'python wsgi.py' (production
+# config, the stdlib preforking server of app/prefork.py) with 1, 2 and the
+# default number of workers (gunicorn_conf.py: CPUs + 1). Logged-in clients
+# fetch profile pages and the index for a few seconds; halfway through the
+# master gets SIGHUP and replaces its workers. Reported per worker count: time
+# from the start of the process to the first answer, requests per second,
+# failed requests (anything but 200, over the reload too), whether the master
+# stopped cleanly on SIGTERM, and how many of the logged-in users have their
+# last_seen in the database afterwards (buffered by the workers, written out
+# by before_exit()).
+#
+#   (venv) $ python -m tests.bench.bench_prefork [seconds]
+import os
+import random
+import re
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from app import db
+from tests.bench.load import HTTPClient, PASSWORD, make_app, seed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class LoggedInClient(HTTPClient):
+    # The production config checks CSRF tokens, the login form carries one
+    def login(self, email):
+        with self.opener.open(self.base_url + '/auth/login', timeout=60) as response:
+            token = CSRF.search(response.read().decode()).group(1)
+        return self.post('/auth/login', {'email': email, 'password': PASSWORD, 'csrf_token': token})
+
+
+def _start(env):
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, 'wsgi.py'], cwd=ROOT, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, universal_newlines=True)
+    base_url = proc.stdout.readline().split()[2].rstrip(',')
+    while True:
+        try:
+            if HTTPClient(base_url).get('/') == 200:
+                break
+        except OSError:
+            time.sleep(0.01)
+    return proc, base_url, time.perf_counter() - start
+
+
+def measure(workers, seconds, clients, users, tmpdir, db_path):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('UPDATE users SET last_seen = NULL')
+    env = dict(os.environ, FLASK_CONFIG='production', DATABASE_URL='sqlite:///' + db_path,
+               PURPLE_BIND='127.0.0.1:0', PURPLE_HASH_POOL_WORKERS='0',
+               PURPLE_TEMPLATE_CACHE_DIR=os.path.join(tmpdir, 'templates'),
+               PURPLE_THROTTLE_STORE=os.path.join(tmpdir, 'throttle-%s.sqlite' % workers))
+    if workers is not None:
+        env['WEB_CONCURRENCY'] = str(workers)
+    proc, base_url, first = _start(env)
+    try:
+        sessions = []
+        for n in range(clients):
+            client = LoggedInClient(base_url)
+            assert client.login('bench%d@example.com' % n) == 302
+            sessions.append(client)
+        counts = {'requests': 0, 'failed': 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+
+        def drive(client, number):
+            rng = random.Random(number)
+            done = failed = 0
+            while time.perf_counter() < deadline:
+                path = '/' if rng.random() < 0.2 else '/user/bench%d' % rng.randrange(users)
+                try:
+                    ok = client.get(path) == 200
+                except OSError:
+                    ok = False
+                done += 1
+                failed += not ok
+            with lock:
+                counts['requests'] += done
+                counts['failed'] += failed
+
+        threads = [threading.Thread(target=drive, args=(client, n)) for n, client in enumerate(sessions)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        time.sleep(seconds / 2)
+        proc.send_signal(signal.SIGHUP)
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        proc.send_signal(signal.SIGTERM)
+        clean = proc.wait(60) == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+    with sqlite3.connect(db_path) as conn:
+        seen = conn.execute("SELECT count(*) FROM users WHERE last_seen IS NOT NULL AND email IN (%s)"
+                            % ','.join("'bench%d@example.com'" % n for n in range(clients))).fetchone()[0]
+    return {'first_ms': first * 1000, 'requests': counts['requests'], 'rps': counts['requests'] / elapsed,
+            'failed': counts['failed'], 'clean_exit': clean, 'last_seen': seen, 'clients': clients}
+
+
+def run(seconds=6, clients=8, users=200):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(tmpdir, 'bench.sqlite')
+        app = make_app(db_path, 'pbkdf2:sha256:1000')
+        with app.app_context():
+            seed(users)
+            db.session.remove()
+            db.engine.dispose()
+        return {'%s workers' % (n or 'default'): measure(n, seconds, clients, users, tmpdir, db_path)
+                for n in (1, 2, None)}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    result = run(int(sys.argv[1]) if len(sys.argv) > 1 else 6)
+    print('%-16s %14s %9s %8s %7s %11s %10s' % ('python wsgi.py', 'first resp ms', 'requests', 'req/s',
+                                                 'failed', 'clean exit', 'last_seen'))
+    for name, r in result.items():
+        print('%-16s %14.0f %9d %8.0f %7d %11s %7d/%d' % (name, r['first_ms'], r['requests'], r['rps'], r['failed'],
+                                                          'yes' if r['clean_exit'] else 'NO', r['last_seen'],
+                                                          r['clients']))
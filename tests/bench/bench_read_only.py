@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# ----- Benchmark: GET throughput with and without read-only requests -----
+# Seeds users into a SQLite file with the production engine profile (WAL,
+# pooled connections) and write-behind last_seen, serves the app from a
+# werkzeug server with a thread pool, and lets logged-in HTTP clients fetch
+# profile pages and the index from several threads. Every request has its own
+# app context, so the teardown commit runs as in production. Reported for
+# PURPLE_READ_ONLY_REQUESTS off and on: requests per second, p95 latency and
+# session commits/rollbacks per request.
+#
+#   (venv) $ python -m tests.bench.bench_read_only
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from sqlalchemy import event
+from app import db
+from config import ProductionConfig
+from tests.bench.load import HTTPClient, PASSWORD, PooledWSGIServer, make_app, percentile, seed
+
+
+def measure(read_only, workers, seconds, users):
+    tmpdir = tempfile.mkdtemp()
+    app = make_app(os.path.join(tmpdir, 'bench.sqlite'), 'pbkdf2:sha256:1000')
+    app.config.update(SQLALCHEMY_ENGINE_PROFILE=ProductionConfig.SQLALCHEMY_ENGINE_PROFILE,
+                      SQLALCHEMY_POOL_OPTIONS=ProductionConfig.SQLALCHEMY_POOL_OPTIONS,
+                      PURPLE_LAST_SEEN_WRITE_BEHIND=True, PURPLE_READ_ONLY_REQUESTS=read_only)
+    httpd = None
+    counts = {'commit': 0, 'rollback': 0}
+    lock = threading.Lock()
+
+    def count(kind):
+        def listener(conn):
+            with lock:
+                counts[kind] += 1
+        return listener
+
+    try:
+        with app.app_context():
+            seed(users)
+            db.session.remove()
+            engine = db.engine
+        httpd = PooledWSGIServer('127.0.0.1', 0, app, workers)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:%d' % httpd.server_port
+        clients = []
+        for n in range(workers):
+            client = HTTPClient(base_url)
+            client.post('/auth/login', {'email': 'bench%d@example.com' % (n % users), 'password': PASSWORD})
+            clients.append(client)
+        event.listen(engine, 'commit', count('commit'))
+        event.listen(engine, 'rollback', count('rollback'))
+        latencies = []
+        deadline = time.perf_counter() + seconds
+
+        def drive(client, number):
+            rng = random.Random(number)
+            mine = []
+            while time.perf_counter() < deadline:
+                path = '/' if rng.random() < 0.2 else '/user/bench%d' % rng.randrange(users)
+                start = time.perf_counter()
+                status = client.get(path)
+                mine.append(time.perf_counter() - start)
+                assert status == 200, (path, status)
+            with lock:
+                latencies.extend(mine)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=drive, args=(client, n)) for n, client in enumerate(clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.pool.shutdown()
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        shutil.rmtree(tmpdir)
+    requests = len(latencies)
+    return {'requests': requests, 'rps': requests / elapsed, 'p95_ms': percentile(latencies, 95) * 1000,
+            'commits': counts['commit'] / requests, 'rollbacks': counts['rollback'] / requests}
+
+
+def run(workers=8, seconds=5, users=200):
+    return {name: measure(read_only, workers, seconds, users)
+            for name, read_only in (('commit', False), ('read-only', True))}
+
+
+if __name__ == '__main__':
+    result = run()
+    print('%-10s %9s %9s %9s %12s %14s' % ('GETs', 'requests', 'req/s', 'p95 ms', 'commits/req', 'rollbacks/req'))
+    for name, r in result.items():
+        print('%-10s %9d %9.0f %9.1f %12.2f %14.2f' % (name, r['requests'], r['rps'], r['p95_ms'],
+                                                      r['commits'], r['rollbacks']))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# ----- Benchmark: concurrent reads and writes on a SQLite file, default vs production profile -----
+# Reader threads load users by id, writer threads update 'last_seen' and commit,
+# each operation in its own session as a request would. Reported: operations
+# per second and 'database is locked' errors for both engine profiles.
+#
+#   (venv) $ python -m tests.bench.bench_sqlite_profile
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import exc
+from app import create_app, db, password_hasher
+from app.models import User, Role
+from config import ProductionConfig
+
+PROFILES = {
+    'default': ({}, None),  # Flask-SQLAlchemy defaults: rollback journal, NullPool
+    'production': (ProductionConfig.SQLALCHEMY_ENGINE_PROFILE, ProductionConfig.SQLALCHEMY_POOL_OPTIONS),
+}
+
+
+def _seed(users):
+    db.create_all()
+    Role.insert_roles()
+    role_id = Role.query.filter_by(default=True).first().id
+    pwhash = password_hasher.hash('cat')
+    db.session.execute(User.__table__.insert(), [
+        dict(email='u%d@example.com' % i, username='u%d' % i, email_canonical='u%d@example.com' % i,
+             username_canonical='u%d' % i, password_hash=pwhash, role_id=role_id)
+        for i in range(users)])
+    db.session.commit()
+
+
+def _worker(app, write, users, deadline, counts, lock):
+    done = errors = 0
+    with app.app_context():
+        while time.perf_counter() < deadline:
+            user_id = random.randint(1, users)
+            try:
+                if write:
+                    User.query.filter_by(id=user_id).update({'last_seen': datetime.utcnow()})
+                    db.session.commit()
+                else:
+                    User.query.get(user_id).username
+                done += 1
+            except exc.OperationalError:
+                db.session.rollback()
+                errors += 1
+            finally:
+                db.session.remove()
+    with lock:
+        counts['ops'] += done
+        counts['errors'] += errors
+
+
+def measure(profile, pool_options, readers, writers, seconds, users):
+    tmpdir = tempfile.mkdtemp()
+    app = create_app('testing')
+    app.config['SQLALCHEMY_ENGINE_PROFILE'] = profile
+    app.config['SQLALCHEMY_POOL_OPTIONS'] = pool_options
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmpdir, 'bench.sqlite')
+    try:
+        with app.app_context():
+            _seed(users)
+            db.session.remove()
+        results = {'read': {'ops': 0, 'errors': 0}, 'write': {'ops': 0, 'errors': 0}}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+        threads = [threading.Thread(target=_worker, args=(app, False, users, deadline, results['read'], lock))
+                   for _ in range(readers)]
+        threads += [threading.Thread(target=_worker, args=(app, True, users, deadline, results['write'], lock))
+                    for _ in range(writers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with app.app_context():
+            db.engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+    return {kind: dict(r, per_sec=r['ops'] / seconds) for kind, r in results.items()}
+
+
+def run(readers=8, writers=4, seconds=5, users=1000):
+    return {name: measure(profile, pool_options, readers, writers, seconds, users)
+            for name, (profile, pool_options) in PROFILES.items()}
+
+
+if __name__ == '__main__':
+    result = run()
+    print('%-11s %12s %12s %13s' % ('profile', 'reads/s', 'writes/s', 'lock errors'))
+    for name, r in result.items():
+        print('%-11s %12.0f %12.0f %13d' % (name, r['read']['per_sec'], r['write']['per_sec'],
+                                             r['read']['errors'] + r['write']['errors']))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# ----- Benchmark: tokens signed and verified per second -----
+# 'legacy' builds a TimedJSONWebSignatureSerializer per call as the model did,
+# 'signer' uses the cached per-purpose signers of app/tokens.py.
+#
+#   (venv) $ python -m tests.bench.bench_tokens [count]
+import sys
+import time
+import warnings
+from itsdangerous import TimedJSONWebSignatureSerializer
+from app import create_app, tokens
+
+
+def legacy(secret_key, count):
+    start = time.perf_counter()
+    signed = [TimedJSONWebSignatureSerializer(secret_key, 3600).dumps({'reset': i}) for i in range(count)]
+    sign = time.perf_counter() - start
+    start = time.perf_counter()
+    for token in signed:
+        TimedJSONWebSignatureSerializer(secret_key).loads(token)
+    return sign, time.perf_counter() - start
+
+
+def cached(count):
+    start = time.perf_counter()
+    signed = [tokens.generate('reset', {'reset': i}) for i in range(count)]
+    sign = time.perf_counter() - start
+    start = time.perf_counter()
+    for token in signed:
+        tokens.load('reset', token)
+    return sign, time.perf_counter() - start
+
+
+def bulk(count):
+    start = time.perf_counter()
+    tokens.generate_many('reset', range(count))
+    return time.perf_counter() - start
+
+
+def run(count=10000):
+    warnings.simplefilter('ignore', DeprecationWarning)
+    app = create_app('testing')
+    with app.app_context():
+        old_sign, old_verify = legacy(app.config['SECRET_KEY'], count)
+        new_sign, new_verify = cached(count)
+        bulk_sign = bulk(count)
+    return {
+        'count': count,
+        'legacy_signed_per_sec': count / old_sign,
+        'legacy_verified_per_sec': count / old_verify,
+        'signed_per_sec': count / new_sign,
+        'verified_per_sec': count / new_verify,
+        'bulk_signed_per_sec': count / bulk_sign,
+    }
+
+
+if __name__ == '__main__':
+    result = run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
+    print('%d tokens' % result['count'])
+    print('  legacy : %9.0f signed/s %9.0f verified/s'
+          % (result['legacy_signed_per_sec'], result['legacy_verified_per_sec']))
+    print('  signer : %9.0f signed/s %9.0f verified/s'
+          % (result['signed_per_sec'], result['verified_per_sec']))
+    print('  bulk   : %9.0f signed/s' % result['bulk_signed_per_sec'])
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# ----- Load test of the auth and profile endpoints -----
+# Seeds N users through the model into a temporary SQLite file, then runs a
+# scripted mix of requests from 'concurrency' virtual users, either through the
+# Flask test client (in process) or over HTTP against a werkzeug server with a
+# thread pool (--server). Reported per scenario and in total: throughput,
+# p50/p95/p99 latency and SQL statements per request (per scenario only with
+# the test client, where the request runs in the calling thread).
+#
+# The result is JSON; with a baseline file the run fails when p95, throughput
+# or queries per request got worse by more than the threshold:
+#
+#   (venv) $ python -m tests.bench.load --mix auth -o bench.json
+#   (venv) $ python manage.py bench --baseline bench.json --threshold 0.2
+import argparse
+import http.cookiejar
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+from sqlalchemy import event
+from werkzeug.serving import WSGIRequestHandler
+from app import create_app, db, password_hasher, prefork
+from app.models import User, Role
+
+PASSWORD = 'bench-password'
+MIXES = {
+    'browse': {'profile': 90, 'login': 5, 'register': 3, 'reset': 2},
+    'auth': {'login': 40, 'register': 20, 'change_email': 20, 'reset': 20},
+    'profile': {'profile': 100},
+}
+
+
+# ----- Clients: the same get()/post() -> status code for both modes -----
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        return self.client.get(path).status_code
+
+    def post(self, path, data):
+        return self.client.post(path, data=data).status_code
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None  # a 302 is the answer we measure, not the page behind it
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def _open(self, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(self.base_url + path, body, timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+    def get(self, path):
+        return self._open(path)
+
+    def post(self, path, data):
+        return self._open(path, data)
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log(self, type, message, *args):
+        pass
+
+
+class PooledWSGIServer(prefork.PooledWSGIServer):
+    # Requests are handled by a fixed pool of threads, like a worker of wsgi.py
+    def __init__(self, host, port, app, threads):
+        super().__init__(host, port, app, threads, handler=_QuietHandler)
+
+
+# ----- Scenarios: (virtual user, random) -> (status, expected statuses) -----
+class VirtualUser:
+    def __init__(self, make_client, number, users):
+        self.anonymous = make_client()
+        self.member = make_client()
+        self.number = number
+        self.users = users
+        self.user = number % users
+        self.member.post('/auth/login', {'email': 'bench%d@example.com' % self.user, 'password': PASSWORD})
+
+
+_unique = itertools.count()
+
+
+def login(vu, rng):
+    user = rng.randrange(vu.users)
+    return vu.anonymous.post('/auth/login', {'email': 'bench%d@example.com' % user,
+                                             'password': PASSWORD}), (302,)
+
+
+def register(vu, rng):
+    n = next(_unique)
+    return vu.anonymous.post('/auth/register', {
+        'email': 'new%d-%d@example.com' % (os.getpid(), n), 'username': 'new%d_%d' % (os.getpid(), n),
+        'password': PASSWORD, 'password2': PASSWORD}), (302,)
+
+
+def profile(vu, rng):
+    return vu.anonymous.get('/user/bench%d' % rng.randrange(vu.users)), (200,)
+
+
+def change_email(vu, rng):
+    return vu.member.post('/auth/change_email', {
+        'email': 'changed%d@example.com' % next(_unique), 'password': PASSWORD}), (302,)
+
+
+def reset(vu, rng):
+    return vu.anonymous.post('/auth/reset', {'email': 'bench%d@example.com' % rng.randrange(vu.users)}), (302,)
+
+
+SCENARIOS = {'login': login, 'register': register, 'profile': profile,
+             'change_email': change_email, 'reset': reset}
+
+
+# ----- Setup -----
+def make_app(db_path, hash_method=None):
+    app = create_app('testing')  # TESTING: Flask-Mail only records messages
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + db_path, PURPLE_THROTTLE_ENABLED=False,
+                      PURPLE_QUERY_BUDGET=None)  # queries are counted here; first-use builds would trip budgets
+    if hash_method:
+        app.config['PURPLE_PASSWORD_METHOD'] = hash_method
+    return app
+
+
+def seed(users):
+    db.create_all()
+    Role.insert_roles()
+    pwhash = password_hasher.hash(PASSWORD)  # one hash for all, seeding is not what we measure
+    for start in range(0, users, 1000):
+        db.session.add_all(User(email='bench%d@example.com' % i, username='bench%d' % i,
+                                password_hash=pwhash, confirmed=True)
+                           for i in range(start, min(start + 1000, users)))
+        db.session.commit()
+
+
+class _QueryCounter:
+    def __init__(self, engine):
+        self.local = threading.local()
+        self.total = 0
+        self.lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+        with self.lock:
+            self.total += 1
+
+    def current(self):
+        return getattr(self.local, 'count', 0)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+def _summary(latencies, errors, queries, seconds):
+    return {
+        'requests': len(latencies), 'errors': errors,
+        'throughput_rps': len(latencies) / seconds if seconds else 0.0,
+        'p50_ms': _ms(percentile(latencies, 50)), 'p95_ms': _ms(percentile(latencies, 95)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+        'queries_per_request': queries / len(latencies) if latencies and queries is not None else None,
+    }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+# ----- Run -----
+def run(users=200, requests=500, mix='browse', concurrency=4, server=False, server_threads=8,
+        hash_method=None, seed_value=1):
+    weights = MIXES[mix]
+    tmpdir = tempfile.mkdtemp()
+    app = make_app(os.path.join(tmpdir, 'bench.sqlite'), hash_method)
+    httpd = None
+    try:
+        with app.app_context():
+            seed(users)
+            db.session.remove()
+            counter = _QueryCounter(db.engine)
+        if server:
+            httpd = PooledWSGIServer('127.0.0.1', 0, app, server_threads)
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            base_url = 'http://127.0.0.1:%d' % httpd.server_port
+            make_client = lambda: HTTPClient(base_url)
+        else:
+            make_client = lambda: TestClient(app)
+        vus = [VirtualUser(make_client, n, users) for n in range(concurrency)]
+        samples = {name: [] for name in weights}
+        errors = dict.fromkeys(weights, 0)
+        queries = dict.fromkeys(weights, 0)
+        lock = threading.Lock()
+        names, cumulative = list(weights), list(itertools.accumulate(weights.values()))
+
+        def drive(vu, count):
+            rng = random.Random(seed_value * 1000 + vu.number)
+            for _ in range(count):
+                name = rng.choices(names, cum_weights=cumulative)[0]
+                before = counter.current()
+                start = time.perf_counter()
+                status, expected = SCENARIOS[name](vu, rng)
+                elapsed = time.perf_counter() - start
+                with lock:
+                    samples[name].append(elapsed)
+                    errors[name] += status not in expected
+                    queries[name] += counter.current() - before
+
+        total_before = counter.total
+        start = time.perf_counter()
+        threads = [threading.Thread(target=drive, args=(vu, requests // concurrency + (vu.number < requests % concurrency)))
+                   for vu in vus]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        seconds = time.perf_counter() - start
+        total_queries = counter.total - total_before
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.pool.shutdown()
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        shutil.rmtree(tmpdir)
+
+    scenarios = {name: _summary(samples[name], errors[name], None if server else queries[name], seconds)
+                 for name in weights if samples[name]}
+    return {
+        'meta': {'date': datetime.utcnow().isoformat(), 'python': platform.python_version(),
+                 'mode': 'server' if server else 'test_client', 'mix': mix, 'users': users,
+                 'requests': requests, 'concurrency': concurrency,
+                 'server_threads': server_threads if server else None,
+                 'password_method': app.config['PURPLE_PASSWORD_METHOD']},
+        'scenarios': scenarios,
+        'total': _summary(list(itertools.chain(*samples.values())), sum(errors.values()), total_queries, seconds),
+    }
+
+
+# ----- Regressions against a baseline run -----
+# Throughput is compared in total only, a scenario's share of it depends on the mix
+def compare(baseline, result, threshold=0.1):
+    for key in ('mode', 'mix', 'concurrency'):
+        if baseline['meta'][key] != result['meta'][key]:
+            raise ValueError('baseline was run with %s=%r, this run with %r'
+                             % (key, baseline['meta'][key], result['meta'][key]))
+    regressions = []
+    pairs = [('total', baseline.get('total'), result['total'])]
+    pairs += [(name, baseline.get('scenarios', {}).get(name), r) for name, r in result['scenarios'].items()]
+    for name, old, new in pairs:
+        if not old:
+            continue
+        checks = [('p95_ms', 1), ('queries_per_request', 1)] + [('throughput_rps', -1)] * (name == 'total')
+        for key, worse in checks:
+            if old.get(key) is None or new.get(key) is None or not old[key]:
+                continue
+            change = (new[key] - old[key]) / old[key]
+            if change * worse > threshold:
+                regressions.append('%s %s: %.3f -> %.3f (%+.0f%%)' % (name, key, old[key], new[key], change * 100))
+    return regressions
+
+
+def report(result, out=sys.stdout):
+    meta = result['meta']
+    print('%(mode)s, mix %(mix)s, %(requests)d requests, %(concurrency)d virtual users, %(users)d users'
+          % meta, file=out)
+    print('%-13s %8s %7s %9s %9s %9s %9s %8s' % (
+        'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'), file=out)
+    rows = sorted(result['scenarios'].items()) + [('total', result['total'])]
+    for name, r in rows:
+        queries = '%8.1f' % r['queries_per_request'] if r['queries_per_request'] is not None else '%8s' % '-'
+        print('%-13s %8d %7d %9.1f %9.2f %9.2f %9.2f %s' % (
+            name, r['requests'], r['errors'], r['throughput_rps'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            queries), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of the auth and profile endpoints.')
+    parser.add_argument('--users', type=int, default=200, help='users to seed')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--mix', choices=sorted(MIXES), default='browse')
+    parser.add_argument('--concurrency', type=int, default=4, help='virtual users')
+    parser.add_argument('--server', action='store_true', help='over HTTP against a werkzeug server')
+    parser.add_argument('--server-threads', type=int, default=8)
+    parser.add_argument('--hash-method', help='e.g. pbkdf2:sha256:1000, default: the config value')
+    parser.add_argument('-o', '--output', help='write the result as JSON')
+    parser.add_argument('--baseline', help='JSON of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative regression')
+    args = parser.parse_args(argv)
+    return bench(args.users, args.requests, args.mix, args.concurrency, args.server, args.server_threads,
+                 args.hash_method, args.output, args.baseline, args.threshold)
+
+
+def bench(users, requests, mix, concurrency, server, server_threads, hash_method, output, baseline, threshold):
+    result = run(users, requests, mix, concurrency, server, server_threads, hash_method)
+    report(result)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            try:
+                regressions = compare(json.load(f), result, threshold)
+            except ValueError as e:
+                print('Not comparable: %s' % e)
+                return 2
+        for line in regressions:
+            print('REGRESSION ' + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
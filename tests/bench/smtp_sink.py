@@ -0,0 +1,62 @@
+# ----- Minimal SMTP server that accepts and drops every message -----
+# Only the stdlib is used (smtpd is deprecated and gone in Python 3.12).
+#
+#   sink = SMTPSink(); sink.start()   # sink.port is a free local port
+#   ...
+#   sink.stop(); sink.messages        # number of messages received
+import socketserver
+import threading
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost purple sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                for data in iter(self.rfile.readline, b''):
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                self.server.count()
+                self.reply('250 ok')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:  # EHLO, HELO, MAIL, RCPT, RSET, NOOP
+                self.reply('250 ok')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), _SMTPHandler)
+        self.port = self.server_address[1]
+        self.messages = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.messages += 1
+
+    def verify_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        return True
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,81 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+
+# ----- Test runner, optionally over several processes -----
+#   python -m tests.run                  # like 'manage.py test'
+#   python -m tests.run --processes 4    # modules spread over 4 processes
+# Tests on tests/base.py have an in-memory database per process anyway and
+# the ones on a file make it in a temporary directory (file_app()). Apps made
+# on the default URI still get their own TEST_DATABASE_URL per process, so
+# nothing is shared between the processes.
+def test_modules(start='tests'):
+    names = []
+    for suite in unittest.TestLoader().discover(start, top_level_dir='.'):
+        tests = suite.countTestCases()
+        if tests:
+            module = next(iter(_flatten(suite))).__class__.__module__
+            names.append((module, tests))
+    return names
+
+
+def _flatten(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from _flatten(test)
+        else:
+            yield test
+
+
+def split(modules, processes):
+    # Biggest modules first, each to the group with the fewest tests so far
+    groups = [[] for _ in range(processes)]
+    sizes = [0] * processes
+    for module, tests in sorted(modules, key=lambda item: -item[1]):
+        i = sizes.index(min(sizes))
+        groups[i].append(module)
+        sizes[i] += tests
+    return [group for group in groups if group]
+
+
+def run(processes=1, verbosity=1):
+    start = time.perf_counter()
+    if processes <= 1:
+        result = unittest.TextTestRunner(verbosity=verbosity).run(unittest.TestLoader().discover('tests'))
+        ok = result.wasSuccessful()
+    else:
+        tmpdir = tempfile.mkdtemp(prefix='purple-tests-')
+        try:
+            workers = []
+            for i, group in enumerate(split(test_modules(), processes)):
+                env = dict(os.environ, TEST_DATABASE_URL='sqlite:///' + os.path.join(tmpdir, 'test-%d.sqlite' % i))
+                cmd = [sys.executable, '-m', 'unittest'] + (['-v'] if verbosity > 1 else ['-q']) + group
+                workers.append(subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+            ok = True
+            for worker in workers:
+                output = worker.communicate()[0]
+                sys.stdout.write(output.decode('utf-8', 'replace'))
+                ok = ok and worker.returncode == 0
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    print('%s in %.1f s wall clock, %d process(es)' % ('OK' if ok else 'FAILED', time.perf_counter() - start,
+                                                       max(processes, 1)))
+    return 0 if ok else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the unit tests.')
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('-v', '--verbose', action='store_const', const=2, default=1, dest='verbosity')
+    args = parser.parse_args(argv)
+    return run(args.processes, args.verbosity)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+import unittest
+from sqlalchemy import event
+from app import db, availability, password_hasher
+from app.availability import BloomFilter
+from app.models import User
+from tests.base import DatabaseTestCase
+
+
+class BloomFilterTestCase(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        names = ['user%d@example.com' % i for i in range(1000)]
+        for name in names:
+            bloom.add(name)
+        self.assertTrue(all(name in bloom for name in names))
+
+    def test_error_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('user%d' % i)
+        false_positives = sum('other%d' % i in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)  # ~1% expected
+
+
+class LazyFiltersTestCase(DatabaseTestCase):
+    # create_app() does not read the users, the first check builds the filters
+    def test_built_on_first_check(self):
+        db.session.add(User(email='john@example.com', username='john', password='cat'))
+        db.session.commit()
+        self.assertIsNone(self.app.extensions['availability']['filters'])
+        self.assertTrue(availability.username_taken('john'))
+        self.assertIsNotNone(self.app.extensions['availability']['filters'])
+
+
+class AvailabilityTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(User(email='john@example.com', username='john', password='cat'))
+        db.session.commit()
+        availability.rebuild()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self._count)
+        super().tearDown()
+
+    def _count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_free_name_needs_no_query(self):
+        self.assertFalse(availability.username_taken('susan'))
+        self.assertFalse(availability.email_taken('susan@example.com'))
+        self.assertEqual(self.statements, [])
+
+    def test_taken_name_is_checked_with_exists(self):
+        self.assertTrue(availability.username_taken('john'))
+        self.assertTrue(availability.email_taken('john@example.com'))
+        self.assertEqual(len(self.statements), 2)
+        self.assertIn('EXISTS', self.statements[0])
+
+    def test_new_user_added_on_flush(self):
+        db.session.add(User(email='susan@example.com', username='susan', password='dog'))
+        db.session.commit()
+        self.assertTrue(availability.username_taken('susan'))
+
+    def test_rows_from_elsewhere_are_synced(self):
+        with db.engine.begin() as conn:
+            conn.execute(User.__table__.insert(), dict(
+                email='david@example.com', username='david', email_canonical='david@example.com',
+                username_canonical='david', password_hash=password_hasher.hash('x')))
+        self.assertFalse(availability.username_taken('david'))  # not synced yet
+        self.app.config['PURPLE_AVAILABILITY_SYNC_INTERVAL'] = 0
+        self.assertTrue(availability.username_taken('david'))
+
+    def test_check_availability_endpoint(self):
+        client = self.app.test_client()
+        response = client.get('/auth/check-availability?username=john&email=susan@example.com')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {
+            'username': {'value': 'john', 'available': False},
+            'email': {'value': 'susan@example.com', 'available': True}})
+        self.assertEqual(client.get('/auth/check-availability').status_code, 400)
+
+    def test_register_rejects_taken_username(self):
+        response = self.app.test_client().post('/auth/register', data={
+            'email': 'other@example.com', 'username': 'john',
+            'password': 'cat', 'password2': 'cat'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Username already in use.', response.data)
@@ -0,0 +1,30 @@
+import unittest
+from tests.bench import load
+
+
+class BenchHarnessTestCase(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(load.percentile(values, 50), 50)
+        self.assertEqual(load.percentile(values, 99), 99)
+        self.assertEqual(load.percentile([7], 95), 7)
+        self.assertIsNone(load.percentile([], 50))
+
+    def test_small_run(self):
+        result = load.run(users=5, requests=12, mix='auth', concurrency=2, hash_method='pbkdf2:sha256:1000')
+        self.assertEqual(result['total']['requests'], 12)
+        self.assertEqual(result['total']['errors'], 0)
+        self.assertGreater(result['total']['queries_per_request'], 0)
+
+    def test_compare(self):
+        meta = {'mode': 'test_client', 'mix': 'auth', 'concurrency': 2}
+        baseline = {'meta': meta, 'total': {'p95_ms': 10.0, 'throughput_rps': 100.0, 'queries_per_request': 3.0},
+                    'scenarios': {'login': {'p95_ms': 10.0, 'throughput_rps': 50.0, 'queries_per_request': 2.0}}}
+        result = {'meta': meta, 'total': {'p95_ms': 10.5, 'throughput_rps': 80.0, 'queries_per_request': 3.0},
+                  'scenarios': {'login': {'p95_ms': 10.0, 'throughput_rps': 20.0, 'queries_per_request': 4.0}}}
+        regressions = load.compare(baseline, result, threshold=0.1)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('total throughput_rps'))
+        self.assertTrue(regressions[1].startswith('login queries_per_request'))
+        with self.assertRaises(ValueError):
+            load.compare(dict(baseline, meta=dict(meta, mix='browse')), result)
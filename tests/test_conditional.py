@@ -0,0 +1,85 @@
+import time
+from unittest import mock
+from datetime import datetime
+from flask import template_rendered
+from werkzeug.http import http_date
+from app import db
+from app.models import User, Role
+from tests.base import DatabaseTestCase
+
+
+class ConditionalGetTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        admin_role = Role.query.filter_by(name='Administrator').first()
+        db.session.add_all([
+            User(email='john@example.com', username='john', password='cat', confirmed=True),
+            User(email='admin@example.com', username='admin', password='cat', confirmed=True,
+                 role=admin_role)])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.rendered = []
+        template_rendered.connect(self._rendered, self.app)
+
+    def tearDown(self):
+        template_rendered.disconnect(self._rendered, self.app)
+        super().tearDown()
+
+    def _rendered(self, sender, template, context, **extra):
+        self.rendered.append(template.name)
+
+    # ----- Test 304 for an unchanged profile, without rendering -----
+    def test_profile_not_modified(self):
+        response = self.client.get('/user/john')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertIn('Cookie', response.headers['Vary'])
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        self.rendered = []
+        response = self.client.get('/user/john', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(self.rendered, [])
+
+    # ----- Test that If-Modified-Since alone never gives a stale profile -----
+    def test_profile_if_modified_since(self):
+        response = self.client.get('/user/john')
+        self.assertNotIn('Last-Modified', response.headers)
+        since = http_date(time.time() + 60)  # later than anything on the page
+        u = User.query.filter_by(username='john').first()
+        u.location = 'Paris'
+        db.session.commit()
+        response = self.client.get('/user/john', headers={'If-Modified-Since': since})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Paris', response.data)
+
+    # ----- Test that a profile change renders the page again -----
+    def test_profile_changed(self):
+        etag = self.client.get('/user/john').headers['ETag']
+        u = User.query.filter_by(username='john').first()
+        u.location = 'Paris'
+        db.session.commit()
+        response = self.client.get('/user/john', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Paris', response.data)
+
+    # ----- Test that administrators get their own variant (email is shown) -----
+    def test_admin_variant(self):
+        etag = self.client.get('/user/john').headers['ETag']
+        self.client.post('/auth/login', data={'email': 'admin@example.com', 'password': 'cat'})
+        response = self.client.get('/user/john', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'john@example.com', response.data)
+
+    # ----- Test 304 for the index page within the same minute -----
+    def test_index_not_modified(self):
+        minute = datetime(2022, 7, 20, 9, 2)
+        with mock.patch('app.main.views.current_minute', return_value=minute):
+            etag = self.client.get('/').headers['ETag']
+            self.rendered = []
+            response = self.client.get('/', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(self.rendered, [])
+        with mock.patch('app.main.views.current_minute', return_value=minute.replace(minute=3)):
+            response = self.client.get('/', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
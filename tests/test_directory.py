@@ -0,0 +1,155 @@
+from datetime import datetime, timedelta
+from unittest import mock
+from sqlalchemy import event
+from app import db, directory
+from app.directory import decode_cursor, encode_cursor
+from app.models import Role, User, UserCount
+from tests.base import DatabaseTestCase
+
+
+class DirectoryTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.roles = {role.name: role for role in Role.query.all()}
+        start = datetime(2022, 1, 1)
+        users = []
+        for n in range(12):
+            users.append(User(email='user%d@example.com' % n, username='User%02d' % (11 - n), password='cat',
+                              confirmed=n % 3 != 0, role=self.roles['Moderator' if n % 4 == 0 else 'User'],
+                              member_since=start + timedelta(days=n // 2)))  # pairs joined the same day
+        users.append(User(email='old@example.com', username='old', password='cat', confirmed=True))
+        users.append(User(email='nameless@example.com', password='cat', confirmed=True))
+        users.append(User(email='admin@example.com', username='admin', password='cat', confirmed=True,
+                          role=self.roles['Administrator']))
+        db.session.add_all(users)
+        db.session.commit()
+        User.query.filter_by(email='old@example.com').update({'member_since': None})  # before the profile columns
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def walk(self, **kwargs):
+        pages, after = [], None
+        while True:
+            page = directory.page(after=after, per_page=3, **kwargs)
+            pages.append([user.email for user in page['users']])
+            after = page['next']
+            if after is None:
+                return pages
+
+    def expected(self, sort, role=None, confirmed=None):
+        users = [u for u in User.query.all() if (role is None or u.role_id == role.id) and
+                 (confirmed is None or u.confirmed == confirmed)]
+        if sort == 'joined':
+            dated = sorted((u for u in users if u.member_since), key=lambda u: (u.member_since, u.id), reverse=True)
+            users = dated + sorted((u for u in users if u.member_since is None), key=lambda u: -u.id)
+        else:
+            named = sorted((u for u in users if u.username_canonical), key=lambda u: u.username_canonical)
+            users = named + sorted((u for u in users if u.username_canonical is None), key=lambda u: u.id)
+        return [u.email for u in users]
+
+    # ----- Test that walking the pages gives every user once, in order -----
+    def test_pages(self):
+        for sort in ('joined', 'username'):
+            for role in (None, self.roles['User']):
+                for confirmed in (None, True, False):
+                    pages = self.walk(role=role, confirmed=confirmed, sort=sort)
+                    self.assertTrue(all(len(page) == 3 for page in pages[:-1]))
+                    self.assertEqual(sum(pages, []), self.expected(sort, role, confirmed),
+                                     (sort, role, confirmed))
+
+    def test_users_without_sort_key_come_last(self):
+        self.assertEqual(sum(self.walk(sort='joined'), [])[-1], 'old@example.com')
+        self.assertEqual(sum(self.walk(sort='username'), [])[-1], 'nameless@example.com')
+
+    # ----- Test that every page is a seek on an index, without sorting -----
+    # 'confirmed' is in none of the indexes, it is filtered while walking them
+    def test_query_plans(self):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT') and 'users' in statement:
+                statements.append((statement, parameters))
+
+        engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            for sort in ('joined', 'username'):
+                for role in (None, self.roles['User']):
+                    for confirmed in (None, True, False):
+                        self.walk(role=role, confirmed=confirmed, sort=sort)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertGreater(len(statements), 16)
+        for statement, parameters in statements:
+            plan = ' '.join(row[-1] for row in
+                            db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters))
+            self.assertNotIn('TEMP B-TREE', plan, statement)
+            self.assertIn('USING INDEX', plan, statement)
+
+    # ----- Test that cursors are checked -----
+    def test_invalid_cursor(self):
+        self.assertEqual(decode_cursor(encode_cursor(0, [datetime(2022, 1, 1), 5]), 'joined'),
+                         (0, (datetime(2022, 1, 1), 5)))
+        for cursor in ('nonsense', encode_cursor(2, [5]), encode_cursor(0, ['x']), encode_cursor(0, [1, 2, 3])):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor, 'joined')
+
+    # ----- Test the approximate counts -----
+    def test_counts(self):
+        self.assertEqual(directory.count(), (None, None))
+        directory.refresh_counts()
+        total, counted_at = directory.count()
+        self.assertEqual(total, User.query.count())
+        self.assertLess(datetime.utcnow() - counted_at, timedelta(seconds=5))
+        user_role = self.roles['User']
+        self.assertEqual(directory.count(user_role.id, False)[0],
+                         user_role.users.filter_by(confirmed=False).count())
+        self.assertEqual(directory.count(confirmed=True)[0], User.query.filter_by(confirmed=True).count())
+        db.session.add(User(email='new@example.com', username='new', password='cat'))
+        db.session.commit()
+        self.assertEqual(directory.count()[0], total)  # until the next refresh
+        directory.refresh_counts()
+        self.assertEqual(directory.count()[0], total + 1)
+        self.assertEqual(UserCount.query.count(), 5)  # (role, confirmed) pairs
+
+    def test_stale_counts_refresh_in_background(self):
+        directory.refresh_counts()
+        with mock.patch.object(directory, '_refresh_in_background') as refresh:
+            directory.count()
+            self.app.config['PURPLE_DIRECTORY_COUNTS_INTERVAL'] = 60
+            directory.count()
+            self.assertFalse(refresh.called)
+            UserCount.query.update({'refreshed_at': datetime.utcnow() - timedelta(minutes=2)})
+            directory.count()
+            refresh.assert_called_once_with(self.app)
+
+    # ----- Test the page /admin/users -----
+    def login(self, email):
+        return self.client.post('/auth/login', data={'email': email, 'password': 'cat'})
+
+    def test_view_requires_admin(self):
+        self.login('user1@example.com')
+        self.assertEqual(self.client.get('/admin/users').status_code, 403)
+
+    def test_view(self):
+        directory.refresh_counts()
+        self.login('admin@example.com')
+        self.app.config['PURPLE_DIRECTORY_PER_PAGE'] = 4
+        role = self.roles['User']
+        url, seen = '/admin/users?sort=username&confirmed=1&role=%d' % role.id, []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            html = response.get_data(as_text=True)
+            self.assertIn('About %d users' % role.users.filter_by(confirmed=True).count(), html)
+            seen += [u.email for u in role.users.filter_by(confirmed=True) if '>%s<' % u.email in html]
+            url = None
+            if 'Next page' in html:
+                url = html.split('<li class="next"><a href="')[1].split('"')[0].replace('&amp;', '&')
+        self.assertEqual(sorted(seen), sorted(self.expected('username', role, True)))
+
+    def test_view_bad_arguments(self):
+        self.login('admin@example.com')
+        for query in ('sort=age', 'confirmed=maybe', 'role=999', 'after=nonsense'):
+            self.assertEqual(self.client.get('/admin/users?' + query).status_code, 400, query)
+        self.assertIn('Not counted yet', self.client.get('/admin/users').get_data(as_text=True))
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime
+from app import db, mail
+from app.email import send_email
+from app.models import User, Role, OutboxMessage
+from tests.base import file_app
+
+
+class OutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = file_app(os.path.join(self.tmpdir, 'outbox.sqlite'))
+        self.request_context = self.app.test_request_context()
+        self.request_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john', password='cat')
+        db.session.add(self.user)
+        db.session.commit()
+        self.pool = self.app.extensions['outbox']
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.request_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def _send(self):
+        return send_email(self.user.email, 'Confirm Your Account', 'auth/email/confirm',
+                          user=self.user, token='token')
+
+    # ----- Test synchronous mode used by the test config -----
+    def test_sync_send(self):
+        with mail.record_messages() as outbox:
+            message = self._send()
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(outbox[0].recipients, ['john@example.com'])
+        self.assertEqual(message.status, 'sent')
+        self.assertEqual(message.attempts, 1)
+
+    # ----- Test that queued messages are persisted and drained in one batch -----
+    def test_queue_and_drain(self):
+        self.app.config['PURPLE_MAIL_OUTBOX_SYNC'] = False
+        for _ in range(3):
+            self._send()
+        db.session.info.pop('outbox_wakeup')  # keep the worker threads out of the test
+        db.session.commit()
+        self.assertEqual(self.pool.stats()['queue_depth'], 3)
+        with mail.record_messages() as outbox:
+            self.assertEqual(self.pool.drain(), 3)
+        self.assertEqual(len(outbox), 3)
+        stats = self.pool.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['sent'], 3)
+        self.assertEqual(OutboxMessage.query.filter_by(status='sent').count(), 3)
+
+    # ----- Test retry with backoff and the final 'failed' state -----
+    def test_retry_and_fail(self):
+        self.app.config['PURPLE_MAIL_OUTBOX_SYNC'] = False
+        self._send()
+        db.session.info.pop('outbox_wakeup')
+        db.session.commit()
+        self.pool.max_attempts = 2
+        with mock.patch.object(mail, 'connect', side_effect=ConnectionRefusedError('refused')):
+            self.pool.drain()
+            message = OutboxMessage.query.first()
+            self.assertEqual(message.status, 'pending')
+            self.assertEqual(message.attempts, 1)
+            self.assertTrue(message.next_attempt_at > datetime.utcnow())
+            self.assertEqual(self.pool.drain(), 0)  # not due yet
+            message.next_attempt_at = datetime.utcnow()
+            db.session.commit()
+            self.pool.drain()
+        db.session.expire_all()
+        message = OutboxMessage.query.first()
+        self.assertEqual(message.status, 'failed')
+        self.assertIn('refused', message.last_error)
+        self.assertEqual(self.pool.stats()['failed'], 1)
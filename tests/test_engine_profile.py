@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+from sqlalchemy.pool import QueuePool
+from app import db
+from config import ProductionConfig
+from tests.base import file_app
+
+
+class EngineProfileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = file_app(os.path.join(self.tmpdir, 'app.sqlite'))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    # Engines are made per URI, so the profile is set before switching to the file
+    def _use_file(self, profile=None, pool_options=None):
+        if profile is not None:
+            self.app.config['SQLALCHEMY_ENGINE_PROFILE'] = profile
+        self.app.config['SQLALCHEMY_POOL_OPTIONS'] = pool_options
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(self.tmpdir, 'p.sqlite')
+
+    def _pragma(self, name):
+        with db.engine.connect() as conn:
+            return conn.exec_driver_sql('PRAGMA %s' % name).scalar()
+
+    def test_default_profile(self):
+        self._use_file()
+        self.assertEqual(self._pragma('foreign_keys'), 1)
+        self.assertEqual(self._pragma('busy_timeout'), 5000)
+        self.assertEqual(self._pragma('journal_mode'), 'delete')
+        self.assertNotIsInstance(db.engine.pool, QueuePool)
+
+    def test_production_profile(self):
+        self._use_file(ProductionConfig.SQLALCHEMY_ENGINE_PROFILE, ProductionConfig.SQLALCHEMY_POOL_OPTIONS)
+        self.assertEqual(self._pragma('journal_mode'), 'wal')
+        self.assertEqual(self._pragma('synchronous'), 1)  # NORMAL
+        self.assertEqual(self._pragma('temp_store'), 2)  # MEMORY
+        self.assertEqual(self._pragma('cache_size'), -64 * 1024)
+        self.assertEqual(self._pragma('foreign_keys'), 1)
+        self.assertIsInstance(db.engine.pool, QueuePool)
+        self.assertEqual(db.engine.pool.size(), ProductionConfig.SQLALCHEMY_POOL_OPTIONS['pool_size'])
+
+    def test_profile_on_every_connection(self):
+        self._use_file(pool_options={'pool_size': 2})
+        with db.engine.connect() as a, db.engine.connect() as b:
+            for conn in (a, b):
+                self.assertEqual(conn.exec_driver_sql('PRAGMA foreign_keys').scalar(), 1)
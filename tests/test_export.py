@@ -0,0 +1,56 @@
+import csv
+import gzip
+import io
+import json
+from datetime import datetime, timedelta
+from app import db
+from app.exporter import encode, export_users, iter_rows
+from app.models import User, Role
+from tests.base import DatabaseTestCase
+
+
+class ExportTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        admin_role = Role.query.filter_by(name='Administrator').first()
+        db.session.add_all([
+            User(email='admin@example.com', username='admin', password='cat',
+                 confirmed=True, role=admin_role),
+            User(email='john@example.com', username='john', password='cat', confirmed=True,
+                 last_seen=datetime.utcnow() - timedelta(days=30))])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def login(self, email):
+        return self.client.post('/auth/login', data={'email': email, 'password': 'cat'})
+
+    # ----- Test NDJSON and CSV encoding -----
+    def test_encode(self):
+        lines = b''.join(encode(iter_rows(), 'ndjson', batch_size=1)).decode().splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([r['username'] for r in rows], ['admin', 'john'])
+        self.assertNotIn('password_hash', rows[0])
+        text = b''.join(encode(iter_rows(), 'csv')).decode()
+        self.assertEqual(len(list(csv.DictReader(io.StringIO(text)))), 2)
+
+    # ----- Test --since filter and gzip output -----
+    def test_since_and_gzip(self):
+        out = io.BytesIO()
+        export_users(out, 'ndjson', compress=True, since=datetime.utcnow() - timedelta(days=1))
+        lines = gzip.decompress(out.getvalue()).decode().splitlines()
+        self.assertEqual([json.loads(line)['username'] for line in lines], ['admin'])
+
+    # ----- Test that the HTTP export is for administrators only -----
+    def test_endpoint_requires_admin(self):
+        self.login('john@example.com')
+        self.assertEqual(self.client.get('/admin/users/export').status_code, 403)
+
+    # ----- Test that the HTTP export matches the command line output -----
+    def test_endpoint_output(self):
+        self.login('admin@example.com')
+        response = self.client.get('/admin/users/export?format=csv&gzip=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/gzip')
+        out = io.BytesIO()
+        export_users(out, 'csv', compress=True)
+        self.assertEqual(gzip.decompress(response.data), gzip.decompress(out.getvalue()))
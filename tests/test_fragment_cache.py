@@ -0,0 +1,58 @@
+from app import db, fragment_cache
+from app.models import User, Role
+from tests.base import DatabaseTestCase
+
+
+class FragmentCacheTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['PURPLE_FRAGMENT_CACHE_ENABLED'] = True
+        admin_role = Role.query.filter_by(name='Administrator').first()
+        db.session.add_all([
+            User(email='john@example.com', username='john', password='cat', confirmed=True),
+            User(email='admin@example.com', username='admin', password='cat', confirmed=True,
+                 role=admin_role)])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    # ----- Test that the second view is served from the cache -----
+    def test_hit(self):
+        first = self.client.get('/user/john').data
+        second = self.client.get('/user/john').data
+        self.assertEqual(first, second)
+        stats = fragment_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertTrue(stats['bytes'] > 0)
+
+    # ----- Test that a change of the user drops the entry -----
+    def test_invalidation(self):
+        self.client.get('/user/john')
+        u = User.query.filter_by(username='john').first()
+        u.location = 'Paris'
+        db.session.commit()
+        self.assertEqual(fragment_cache.stats()['size'], 0)
+        self.assertIn(b'Paris', self.client.get('/user/john').data)
+
+    # ----- Test separate variants for administrators and other viewers -----
+    def test_admin_variant(self):
+        self.assertNotIn(b'mailto:john@example.com', self.client.get('/user/john').data)
+        self.client.post('/auth/login', data={'email': 'admin@example.com', 'password': 'cat'})
+        self.assertIn(b'mailto:john@example.com', self.client.get('/user/john').data)
+        self.assertEqual(fragment_cache.stats()['size'], 2)
+
+    # ----- Test LRU eviction within the memory budget -----
+    def test_memory_budget(self):
+        cache = self.app.extensions['fragment_cache']
+        self.client.get('/user/john')
+        cache.max_bytes = cache.bytes + 10  # room for about one entry
+        self.client.get('/user/admin')
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(cache.bytes <= cache.max_bytes)
+        self.assertEqual(fragment_cache.stats()['evictions'], 1)
+
+    # ----- Test the admin stats page -----
+    def test_stats_page(self):
+        self.client.post('/auth/login', data={'email': 'admin@example.com', 'password': 'cat'})
+        response = self.client.get('/admin/stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'hit_ratio', response.data)
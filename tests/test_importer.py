@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+from app import db, importer, password_hasher
+from app.importer import import_users
+from app.models import User
+from tests.base import DatabaseTestCase
+
+
+class ImporterTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(User(email='john@example.com', username='john', password='cat'))
+        db.session.commit()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmp)
+
+    def _write(self, name, text):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def _import(self, path, **options):
+        return import_users(path, chunk_size=2,
+                            reject_path=os.path.join(self.tmp, 'rejects.jsonl'),
+                            checkpoint_path=os.path.join(self.tmp, 'progress'), **options)
+
+    # ----- Test CSV import with duplicates going to the reject file -----
+    def test_csv_import(self):
+        path = self._write('users.csv', 'email,username,password,role,confirmed\n'
+                                        'susan@example.org,susan,dog,,true\n'
+                                        'John@Example.com,johnny,cat,,\n'
+                                        'david@example.net,Susan,cat,,\n'
+                                        'mod@example.net,mod,cat,Moderator,\n'
+                                        'x@example.net,x,cat,Nobody,\n')
+        report = self._import(path)
+        self.assertEqual(report['inserted'], 2)
+        self.assertEqual(report['rejected'], 3)
+        susan = User.query.filter_by(username='susan').first()
+        self.assertTrue(susan.confirmed)
+        self.assertEqual(susan.email_canonical, 'susan@example.org')
+        self.assertTrue(susan.verify_password('dog'))
+        self.assertEqual(susan.role.name, 'User')
+        self.assertEqual(User.query.filter_by(username='mod').first().role.name, 'Moderator')
+        with open(os.path.join(self.tmp, 'rejects.jsonl')) as f:
+            reasons = [json.loads(line)['reject_reason'] for line in f]
+        self.assertEqual(reasons, ['duplicate email', 'duplicate username', 'unknown role'])
+
+    # ----- Test JSON lines with pre-hashed passwords and a resumed import -----
+    def test_resume(self):
+        pwhash = password_hasher.hash('cat')
+        lines = [json.dumps({'email': 'u%d@example.com' % i, 'username': 'u%d' % i,
+                             'password_hash': pwhash}) for i in range(5)]
+        path = self._write('users.jsonl', '\n'.join(lines) + '\n')
+        with open(os.path.join(self.tmp, 'progress'), 'w') as f:
+            f.write('2')  # an earlier run got through the first chunk
+        report = self._import(path)
+        self.assertEqual(report['skipped'], 2)
+        self.assertEqual(report['inserted'], 3)
+        self.assertIsNone(User.query.filter_by(username='u1').first())
+        self.assertTrue(User.query.filter_by(username='u4').first().verify_password('cat'))
+        with open(os.path.join(self.tmp, 'progress')) as f:
+            self.assertEqual(f.read(), '5')
+
+    # ----- Test a crash between the commit of a chunk and its checkpoint -----
+    def test_resume_after_crash_before_checkpoint(self):
+        pwhash = password_hasher.hash('cat')
+        lines = [json.dumps({'email': 'u%d@example.com' % i, 'username': 'u%d' % i,
+                             'password_hash': pwhash}) for i in range(5)]
+        lines.append(json.dumps({'email': 'john@example.com', 'username': 'john', 'password_hash': pwhash}))
+        path = self._write('users.jsonl', '\n'.join(lines) + '\n')
+        write_checkpoint = importer._write_checkpoint
+
+        def crash_after_second_chunk(checkpoint_path, done):
+            if done == 4:
+                raise KeyboardInterrupt  # the chunk is committed, its checkpoint is not
+            write_checkpoint(checkpoint_path, done)
+
+        with mock.patch.object(importer, '_write_checkpoint', crash_after_second_chunk):
+            with self.assertRaises(KeyboardInterrupt):
+                self._import(path)
+        self.assertEqual(User.query.filter(User.username.like('u%')).count(), 4)
+        report = self._import(path)
+        self.assertEqual(report['skipped'], 4)  # 2 by the checkpoint, 2 already in the table
+        self.assertEqual(report['inserted'], 1)
+        self.assertEqual(report['rejected'], 1)  # john was there before the import
+        with open(os.path.join(self.tmp, 'rejects.jsonl')) as f:
+            self.assertEqual([json.loads(line)['username'] for line in f], ['john'])
+
+    def test_crash_in_first_chunk(self):
+        pwhash = password_hasher.hash('cat')
+        lines = [json.dumps({'email': 'u%d@example.com' % i, 'username': 'u%d' % i,
+                             'password_hash': pwhash}) for i in range(3)]
+        path = self._write('users.jsonl', '\n'.join(lines) + '\n')
+        write_checkpoint = importer._write_checkpoint
+
+        def crash(checkpoint_path, done):
+            if done:
+                raise KeyboardInterrupt
+            write_checkpoint(checkpoint_path, done)
+
+        with mock.patch.object(importer, '_write_checkpoint', crash):
+            with self.assertRaises(KeyboardInterrupt):
+                self._import(path)
+        report = self._import(path)
+        self.assertEqual((report['skipped'], report['inserted'], report['rejected']), (2, 1, 0))
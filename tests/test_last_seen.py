@@ -0,0 +1,95 @@
+import gc
+import unittest
+import weakref
+from datetime import datetime, timedelta
+from app import create_app, db, last_seen
+from app.last_seen import _buffers
+from app.models import User
+from tests.base import DatabaseTestCase
+
+
+class LastSeenTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['PURPLE_LAST_SEEN_WRITE_BEHIND'] = True
+        self.buffer = self.app.extensions['last_seen']
+        self.buffer.flush_size = 100
+        self.buffer.interval = 3600  # no time-based flush during a test
+        self.buffer.granularity = timedelta(seconds=60)
+
+    def _user(self, email, last_seen_value):
+        u = User(email=email, password='cat', last_seen=last_seen_value)
+        db.session.add(u)
+        db.session.commit()
+        return u
+
+    # ----- ping() must not dirty the session -----
+    def test_ping_is_buffered(self):
+        u = self._user('john@example.com', datetime.utcnow() - timedelta(hours=1))
+        u.ping()
+        self.assertFalse(db.session.dirty)
+        self.assertEqual(last_seen.stats()['pending'], 1)
+        self.assertEqual(last_seen.flush(), 1)
+        db.session.expire_all()
+        self.assertTrue((datetime.utcnow() - u.last_seen).total_seconds() < 3)
+
+    # ----- pings within the granularity window are skipped -----
+    def test_granularity(self):
+        u = self._user('john@example.com', datetime.utcnow())
+        u.ping()
+        stats = last_seen.stats()
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['pending'], 0)
+
+    # ----- repeated pings of one user collapse into one row -----
+    def test_coalescing(self):
+        old = datetime.utcnow() - timedelta(hours=1)
+        u1 = self._user('john@example.com', old)
+        u2 = self._user('susan@example.org', old)
+        self.buffer.granularity = timedelta(0)
+        for _ in range(5):
+            u1.ping()
+            u2.ping()
+        stats = last_seen.stats()
+        self.assertEqual(stats['pings'], 10)
+        self.assertEqual(stats['coalesced'], 8)
+        self.assertEqual(last_seen.flush(), 2)
+        self.assertEqual(last_seen.stats()['written'], 2)
+
+    # ----- reaching PURPLE_LAST_SEEN_FLUSH_SIZE flushes immediately -----
+    def test_flush_on_size(self):
+        self.buffer.flush_size = 2
+        old = datetime.utcnow() - timedelta(hours=1)
+        self._user('john@example.com', old).ping()
+        self._user('susan@example.org', old).ping()
+        stats = last_seen.stats()
+        self.assertEqual(stats['flushes'], 1)
+        self.assertEqual(stats['pending'], 0)
+
+    # ----- an older buffered value never overwrites a newer one -----
+    def test_flush_only_moves_forward(self):
+        u = self._user('john@example.com', datetime.utcnow() - timedelta(hours=1))
+        u.ping()
+        newer = datetime.utcnow() + timedelta(hours=1)
+        User.query.filter_by(id=u.id).update({'last_seen': newer})
+        db.session.commit()
+        last_seen.flush()
+        db.session.expire_all()
+        self.assertEqual(u.last_seen, newer)
+
+
+class LastSeenLifetimeTestCase(unittest.TestCase):
+    # A buffer is not kept alive by the atexit hook or by its flusher thread
+    def test_buffer_is_collected(self):
+        app = create_app('testing-memory', blueprints=False)
+        buffer = app.extensions['last_seen']
+        buffer.interval = 0.05
+        buffer.record(1, datetime.utcnow())  # starts the flusher thread
+        buffer._pending.clear()  # nothing for it to write
+        flusher, ref = buffer._flusher, weakref.ref(buffer)
+        self.assertIn(buffer, _buffers)
+        del app, buffer
+        gc.collect()
+        self.assertIsNone(ref())
+        flusher.join(1)
+        self.assertFalse(flusher.is_alive())
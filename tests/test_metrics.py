@@ -0,0 +1,109 @@
+import unittest
+from app import create_app, db, metrics
+from app.metrics import BACKGROUND, Histogram, render_prometheus
+from app.models import User, Role
+from tests.base import DatabaseTestCase
+
+
+class MetricsTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        admin_role = Role.query.filter_by(name='Administrator').first()
+        db.session.add_all([
+            User(email='john@example.com', username='john', password='cat', confirmed=True),
+            User(email='admin@example.com', username='admin', password='cat', confirmed=True,
+                 role=admin_role)])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_histogram(self):
+        h = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            h.observe(value)
+        self.assertEqual(h.counts, [2, 1, 1])
+        self.assertEqual(h.quantile(0.5), 0.1)
+        self.assertEqual(h.quantile(0.75), 1.0)
+        self.assertIsNone(h.quantile(0.95))
+
+    def test_request_and_sql(self):
+        for _ in range(3):
+            self.assertEqual(self.client.get('/user/john').status_code, 200)
+        registry = metrics.registry()
+        self.assertEqual(registry.requests[('main.user', 'GET', 200)].count, 3)
+        queries = registry.request_queries['main.user']
+        self.assertTrue(queries.sum >= 3)
+        self.assertEqual(registry.sql['main.user'][0], queries.sum)
+        self.assertEqual(registry.templates['user.html'][0], 3)
+
+    def test_failed_statement_leaves_nothing_behind(self):
+        conn = db.session.connection()
+        with self.assertRaises(Exception):
+            conn.exec_driver_sql('SELECT * FROM no_such_table')
+        self.assertNotIn('metrics_start', conn.info)
+        before = metrics.registry().sql.get(BACKGROUND, (0, 0.0))[0]
+        conn.exec_driver_sql('SELECT 1')
+        self.assertEqual(metrics.registry().sql[BACKGROUND][0], before + 1)
+
+    def test_emails_queued(self):
+        self.client.post('/auth/register', data={
+            'email': 'susan@example.com', 'username': 'susan', 'password': 'dog', 'password2': 'dog'})
+        key = ('emails_queued', (('template', 'auth/email/confirm'),))
+        self.assertEqual(metrics.registry().counters[key], 1)
+
+    def test_prometheus_endpoint(self):
+        self.app.config['PURPLE_METRICS_TOKEN'] = 'secret'
+        self.client.get('/user/john')
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        text = response.get_data(as_text=True)
+        self.assertIn('purple_http_request_duration_seconds_bucket{endpoint="main.user",'
+                      'method="GET",status="200",le="+Inf"} 1', text)
+        self.assertIn('purple_http_request_queries_count{endpoint="main.user"} 1', text)
+        self.assertIn('purple_sql_queries_total{endpoint="main.user"}', text)
+        self.assertIn('purple_user_cache_hits ', text)
+
+    def test_prometheus_token(self):
+        self.app.config['PURPLE_METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_prometheus_without_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.app.debug = True
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_label_escaping(self):
+        registry = metrics.registry()
+        registry.inc('odd', path='a"b\\c')
+        self.assertIn('purple_odd_total{path="a\\"b\\\\c"} 1', render_prometheus(registry))
+
+    def test_admin_page(self):
+        self.client.get('/user/john')
+        metrics.inc('emails_queued', template='a')
+        metrics.inc('emails_queued', template='b')
+        self.assertEqual(self.client.get('/admin/metrics').status_code, 302)  # login first
+        self.client.post('/auth/login', data={'email': 'admin@example.com', 'password': 'cat'})
+        response = self.client.get('/admin/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'main.user', response.data)
+        self.assertIn(b'user.html', response.data)
+
+
+class MetricsDisabledTestCase(unittest.TestCase):
+    def test_nothing_hooked_in(self):
+        from config import TestingConfig
+        TestingConfig.PURPLE_METRICS_ENABLED = False
+        try:
+            app = create_app('testing-memory')
+        finally:
+            del TestingConfig.PURPLE_METRICS_ENABLED
+        self.assertIsNone(app.extensions['metrics'])
+        self.assertFalse([hook for hook in app.extensions.get('engine_hooks', [])
+                          if hook.__module__ == 'app.metrics'])
+        self.assertEqual(app.test_client().get('/metrics').status_code, 404)
+        with app.app_context():
+            metrics.inc('emails_queued', template='x')  # no-op
@@ -0,0 +1,92 @@
+import gc
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.request
+from datetime import datetime, timedelta
+from app import db
+from app.models import Role, User
+from app.prefork import after_fork, before_exit, warm_up
+from tests.base import DatabaseTestCase, file_app
+
+
+class PreforkHooksTestCase(DatabaseTestCase):
+    def test_warm_up(self):
+        try:
+            warm_up(self.app)
+        finally:
+            gc.unfreeze()
+        self.assertIn('bootstrap/base.html', self.app.extensions['templates']['load_seconds'])
+        self.assertIsNotNone(self.app.extensions['permissions'])
+        self.assertIsNotNone(self.app.extensions['availability']['filters'])
+        self.assertEqual(self.app.extensions['prefork']['master_pid'], os.getpid())
+
+    def test_after_fork(self):
+        pool = db.engine.pool
+        buffer = self.app.extensions['last_seen']
+        buffer._flusher = object()  # the master's thread
+        after_fork(self.app)
+        self.assertIsNot(db.engine.pool, pool)
+        self.assertIsNone(buffer._flusher)
+
+    def test_before_exit_flushes_last_seen(self):
+        self.app.config['PURPLE_LAST_SEEN_WRITE_BEHIND'] = True
+        self.app.extensions['last_seen'].interval = 0  # no flusher thread
+        u = User(email='john@example.com', password='cat', last_seen=datetime.utcnow() - timedelta(hours=1))
+        db.session.add(u)
+        db.session.commit()
+        u.ping()
+        before_exit(self.app)
+        db.session.expire_all()
+        self.assertLess(datetime.utcnow() - User.query.get(u.id).last_seen, timedelta(seconds=5))
+
+
+class PreforkServerTestCase(unittest.TestCase):
+    # python wsgi.py: serves, reloads on HUP without refusing requests, stops on TERM
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'prefork.sqlite')
+        url = 'sqlite:///' + path
+        app = file_app(path)
+        with app.app_context():
+            db.create_all()
+            Role.insert_roles()
+            db.session.remove()
+            db.engine.dispose()
+        self.env = dict(os.environ, FLASK_CONFIG='production', DATABASE_URL=url, PURPLE_BIND='127.0.0.1:0',
+                        WEB_CONCURRENCY='2', PURPLE_WEB_THREADS='2', PURPLE_HASH_POOL_WORKERS='0',
+                        PURPLE_TEMPLATE_CACHE_DIR=os.path.join(self.tmpdir, 'templates'),
+                        PURPLE_THROTTLE_STORE=os.path.join(self.tmpdir, 'throttle.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _get(self, url):
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.status
+
+    def test_serve_reload_stop(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        proc = subprocess.Popen([sys.executable, 'wsgi.py'], cwd=root, env=self.env,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        try:
+            line = proc.stdout.readline()
+            self.assertIn('2 workers x 2 threads', line)
+            base_url = line.split()[2].rstrip(',')
+            self.assertEqual(self._get(base_url + '/'), 200)
+            proc.send_signal(signal.SIGHUP)
+            deadline = time.monotonic() + 2
+            while time.monotonic() < deadline:  # old workers stopping, new ones starting
+                self.assertEqual(self._get(base_url + '/auth/login'), 200)
+            proc.send_signal(signal.SIGTERM)
+            self.assertEqual(proc.wait(15), 0)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
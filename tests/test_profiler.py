@@ -0,0 +1,82 @@
+import os
+import pstats
+import shutil
+import tempfile
+from app import db, profiler
+from app.models import User, Role
+from tests.base import DatabaseTestCase
+
+
+class ProfilerTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.app.config['PURPLE_PROFILER_DIR'] = os.path.join(self.tmpdir, 'profiles')
+        admin_role = Role.query.filter_by(name='Administrator').first()
+        db.session.add_all([
+            User(email='john@example.com', username='john', password='cat', confirmed=True),
+            User(email='admin@example.com', username='admin', password='cat', confirmed=True,
+                 role=admin_role)])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _login(self, email):
+        self.client.post('/auth/login', data={'email': email, 'password': 'cat'})
+
+    def test_only_admins(self):
+        response = self.client.get('/user/john?__profile=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile', response.headers)
+        self._login('john@example.com')
+        self.assertNotIn('X-Profile', self.client.get('/user/john?__profile=1').headers)
+        self.assertEqual(profiler.names(), [])
+
+    def test_cprofile(self):
+        self._login('admin@example.com')
+        response = self.client.get('/user/john?__profile=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'john', response.data)
+        name = response.headers['X-Profile']
+        self.assertIn('-GET-main_user-', name)
+        self.assertTrue(name.endswith('.pstats'))
+        stats = pstats.Stats(os.path.join(self.app.config['PURPLE_PROFILER_DIR'], name))
+        self.assertTrue(any(func[2] == 'user' for func in stats.stats))
+
+    def test_stack_sampler(self):
+        self.app.config['PURPLE_PROFILER_INTERVAL'] = 0.0005
+        self._login('admin@example.com')
+        response = self.client.get('/user/john', headers={'X-Profile': 'stacks'})
+        name = response.headers['X-Profile']
+        self.assertTrue(name.endswith('.stacks'))
+        with open(os.path.join(self.app.config['PURPLE_PROFILER_DIR'], name)) as f:
+            for line in f:
+                stack, count = line.rsplit(' ', 1)
+                self.assertGreater(int(count), 0)
+
+    def test_sample_every(self):
+        self.app.config['PURPLE_PROFILER_SAMPLE_EVERY'] = 3
+        for _ in range(6):
+            self.client.get('/auth/login')
+        self.assertEqual(len(profiler.names()), 2)
+
+    def test_ring(self):
+        self.app.config['PURPLE_PROFILER_KEEP'] = 3
+        self._login('admin@example.com')
+        names = [self.client.get('/?__profile=1').headers['X-Profile'] for _ in range(5)]
+        self.assertEqual(profiler.names(), names[:1:-1])
+
+    def test_list_and_download(self):
+        self._login('admin@example.com')
+        name = self.client.get('/?__profile=1').headers['X-Profile']
+        response = self.client.get('/admin/profiles')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(name.encode(), response.data)
+        response = self.client.get('/admin/profiles/' + name)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        self.assertEqual(self.client.get('/admin/profiles/..%2Fconfig.py').status_code, 404)
+        self.assertEqual(self.client.get('/admin/profiles/missing.pstats').status_code, 404)
@@ -0,0 +1,100 @@
+import unittest
+from unittest import mock
+from flask import Blueprint
+from app import create_app, db
+from app.models import Role
+from app.query_budget import QueryBudgetExceeded, assert_max_queries, query_budget
+from config import TestingConfig
+from tests.base import DatabaseTestCase
+
+
+class AssertMaxQueriesTestCase(DatabaseTestCase):
+    def test_context_manager(self):
+        with assert_max_queries(1) as counter:
+            Role.query.all()
+        self.assertEqual(len(counter.statements), 1)
+        with self.assertRaises(QueryBudgetExceeded) as cm:
+            with assert_max_queries(2):
+                for _ in range(3):
+                    Role.query.filter_by(name='User').first()
+        self.assertIn('3x SELECT', str(cm.exception))
+
+    def test_decorator(self):
+        @assert_max_queries(0)
+        def lookup():
+            return Role.query.all()
+        with self.assertRaises(QueryBudgetExceeded):
+            lookup()
+
+    def test_other_threads_are_not_counted(self):
+        import threading
+
+        def query():
+            with self.app.app_context():
+                Role.query.all()
+                db.session.remove()
+        with assert_max_queries(0):
+            t = threading.Thread(target=query)
+            t.start()
+            t.join()
+
+
+class RequestBudgetTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        bp = Blueprint('budget_test', __name__)
+
+        @bp.route('/roles/<int:n>')
+        @query_budget(2)
+        def roles(n):
+            for i in range(n):
+                Role.query.filter_by(id=i).first()
+            return 'ok'
+
+        @bp.route('/role-names')
+        def role_names():
+            return ','.join(Role.query.filter_by(name=name).first().name for name in ('User', 'Moderator'))
+
+        self.app.register_blueprint(bp)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_within_budget(self):
+        self.assertEqual(self.client.get('/roles/2').status_code, 200)
+        self.assertEqual(self.client.get('/role-names').status_code, 200)  # no budget, 2 < repeat limit
+
+    def test_over_budget_raises(self):
+        with self.assertRaises(QueryBudgetExceeded) as cm:
+            self.client.get('/roles/3')
+        self.assertIn('3 queries, budget 2', str(cm.exception))
+
+    def test_repeated_statement(self):
+        self.app.config['PURPLE_QUERY_REPEAT_LIMIT'] = 1
+        with self.assertRaises(QueryBudgetExceeded) as cm:
+            self.client.get('/role-names')
+        self.assertIn('run more than 1 times', str(cm.exception))
+
+    def test_log_mode(self):
+        self.app.config['PURPLE_QUERY_BUDGET'] = 'log'
+        with self.assertLogs('app.query_budget', 'WARNING') as logs:
+            self.assertEqual(self.client.get('/roles/3').status_code, 200)
+        self.assertIn('GET /roles/3', logs.output[0])
+
+
+class ViewBudgetsTestCase(unittest.TestCase):
+    # Every view declares a budget; TestingConfig raises when one is exceeded
+    def test_views_have_budgets(self):
+        app = create_app('testing-memory')
+        missing = [endpoint for endpoint, view in app.view_functions.items()
+                   if endpoint not in ('static', 'metrics', 'bootstrap.static')
+                   and getattr(view, 'query_budget', None) is None]
+        self.assertEqual(missing, [])
+
+    def test_disabled(self):
+        with mock.patch.object(TestingConfig, 'PURPLE_QUERY_BUDGET', None):
+            app = create_app('testing-memory')
+        self.assertFalse([hook for hook in app.extensions.get('engine_hooks', [])
+                          if hook.__module__ == 'app.query_budget'])
+        self.assertEqual(TestingConfig.PURPLE_QUERY_BUDGET, 'raise')  # for the tests that come after
@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+from flask import Blueprint
+from sqlalchemy import event
+from app import db
+from app.database import ReadOnlyRequestError
+from app.decorators import read_only, read_write
+from app.models import Role, User
+from tests.base import DatabaseTestCase
+
+
+class ReadOnlyRequestTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        bp = Blueprint('read_only_test', __name__)
+
+        def rename():
+            Role.query.filter_by(name='User').first().name = 'Member'
+            db.session.flush()
+            return 'ok'
+
+        def core_update():
+            db.session.execute(Role.__table__.update().where(Role.name == 'User').values(name='Member'))
+            return 'ok'
+
+        def add_unflushed():
+            db.session.add(User(email='susan@example.com', username='susan', password='dog'))
+            return 'ok'
+
+        def rename_unflushed():
+            Role.query.filter_by(name='User').first().name = 'Member'
+            return 'ok'
+
+        bp.add_url_rule('/rename', 'rename', rename)
+        bp.add_url_rule('/add-unflushed', 'add_unflushed', add_unflushed)
+        bp.add_url_rule('/rename-unflushed', 'rename_unflushed', rename_unflushed)
+        bp.add_url_rule('/core-update', 'core_update', core_update)
+        bp.add_url_rule('/rename-anyway', 'rename_anyway', read_write(lambda: rename()))
+        bp.add_url_rule('/rename-post', 'rename_post', read_only(lambda: rename()), methods=['POST'])
+        self.app.register_blueprint(bp)
+        db.session.add(User(email='john@example.com', username='john', password='cat', confirmed=True,
+                            last_seen=datetime.utcnow() - timedelta(hours=1)))
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def _renamed(self):
+        db.session.expire_all()
+        return Role.query.filter_by(name='Member').first() is not None
+
+    def _commits(self, path, method='get'):
+        # Pop the test's app context so that the request ends with the teardown
+        # commit of Flask-SQLAlchemy, as it does outside of tests
+        commits = []
+        listener = lambda conn: commits.append(conn)
+        event.listen(db.engine, 'commit', listener)
+        self.app_context.pop()
+        try:
+            getattr(self.client, method)(path)
+        finally:
+            self.app_context.push()
+            event.remove(db.engine, 'commit', listener)
+        return len(commits)
+
+    def test_write_in_get_raises(self):
+        with self.assertRaises(ReadOnlyRequestError):
+            self.client.get('/rename')
+        with self.assertRaises(ReadOnlyRequestError) as cm:
+            self.client.get('/core-update')
+        self.assertIn('UPDATE in the read-only request GET /core-update', str(cm.exception))
+
+    def _added(self):
+        db.session.expire_all()
+        return User.query.filter_by(username='susan').first() is not None
+
+    # Changes the view leaves to the teardown commit never reach a flush
+    def test_unflushed_write_in_get_raises(self):
+        for path in ('/add-unflushed', '/rename-unflushed'):
+            with self.assertRaises(ReadOnlyRequestError) as cm:
+                self.client.get(path)
+            self.assertIn('Unflushed changes in the read-only request GET %s' % path, str(cm.exception))
+        db.session.commit()
+        self.assertFalse(self._added())
+        self.assertFalse(self._renamed())
+
+    def test_unflushed_write_in_log_mode(self):
+        self.app.config['PURPLE_READ_ONLY_WRITES'] = 'log'
+        for path, written in (('/add-unflushed', self._added), ('/rename-unflushed', self._renamed)):
+            with self.assertLogs('app.database', 'WARNING') as logs:
+                self.assertGreater(self._commits(path), 0)
+            self.assertIn('GET %s' % path, logs.output[0])
+            self.assertTrue(written())
+
+    def test_read_write_view(self):
+        self.assertEqual(self.client.get('/rename-anyway').status_code, 200)
+        db.session.commit()
+        self.assertTrue(self._renamed())
+
+    def test_read_only_post(self):
+        with self.assertRaises(ReadOnlyRequestError):
+            self.client.post('/rename-post')
+
+    def test_log_mode(self):
+        self.app.config['PURPLE_READ_ONLY_WRITES'] = 'log'
+        with self.assertLogs('app.database', 'WARNING') as logs:
+            self.assertEqual(self.client.get('/rename').status_code, 200)
+        self.assertIn('GET /rename', logs.output[0])
+        db.session.commit()
+        self.assertTrue(self._renamed())
+
+    def test_disabled(self):
+        self.app.config['PURPLE_READ_ONLY_REQUESTS'] = False
+        self.assertEqual(self.client.get('/rename').status_code, 200)
+
+    def test_no_commit_for_reads(self):
+        self.assertEqual(self._commits('/user/john'), 0)
+        self.app.config['PURPLE_READ_ONLY_REQUESTS'] = False
+        self.assertEqual(self._commits('/user/john'), 1)
+
+    def test_ping_in_read_only_request(self):
+        self.app.config['PURPLE_LAST_SEEN_WRITE_BEHIND'] = False
+        before = User.query.filter_by(username='john').first().last_seen
+        self.client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+        db.session.expire_all()
+        User.query.filter_by(username='john').update({'last_seen': before})
+        db.session.commit()
+        self.assertEqual(self.client.get('/user/john').status_code, 200)
+        db.session.expire_all()
+        self.assertGreater(User.query.filter_by(username='john').first().last_seen, before)
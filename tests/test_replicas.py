@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from flask import session as flask_session
+from app import db
+from app.models import User, Role
+from tests.base import file_app
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    # Two SQLite files: the replica is a copy of the primary, then both get a
+    # different 'location' for john so every read shows where it came from
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        primary = os.path.join(self.tmpdir, 'primary.sqlite')
+        self.replicas = [os.path.join(self.tmpdir, 'replica%d.sqlite' % i) for i in range(2)]
+        self.app = file_app(primary, replica_urls=['sqlite:///' + path for path in self.replicas])
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        db.session.add(User(email='john@example.com', username='john', password='cat', confirmed=True))
+        db.session.commit()
+        db.session.remove()
+        db.get_engine(self.app).dispose()
+        for i, path in enumerate(self.replicas):
+            shutil.copy(primary, path)
+            with db.get_engine(self.app, bind='replica_%d' % i).begin() as conn:
+                conn.exec_driver_sql("UPDATE users SET location = 'replica%d'" % i)
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("UPDATE users SET location = 'primary'")
+
+    def tearDown(self):
+        db.session.remove()
+        for bind in (None, 'replica_0', 'replica_1'):
+            db.get_engine(self.app, bind=bind).dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def _location(self):
+        return User.query.filter_by(username='john').first().location
+
+    def test_get_reads_from_replica(self):
+        with self.app.test_request_context('/', method='GET'):
+            self.assertTrue(self._location().startswith('replica'))
+        db.session.remove()
+        with self.app.test_request_context('/', method='HEAD'):
+            self.assertTrue(self._location().startswith('replica'))
+
+    def test_post_reads_from_primary(self):
+        with self.app.test_request_context('/', method='POST'):
+            self.assertEqual(self._location(), 'primary')
+
+    def test_no_request_reads_from_primary(self):
+        self.assertEqual(self._location(), 'primary')
+
+    def test_read_only_block(self):
+        with db.read_only():
+            self.assertTrue(self._location().startswith('replica'))
+        db.session.expire_all()
+        self.assertEqual(self._location(), 'primary')
+
+    def test_write_pins_session_to_primary(self):
+        with self.app.test_request_context('/', method='GET'):
+            db.session.add(User(email='susan@example.com', username='susan', password='dog'))
+            db.session.flush()
+            db.session.expire_all()
+            self.assertEqual(self._location(), 'primary')
+            self.assertEqual(User.query.filter_by(username='susan').count(), 1)
+
+    def test_update_statement_pins_session_to_primary(self):
+        with self.app.test_request_context('/', method='GET'):
+            User.query.filter_by(username='john').update({'name': 'John'})
+            self.assertEqual(self._location(), 'primary')
+
+    def test_read_your_writes_window(self):
+        with self.app.test_request_context('/', method='POST'):
+            db.session.add(User(email='susan@example.com', username='susan', password='dog'))
+            db.session.commit()
+            until = flask_session['_primary_until']
+        self.assertAlmostEqual(until, time.time() + self.app.config['PURPLE_READ_YOUR_WRITES'], delta=2)
+        db.session.remove()
+        with self.app.test_request_context('/', method='GET'):
+            flask_session['_primary_until'] = until
+            self.assertEqual(self._location(), 'primary')
+        db.session.remove()
+        with self.app.test_request_context('/', method='GET'):
+            flask_session['_primary_until'] = time.time() - 1
+            self.assertTrue(self._location().startswith('replica'))
+
+    def test_read_your_writes_window_for_teardown_commit(self):
+        with self.app.test_request_context('/', method='POST'):
+            db.session.add(User(email='susan@example.com', username='susan', password='dog'))
+            self.app.process_response(self.app.response_class())  # not flushed yet
+            self.assertIn('_primary_until', flask_session)
+        db.session.rollback()
+        with self.app.test_request_context('/', method='POST'):
+            self.app.process_response(self.app.response_class())
+            self.assertNotIn('_primary_until', flask_session)
+
+    def test_read_your_writes_window_after_password_change(self):
+        client = self.app.test_client()
+        client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+        with client.session_transaction() as session:
+            session.pop('_primary_until', None)
+        response = client.post('/auth/change-password',
+                               data={'old_password': 'cat', 'password': 'dog', 'password2': 'dog'})
+        self.assertEqual(response.status_code, 302)
+        with client.session_transaction() as session:
+            self.assertIn('_primary_until', session)
+
+    def test_round_robin(self):
+        seen = []
+        for _ in range(4):
+            db.session.remove()
+            with self.app.test_request_context('/', method='GET'):
+                seen.append(self._location())
+        self.assertEqual(seen, ['replica0', 'replica1', 'replica0', 'replica1'])
+
+    def test_least_loaded(self):
+        replicas = self.app.extensions['replicas']
+        replicas.strategy = 'least_loaded'
+        with db.get_engine(self.app, bind='replica_0').connect():
+            self.assertEqual(replicas.in_use['replica_0'], 1)
+            with self.app.test_request_context('/', method='GET'):
+                self.assertEqual(self._location(), 'replica1')
+        self.assertEqual(replicas.in_use['replica_0'], 0)
+
+    def test_profile_page_from_replica(self):
+        response = self.app.test_client().get('/user/john')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'replica', response.data)
+        self.assertNotIn(b'primary', response.data)
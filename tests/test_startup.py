@@ -0,0 +1,85 @@
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+import app
+from app import create_app
+from tests.bench.bench_import_time import check, load_budget, measure
+
+
+class StartupTestCase(unittest.TestCase):
+    # The forbidden modules of tests/bench/import_budget.json; the times are
+    # only checked by the benchmark
+    def test_forbidden_imports(self):
+        results = measure(runs=1, scenarios=['create_app cli', 'create_app web'])
+        self.assertEqual(check(results, load_budget(), times=False), [])
+
+    def test_without_blueprints(self):
+        cli_app = create_app('testing', blueprints=False)
+        self.assertNotIn('auth', cli_app.blueprints)
+        self.assertNotIn('bootstrap', cli_app.blueprints)
+        self.assertNotIn('moment', cli_app.jinja_env.globals)
+        self.assertIn('outbox', cli_app.extensions)
+
+    def test_lazy_extensions(self):
+        self.assertIs(app.mail, app.mail)
+        with self.assertRaises(AttributeError):
+            app.no_such_extension
+
+
+class ManageAppTestCase(unittest.TestCase):
+    # Which app each manage.py command gets, see app_for_command()
+    def setUp(self):
+        import tests.base  # 'testing-memory', no database file opened
+        environ = mock.patch.dict(os.environ, FLASK_CONFIG='testing-memory')
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def test_no_app_commands(self):
+        import manage
+        for command in ('test', 'bench'):
+            app = manage.app_for_command(command)
+            self.assertEqual(app.blueprints, {})
+            self.assertNotIn('sqlalchemy', app.extensions)
+
+    def test_data_commands(self):
+        import manage
+        for command in ('tokens', 'import-users', 'export-users', 'user-counts'):
+            app = manage.app_for_command(command)
+            self.assertEqual(app.blueprints, {})
+            self.assertIn('sqlalchemy', app.extensions)
+            self.assertNotIn('migrate', app.extensions)
+
+    def test_dispatch(self):
+        import manage
+        stdout = io.StringIO()
+        with mock.patch.object(sys, 'argv', ['manage.py', 'tokens', '-p', 'confirm', '1']), \
+                mock.patch.object(sys, 'stdout', stdout):
+            self.assertEqual(manage.manager.app().blueprints, {})
+            manage.manager.handle('manage.py', sys.argv[1:])
+        user_id, token = stdout.getvalue().split()
+        self.assertEqual(user_id, '1')
+        self.assertTrue(token)
+
+    def test_tokens_purpose(self):
+        import manage
+        for purpose in ('foo', 'change_email'):
+            with mock.patch.object(sys, 'argv', ['manage.py', 'tokens', '-p', purpose, '1']), \
+                    mock.patch.object(sys, 'stderr', io.StringIO()), self.assertRaises(SystemExit):
+                manage.manager.handle('manage.py', sys.argv[1:])
+
+    def test_other_commands(self):
+        import manage
+        app = manage.app_for_command('shell')
+        self.assertIn('auth', app.blueprints)
+        self.assertNotIn('migrate', app.extensions)
+
+    def test_flask_db(self):
+        # FLASK_APP=manage.py flask db ... asks the module for 'app'
+        import manage
+        self.addCleanup(vars(manage).pop, 'app', None)
+        app = manage.app
+        self.assertIn('auth', app.blueprints)
+        self.assertIn('migrate', app.extensions)
+        self.assertIs(manage.app, app)
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from flask import render_template
+from app import create_app, db, templates
+from app.models import Role, User
+from tests.base import DatabaseTestCase, MemoryTestingConfig
+
+
+def _app(**config):
+    with mock.patch.multiple(MemoryTestingConfig, **config):
+        return create_app('testing-memory')
+
+
+class BytecodeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_off_by_default(self):
+        app = create_app('testing-memory')
+        self.assertIsNone(app.jinja_env.bytecode_cache)
+        self.assertEqual(app.extensions['templates']['load_seconds'], {})
+
+    def test_prewarm(self):
+        app = _app(PURPLE_TEMPLATE_PREWARM=True)
+        loaded = app.extensions['templates']['load_seconds']
+        for name in ('base.html', 'bootstrap/base.html', 'user.html', 'auth/login.html',
+                     'auth/email/confirm.txt', 'mail/new_user.html'):
+            self.assertIn(name, loaded)
+        # nothing left to compile for the first request
+        self.assertIn('user.html', [name for loader, name in app.jinja_env.cache.keys()])
+
+    def test_shared_between_workers(self):
+        directory = os.path.join(self.tmpdir, 'cache')
+        first = _app(PURPLE_TEMPLATE_CACHE_DIR=directory, PURPLE_TEMPLATE_PREWARM=True)
+        cache = first.jinja_env.bytecode_cache
+        count = len(first.extensions['templates']['load_seconds'])
+        self.assertEqual((cache.hits, cache.misses), (0, count))
+        self.assertEqual(len([name for name in os.listdir(directory) if name.endswith('.cache')]), count)
+        self.assertFalse([name for name in os.listdir(directory) if name.startswith('.tmp-')])
+        second = _app(PURPLE_TEMPLATE_CACHE_DIR=directory, PURPLE_TEMPLATE_PREWARM=True)
+        cache = second.jinja_env.bytecode_cache
+        self.assertEqual((cache.hits, cache.misses), (count, 0))
+        with second.test_request_context():
+            self.assertIn('Forbidden', render_template('403.html'))
+
+
+class StatsPageTestCase(DatabaseTestCase):
+    def test_load_times_on_stats_page(self):
+        templates.prewarm(self.app)
+        admin_role = Role.query.filter_by(name='Administrator').first()
+        db.session.add(User(email='admin@example.com', username='admin', password='cat', confirmed=True,
+                            role=admin_role))
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'email': 'admin@example.com', 'password': 'cat'})
+        page = client.get('/admin/stats').get_data(as_text=True)
+        self.assertIn('Template load time at start', page)
+        self.assertIn('bootstrap/base.html', page)
+        self.assertEqual(templates.stats()['prewarmed'], len(self.app.extensions['templates']['load_seconds']))
@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from app import db, throttle
+from app.models import User
+from app.throttle import MemoryStore, SQLiteStore, TooBusy
+from tests.base import DatabaseTestCase
+
+
+class BucketTestCase(unittest.TestCase):
+    def _drain(self, store):
+        # 3 tokens, refilled at 1 per second
+        waits = [store.take('k', 3, 1.0, 100.0) for _ in range(4)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertAlmostEqual(waits[3], 1.0)
+        self.assertEqual(store.take('k', 3, 1.0, 101.0), 0)  # one token back after a second
+        self.assertGreater(store.take('k', 3, 1.0, 101.0), 0)
+        self.assertEqual(store.take('other', 3, 1.0, 101.0), 0)
+
+    # A full bucket of 3 tokens refilled at 3 per 3 seconds: 2 x 3 - 1 requests
+    # within 3 seconds, the burst and then the refill
+    def test_worst_case_window(self):
+        store = MemoryStore()
+        times = [100.0, 100.0, 100.0, 101.0, 102.0]
+        self.assertEqual([store.take('k', 3, 1.0, t) for t in times], [0] * 5)
+        self.assertGreater(store.take('k', 3, 1.0, 102.5), 0)
+        self.assertLess(max(times) - min(times), 3)
+
+    def test_memory_store(self):
+        self._drain(MemoryStore())
+
+    def test_sqlite_store_is_shared(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'throttle.sqlite')
+            self._drain(SQLiteStore(path))
+            self.assertGreater(SQLiteStore(path).take('k', 3, 1.0, 101.0), 0)  # e.g. another worker
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class ThrottleTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['PURPLE_THROTTLE_LIMITS'] = {
+            'login': {'ip': (10, 60), 'account': (3, 300)}, 'reset': {'ip': (2, 3600)}}
+        db.session.add(User(email='john@example.com', username='john', password='cat', confirmed=True))
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def _login(self, email, password='wrong', ip='10.0.0.1'):
+        return self.client.post('/auth/login', data={'email': email, 'password': password},
+                                environ_base={'REMOTE_ADDR': ip})
+
+    def test_account_limit(self):
+        for _ in range(3):
+            self.assertEqual(self._login('john@example.com').status_code, 200)
+        response = self._login('JOHN@example.com', password='cat', ip='10.0.0.2')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        self.assertEqual(self._login('susan@example.com').status_code, 200)  # other accounts are fine
+        self.assertEqual(throttle.stats()['limited_account'], 1)
+
+    def test_ip_limit(self):
+        for i in range(10):
+            self.assertEqual(self._login('user%d@example.com' % i).status_code, 200)
+        self.assertEqual(self._login('other@example.com').status_code, 429)
+        self.assertEqual(self._login('other@example.com', ip='10.0.0.2').status_code, 200)
+        self.assertEqual(throttle.stats()['limited_ip'], 1)
+
+    def test_get_is_not_limited(self):
+        for _ in range(15):
+            self.assertEqual(self.client.get('/auth/login').status_code, 200)
+
+    def test_reset_request_limit(self):
+        for _ in range(2):
+            self.assertEqual(self.client.post('/auth/reset', data={'email': 'x@example.com'}).status_code, 302)
+        self.assertEqual(self.client.post('/auth/reset', data={'email': 'x@example.com'}).status_code, 429)
+
+    def test_disabled(self):
+        self.app.config['PURPLE_THROTTLE_ENABLED'] = False
+        for _ in range(5):
+            self.assertEqual(self._login('john@example.com').status_code, 200)
+
+    def test_verification_slots(self):
+        self.app.config['PURPLE_VERIFY_WAIT'] = 0
+        state = self.app.extensions['throttle']
+        for _ in range(state.concurrency):
+            state.slots.acquire()  # every slot taken by other threads
+        try:
+            with self.assertRaises(TooBusy):
+                with throttle.verification():
+                    pass
+            response = self._login('john@example.com', password='cat')
+            self.assertEqual(response.status_code, 503)
+        finally:
+            for _ in range(state.concurrency):
+                state.slots.release()
+        self.assertEqual(self._login('john@example.com', password='cat').status_code, 302)
+        self.assertEqual(throttle.stats()['busy'], 2)
+
+    def test_verification_concurrency(self):
+        self.app.config['PURPLE_VERIFY_WAIT'] = 5
+        state = self.app.extensions['throttle']
+        release = threading.Event()
+
+        def verify():
+            with self.app.app_context(), throttle.verification():
+                release.wait(5)
+
+        threads = [threading.Thread(target=verify) for _ in range(state.concurrency + 2)]
+        for t in threads:
+            t.start()
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertLessEqual(throttle.stats()['verifications_peak'], state.concurrency)
+        self.assertEqual(throttle.stats()['verifications_in_flight'], 0)
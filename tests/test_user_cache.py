@@ -0,0 +1,117 @@
+from sqlalchemy import event
+from app import db, password_hasher, user_cache
+from app.models import User, Permission
+from tests.base import DatabaseTestCase
+
+
+class UserCacheTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['PURPLE_USER_CACHE_ENABLED'] = True
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        self.user_id = u.id
+        db.session.remove()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self._count)
+        super().tearDown()
+
+    def _count(self, conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith('SELECT'):
+            self.statements.append(statement)
+
+    # ----- second lookup is served without SELECTs, role included -----
+    def test_hit_needs_no_query(self):
+        self.assertIsNotNone(user_cache.get(self.user_id))
+        db.session.remove()
+        self.statements = []
+        u = user_cache.get(self.user_id)
+        self.assertEqual(u.email, 'john@example.com')
+        self.assertTrue(u.can(Permission.WRITE_ARTICLES))
+        self.assertEqual(self.statements, [])
+        stats = user_cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    # ----- a lookup keeps the unflushed changes of the session's instance -----
+    def test_lookup_keeps_pending_changes(self):
+        user_cache.get(self.user_id)  # cached
+        db.session.remove()
+        u = User.query.get(self.user_id)
+        u.about_me = 'Edited'
+        self.assertIs(user_cache.get_by_username('john'), u)
+        self.assertEqual(u.about_me, 'Edited')
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(User.query.get(self.user_id).about_me, 'Edited')
+
+    # ----- id, username and email all point to the same entry -----
+    def test_lookup_keys(self):
+        user_cache.get(self.user_id)
+        db.session.remove()
+        self.statements = []
+        self.assertEqual(user_cache.get_by_username('john').id, self.user_id)
+        self.assertEqual(user_cache.get_by_email('john@example.com').id, self.user_id)
+        self.assertEqual(self.statements, [])
+        self.assertIsNone(user_cache.get_by_username('susan'))
+
+    # ----- merged copies are ordinary persistent objects -----
+    def test_changes_are_saved_and_invalidate(self):
+        u = user_cache.get(self.user_id)
+        db.session.remove()
+        u = user_cache.get(self.user_id)
+        token = u.generate_email_change_token('susan@example.org')
+        self.assertTrue(u.change_email(token))
+        db.session.commit()
+        db.session.remove()
+        self.assertIsNone(user_cache.get_by_email('john@example.com'))
+        self.assertEqual(user_cache.get(self.user_id).email, 'susan@example.org')
+
+    # ----- a rolled back change must not stay in the cache -----
+    def test_rollback_invalidates(self):
+        u = user_cache.get(self.user_id)
+        u.confirmed = True
+        db.session.flush()
+        db.session.rollback()
+        db.session.remove()
+        self.assertFalse(user_cache.get(self.user_id).confirmed)
+
+    # ----- disabled cache falls through to the database -----
+    def test_disabled(self):
+        self.app.config['PURPLE_USER_CACHE_ENABLED'] = False
+        user_cache.get(self.user_id)
+        db.session.remove()
+        user_cache.get(self.user_id)
+        self.assertEqual(user_cache.stats()['hits'], 0)
+
+    # ----- passwords changed by another worker: the cached copy has no hash -----
+    def _change_password_elsewhere(self, password):
+        users = User.__table__
+        with db.engine.begin() as conn:  # no session, the cache is not told
+            conn.execute(users.update().where(users.c.id == self.user_id)
+                         .values(password_hash=password_hasher.hash(password)))
+
+    def test_password_hash_is_not_cached(self):
+        user_cache.get(self.user_id)
+        self._change_password_elsewhere('dog')
+        db.session.remove()
+        u = user_cache.get(self.user_id)
+        self.assertFalse(u.verify_password('cat'))
+        self.assertTrue(u.verify_password('dog'))
+
+    def test_login_and_change_password_use_current_hash(self):
+        client = self.app.test_client()
+        user_cache.get(self.user_id)
+        self._change_password_elsewhere('dog')
+        response = client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+        self.assertEqual(response.status_code, 200)  # form again, not logged in
+        response = client.post('/auth/login', data={'email': 'john@example.com', 'password': 'dog'})
+        self.assertEqual(response.status_code, 302)
+        self._change_password_elsewhere('fish')
+        response = client.post('/auth/change-password',
+                               data={'old_password': 'fish', 'password': 'bird', 'password2': 'bird'})
+        self.assertEqual(response.status_code, 302)  # 'Invalid password.' renders the form again
@@ -1,25 +1,15 @@
-import unittest
-from app import create_app, db
-from app.models import User, AnonymousUser, Role, Permission
+from sqlalchemy.exc import IntegrityError
+from app import db, user_cache
+from app.models import User, AnonymousUser, Permission, Role
+from app.query_budget import assert_max_queries
+from tests.base import DatabaseTestCase
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from unittest import mock
 
 
-class UserModelTestCase(unittest.TestCase):
-    # Basic method performed before all test_<name> methods
-    def setUp(self):
-        self.app = create_app('testing')
-        self.app_context = self.app.app_context()
-        self.app_context.push()
-        db.create_all()
-        Role.insert_roles()  # [09a] insert roles to data-test.sqlite
-
-    # Basic method performed after all test_<name> methods
-    def tearDown(self):
-        db.session.remove()
-        db.drop_all()
-        self.app_context.pop()
-
+# Schema and roles come from tests/base.py, every test is rolled back
+class UserModelTestCase(DatabaseTestCase):
     def test_password_setter(self):
         u = User(password='cat')
         self.assertTrue(u.password_hash is not None)
@@ -39,13 +29,38 @@ class UserModelTestCase(unittest.TestCase):
         u2 = User(password='cat')
         self.assertTrue(u.password_hash != u2.password_hash)
 
+    # ----- Test re-hashing of a password stored with old parameters -----
+    def test_rehash_on_login(self):
+        u = User(password='cat')
+        old_hash = u.password_hash
+        self.app.config['PURPLE_PASSWORD_METHOD'] = 'pbkdf2:sha256:300000'
+        self.assertTrue(u.verify_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:300000$'))
+        self.assertNotEqual(u.password_hash, old_hash)
+        self.assertTrue(u.verify_password('cat'))
+        self.assertFalse(u.verify_password('dog'))
+
+    # ----- Test hashing through the process pool -----
+    def test_hashing_pool(self):
+        from app.hashing import PasswordHasher
+        self.app.config['PURPLE_HASH_POOL_WORKERS'] = 1
+        hasher = PasswordHasher(self.app)
+        try:
+            pwhash = hasher.hash('cat')
+            self.assertTrue(hasher.verify(pwhash, 'cat'))
+            self.assertFalse(hasher.verify(pwhash, 'dog'))
+            self.assertEqual(len(hasher.hash_many(['a', 'b', 'c'])), 3)
+        finally:
+            hasher.shutdown()
+
     # ----- [08e] Generate and check confirm token -----
     def test_valid_confirmation_token(self):
         u = User(password='cat')
         db.session.add(u) # prepare to add
         db.session.commit() # app data to db
         token = u.generate_confirmation_token() # Generate marker
-        self.assertTrue(u.confirm(token)) # Check marker and save it in confirmed field in Model
+        with assert_max_queries(1):  # u is expired by the commit
+            self.assertTrue(u.confirm(token)) # Check marker and save it in confirmed field in Model
 
     # ----- [08e] Use invalid confirmation token for existing user -----
     def test_invalid_confirmation_token(self):
@@ -55,7 +70,8 @@ class UserModelTestCase(unittest.TestCase):
         db.session.add(u2)
         db.session.commit()
         token = u1.generate_confirmation_token()
-        self.assertFalse(u2.confirm(token)) # False if we use wrong token for user
+        with assert_max_queries(1):
+            self.assertFalse(u2.confirm(token)) # False if we use wrong token for user
 
     # ----- [08e] Check expiration -----
     def test_expired_confirmation_token(self):
@@ -63,8 +79,44 @@ class UserModelTestCase(unittest.TestCase):
         db.session.add(u)
         db.session.commit()
         token = u.generate_confirmation_token(1) # expiration = 1 sec
-        time.sleep(2)
-        self.assertFalse(u.confirm(token))
+        with mock.patch('app.tokens.time.time', return_value=time.time() + 2):  # 2 seconds later
+            with assert_max_queries(0):  # rejected before the user is read
+                self.assertFalse(u.confirm(token))
+
+    # ----- Test that a token of one purpose is rejected for another -----
+    def test_token_purpose(self):
+        u = User(password='cat')
+        db.session.add(u)
+        db.session.commit()
+        token = u.generate_reset_token()
+        with assert_max_queries(1):
+            self.assertFalse(u.confirm(token))
+            self.assertTrue(u.reset_password(token, 'dog'))
+
+    # ----- Test that tokens made by the old serializer are still accepted -----
+    def test_legacy_token(self):
+        from itsdangerous import TimedJSONWebSignatureSerializer
+        u = User(password='cat')
+        db.session.add(u)
+        db.session.commit()
+        s = TimedJSONWebSignatureSerializer(self.app.config['SECRET_KEY'], 3600)
+        self.assertFalse(u.confirm(s.dumps({'reset': u.id})))
+        self.assertTrue(u.confirm(s.dumps({'confirm': u.id})))
+        self.app.config['PURPLE_TOKEN_ACCEPT_LEGACY'] = False
+        self.assertFalse(u.confirm(s.dumps({'confirm': u.id})))
+
+    # ----- Test bulk token generation -----
+    def test_generate_tokens(self):
+        u1 = User(password='cat')
+        u2 = User(password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        ids = [u1.id, u2.id]
+        with assert_max_queries(0):  # from the ids, no user is loaded
+            tokens = User.generate_tokens('confirm', ids)
+        self.assertTrue(u1.confirm(tokens[u1.id]))
+        self.assertFalse(u2.confirm(tokens[u1.id]))
+        self.assertTrue(u2.confirm(tokens[u2.id]))
 
     # ----- [08g] Test how we can reset token (true) -----
     def test_valid_reset_token(self):
@@ -72,8 +124,9 @@ class UserModelTestCase(unittest.TestCase):
         db.session.add(u)
         db.session.commit()
         token = u.generate_reset_token()
-        self.assertTrue(u.reset_password(token, 'dog'))
-        self.assertTrue(u.verify_password('dog'))
+        with assert_max_queries(1):
+            self.assertTrue(u.reset_password(token, 'dog'))
+            self.assertTrue(u.verify_password('dog'))
 
     # ----- [08g] Test how we can reset token (false) -----
     def test_invalid_reset_token(self):
@@ -83,7 +136,8 @@ class UserModelTestCase(unittest.TestCase):
         db.session.add(u2)
         db.session.commit()
         token = u.generate_reset_token()
-        self.assertFalse(u.reset_password(token + 'a', 'horse'))
+        with assert_max_queries(0):
+            self.assertFalse(u.reset_password(token + 'a', 'horse'))
         self.assertTrue(u.verify_password('cat'))
 
     # ----- [08g] Test how we can change email address (valid) -----
@@ -92,7 +146,8 @@ class UserModelTestCase(unittest.TestCase):
         db.session.add(u)
         db.session.commit()
         token = u.generate_email_change_token('susan@example.org')
-        self.assertTrue(u.change_email(token))
+        with assert_max_queries(2):  # u, then whether the address is taken
+            self.assertTrue(u.change_email(token))
         self.assertTrue(u.email == 'susan@example.org')
 
     # ----- [08g] Test how we can change email address (invalid) -----
@@ -103,7 +158,8 @@ class UserModelTestCase(unittest.TestCase):
         db.session.add(u2)
         db.session.commit()
         token = u1.generate_email_change_token('david@example.net')
-        self.assertFalse(u2.change_email(token))
+        with assert_max_queries(1):
+            self.assertFalse(u2.change_email(token))
         self.assertTrue(u2.email == 'susan@example.org')
 
     # ----- [08g] Test how we can change email address (duplicate) -----
@@ -114,21 +170,100 @@ class UserModelTestCase(unittest.TestCase):
         db.session.add(u2)
         db.session.commit()
         token = u2.generate_email_change_token('john@example.com')
-        self.assertFalse(u2.change_email(token))
+        with assert_max_queries(2):
+            self.assertFalse(u2.change_email(token))
         self.assertTrue(u2.email == 'susan@example.org')
 
     # ----- [09a] Test to check permission -----
     def test_roles_and_permissions(self):
-        u = User(email='john@example.com', password='cat')
+        with assert_max_queries(1):  # the default role
+            u = User(email='john@example.com', password='cat')
         # Permission 'WRITE_ARTICLES' is a part of default role 'User'
-        self.assertTrue(u.can(Permission.WRITE_ARTICLES))
+        with assert_max_queries(0):
+            self.assertTrue(u.can(Permission.WRITE_ARTICLES))
+            self.assertFalse(u.can(Permission.MODERATE_COMMENTS))
+
+    # ----- Test that can() uses the permission table instead of 'role' -----
+    def test_permission_table(self):
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        u = User.query.get(u.id)
+        with assert_max_queries(0):
+            self.assertTrue(u.can(Permission.WRITE_ARTICLES))
+            self.assertFalse(u.is_administrator())
+        self.assertNotIn('role', u.__dict__)  # relationship was never loaded
+
+    # ----- Test that changing a role rebuilds the permission table -----
+    def test_permission_table_reset(self):
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertFalse(u.can(Permission.MODERATE_COMMENTS))
+        u.role.permissions |= Permission.MODERATE_COMMENTS
+        db.session.commit()
+        self.assertTrue(u.can(Permission.MODERATE_COMMENTS))
+
+    # ----- Test that roles changed by another process are read again -----
+    def test_permission_table_ttl(self):
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
         self.assertFalse(u.can(Permission.MODERATE_COMMENTS))
+        roles = Role.__table__
+        with db.engine.begin() as conn:  # not through this session, no after_commit reset
+            conn.execute(roles.update().where(roles.c.id == u.role_id).values(permissions=0xff))
+        self.assertFalse(u.can(Permission.MODERATE_COMMENTS))  # until the TTL is over
+        self.app.extensions['permissions_loaded_at'] -= self.app.config['PURPLE_PERMISSION_TABLE_TTL'] + 1
+        self.assertTrue(u.can(Permission.MODERATE_COMMENTS))
 
     # ----- [09a] Test to check permission for anonymous_user -----
     def test_anonymous_user(self):
         u = AnonymousUser()
         self.assertFalse(u.can(Permission.FOLLOW))
 
+    # ----- Canonical email/username columns -----
+    def test_canonical_columns(self):
+        u = User(email=' John@Example.com', username='John', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(u.email_canonical, 'john@example.com')
+        self.assertEqual(u.username_canonical, 'john')
+        u.email = 'JOHN@example.org'
+        self.assertEqual(u.email_canonical, 'john@example.org')
+        self.assertEqual(u.email, 'JOHN@example.org')  # typed value kept for display
+
+    def test_canonical_columns_are_unique(self):
+        db.session.add(User(email='john@example.com', username='john', password='cat'))
+        db.session.commit()
+        db.session.add(User(email='JOHN@example.com', username='other', password='cat'))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+    def test_lookup_ignores_case(self):
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        with assert_max_queries(2):  # one indexed lookup each
+            self.assertEqual(user_cache.get_by_email('John@Example.COM '), u)
+            self.assertEqual(user_cache.get_by_username('JOHN'), u)
+        with assert_max_queries(1):
+            response = self.app.test_client().post('/auth/login', data={
+                'email': 'JOHN@example.com', 'password': 'cat'})
+        self.assertEqual(response.status_code, 302)
+
+    # ----- Queries of the pages showing a user -----
+    def test_profile_queries(self):
+        db.session.add(User(email='john@example.com', username='john', password='cat', confirmed=True))
+        db.session.commit()
+        client = self.app.test_client()
+        with assert_max_queries(1):
+            self.assertEqual(client.get('/user/john').status_code, 200)
+        client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+        with assert_max_queries(3):
+            self.assertEqual(client.get('/user/john').status_code, 200)
+
     # ----- [10a] Test to check member_since field -----
     def test_timestamps(self):
         u = User(password='cat')
@@ -144,7 +279,9 @@ class UserModelTestCase(unittest.TestCase):
         u = User(password='cat')
         db.session.add(u)
         db.session.commit()
-        time.sleep(2)
+        u.last_seen -= timedelta(seconds=2)  # seen 2 seconds ago
+        db.session.commit()
         last_seen_before = u.last_seen
-        u.ping()
+        with assert_max_queries(0):  # the UPDATE waits for the commit or the write-behind buffer
+            u.ping()
         self.assertTrue(u.last_seen > last_seen_before)
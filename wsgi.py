@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# ----- Production entry point -----
+#   (venv) $ gunicorn -c gunicorn_conf.py wsgi:app
+#   (venv) $ python wsgi.py      # the same settings on the stdlib server of app/prefork.py
+# The app is built and warmed up here, in the master, before any worker is forked.
+import os
+from app import create_app
+from app.prefork import warm_up
+
+app = application = create_app(os.getenv('FLASK_CONFIG') or 'production')
+warm_up(app)
+
+
+if __name__ == '__main__':
+    import gunicorn_conf
+    from app.prefork import PreforkServer
+    PreforkServer(app, gunicorn_conf.bind, gunicorn_conf.workers, gunicorn_conf.threads,
+                  gunicorn_conf.graceful_timeout, access_log=bool(gunicorn_conf.accesslog)).run()